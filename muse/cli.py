@@ -21,45 +21,98 @@ from __future__ import absolute_import
 from __future__ import division
 from builtins import str
 from builtins import range
-from past.utils import old_div
 
+# Only the standard library and muse's own light-weight modules are imported here, so argument
+# parsing and tab-completion stay fast; numpy, pandas, h5py and matplotlib are imported when used
 import sys
 import os
 import re
 import argparse as ap
+from timeit import default_timer as timer
+from . import START
 from . import pputils as pp
+from . import logindex
+from . import colstore
+from . import trace
+from .trace import span
+from . import resample as rs
 from .plot import generate_plots
 
-from timeit import default_timer as timer
+# Points kept per line when streaming, if --max-points isn't given
+STREAM_POINTS = 4000
 
 
 def main():
     """ Top-level function for executing script """
+    start = timer()
+    if sys.argv[1:2] == ['ingest']:
+        return ingest(sys.argv[2:])
     # Parse user arguments and options
     args = parse_user_args()
     # Timing to identify slow parts
+    args.start = start
     args.time = timer()
+    if args.profile_startup:
+        profile_startup(args)
+        return 0
+    trace.tracer.start(args.trace is not None, args.verbose)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            status = profiler.runcall(plot, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        status = plot(args)
+    if args.trace:
+        trace.tracer.write(args.trace)
+    return status
+
+
+def plot(args):
+    """ Runs each stage of plotting, each in a span of its own """
     # Sanity check user arguments and options
-    sanity_check(args)
+    with span('sanity_check', 'stage'):
+        sanity_check(args)
     # If a monte-carlo run was specified, get all sub-runs
     args.runs = pp.check_monte(args.sim, args.runs)
     # Get a list of all logged variables and what log they are in
-    logs, lvars = get_logged_vars(args)
+    with span('get_logged_vars', 'stage'):
+        logs, lvars = get_logged_vars(args)
     # Get figure/plot specification information
-    figs = get_figures(args)
+    with span('get_figures', 'stage'):
+        figs = get_figures(args)
+    # Only read the part of the logs the figures need
+    get_time_window(args, figs)
     # Get list of variable to plot in figures
-    pvars = get_plot_vars(args, figs, lvars)
+    with span('get_plot_vars', 'stage'):
+        pvars = get_plot_vars(args, figs, lvars)
     # Find smallest number of logs to get all variables
-    loglist = get_logs(args, logs, pvars)
-    # Extract data for plotting
-    rdata, time = extract_data(args, pvars, loglist)
-    # Process data and apply any simple-math operations
-    figs = process_data(args, figs, rdata, time)
+    with span('get_logs', 'stage'):
+        loglist, vlog = get_logs(args, logs, pvars)
+    if args.follow:
+        # Plot the run live, reading samples as they are logged
+        follow_run(args, figs, pvars, loglist, vlog)
+        return 0
+    if args.stream_runs:
+        # Extract and process runs one at a time, folding them into statistics
+        with span('stream_runs', 'stage', runs=len(args.runs)):
+            figs = stream_runs(args, figs, pvars, loglist, vlog)
+    elif args.chunk_size:
+        # Extract and process data a chunk at a time
+        with span('stream_data', 'stage', runs=len(args.runs)):
+            figs = stream_data(args, figs, pvars, loglist, vlog)
+    else:
+        # Extract data for plotting
+        with span('extract_data', 'stage', runs=len(args.runs)):
+            rdata, time, source = extract_data(args, pvars, loglist, vlog)
+        # Process data and apply any simple-math operations
+        with span('process_data', 'stage', figures=len(figs)):
+            figs = process_data(args, figs, rdata, time, source)
     # Generate plots!
-    generate_plots(args, figs)
-    if args.verbose:
-        print("\nTiming: generate_plots at " + str(timer() - args.time))
-        args.time = timer()
+    with span('generate_plots', 'stage', figures=len(figs)):
+        generate_plots(args, figs)
     return 0
 
 
@@ -82,6 +135,12 @@ def sanity_check(args):
         if not os.path.isfile(yfile):
             print("\nDoes not exist: " + yfile)
             pp.end_script(-1)
+    pp.check_csv_engine(args.csv_engine)
+    # Logs read a chunk at a time need a csv parser that can read in chunks
+    if args.chunk_size and args.csv_engine == 'pyarrow':
+        print("\nThe pyarrow csv engine can't read logs in chunks; use --csv-engine c or python "
+              "with --chunk-size")
+        pp.end_script(-1)
     # Check log file(s) existence
     for r in args.runs:
         for l in args.log:
@@ -89,9 +148,6 @@ def sanity_check(args):
             if not os.path.isfile(lfile):
                 print("\nDoes not exist: " + lfile)
                 pp.end_script(-1)
-    if args.verbose:
-        print("\nTiming: sanity_check at " + str(timer() - args.time))
-        args.time = timer()
 
 
 def get_figures(args):
@@ -110,12 +166,19 @@ def get_figures(args):
     # Command line
     if len(args.var) > 0:
         figs.append(get_fig_info_cl(args.var))
-    if args.verbose:
-        print("\nTiming: get_figures at " + str(timer() - args.time))
-        args.time = timer()
     return figs
 
 
+def get_time_window(args, figs):
+    """ Narrows the time window read from the logs to the time ranges of the figures, if they all
+        have one and no window was given """
+    if args.tmin is None and args.tmax is None and figs and all('trange' in f for f in figs):
+        args.tmin = min(f['trange'][0] for f in figs)
+        args.tmax = max(f['trange'][-1] for f in figs)
+        if args.verbose:
+            print("\nInfo: Time window: " + str(args.tmin) + " to " + str(args.tmax))
+
+
 def get_fig_info_cl(var):
     """ Simple extract of figure information from command-line """
     fig = {}
@@ -139,32 +202,26 @@ def get_logged_vars(args):
     # Major assumption is that all comparable runs log all the same variables
     run = args.runs[0]
 
-    # Identify log files
-    find_all = False
+    # Get variables in log files
     root = os.path.join(args.sim, run)
-    files = []
+    found = []
     if args.log:  # Only variables in specific log files
-        files = args.log
-        find_all = False
-    else:  # Find all logged variables
-        files = os.listdir(root)
-        find_all = True
-
-    # Get variabls in log files
-    for f in files:
-        fpath = os.path.join(root, f)
-        name, ext = os.path.splitext(fpath)
-        name = os.path.basename(name)
-        log_var_list = []
-        if ext == ".header" and find_all:
-            log_var_list, ext = pp.get_vars_header(fpath)
-        elif ext == ".h5" and not find_all:
-            log_var_list = pp.get_vars_h5(fpath)
-        elif ext == ".csv" and not find_all:
-            log_var_list = pp.get_vars_csv(fpath)
-        else:
-            continue
-        lfile = name + ext
+        for f in args.log:
+            fpath = os.path.join(root, f)
+            name, ext = os.path.splitext(fpath)
+            lfile = os.path.basename(name) + ext
+            if ext == ".h5":
+                found.append((lfile, pp.get_vars_h5(fpath)))
+            elif ext == ".csv":
+                found.append((lfile, pp.get_vars_csv(fpath)))
+            elif ext == ".trk":
+                found.append((lfile, pp.get_vars_trk(fpath)))
+    else:  # Find all logged variables, from the index of the run's log headers
+        # Plotting only needs variable names, so logs aren't read to count their samples
+        found = list(logindex.get_index(root, samples=False).logs().items())
+
+    for lfile, log_var_list in found:
+        log_var_list = list(log_var_list or [])
         if not log_var_list:
             if args.verbose:
                 print("\nWarning: log file is empty or unsupported: " + lfile)
@@ -176,10 +233,6 @@ def get_logged_vars(args):
         print("\nError: No data logged: " + run)
         pp.end_script(-1)
 
-    if args.verbose:
-        print("\nTiming: get_logged_vars at " + str(timer() - args.time))
-        args.time = timer()
-
     return logs, list(lvars)
 
 
@@ -208,9 +261,6 @@ def get_plot_vars(args, figs, lvars):
     if args.verbose:
         print("\nInfo: Variables to plot:")
         print(list(varset))
-    if args.verbose:
-        print("\nTiming: get_plot_vars at " + str(timer() - args.time))
-        args.time = timer()
 
     return list(varset)
 
@@ -223,12 +273,12 @@ def var_parse(exp, lvars):
     # Get rid of all whitespace in expression
     exp = exp.replace(" ", "")
     # Split on:
-    # * basic operators: + * - / ( )
+    # * basic operators: + * - / ^ ( ) and commas between function arguments
     # * numbers, if they are not preceeded with a "word"-style character set
     #   and are not followed by a ] character or a number and ]
     # * period, if preceeded by a number and followed by a number
     evars = re.split(
-        r'[+*\-/()]+|(?<!\w)(\d+|(\.\d+))(?!\d|])|(?<=\d)[.](?=\d)', exp)
+        r'[+*\-/^(),]+|(?<!\w)(\d+|(\.\d+))(?!\d|])|(?<=\d)[.](?=\d)', exp)
     # Filter out null strings
     evars = [_f for _f in evars if _f]
     # Gets rid of strings that are not logged variables, such as simple operators
@@ -245,9 +295,8 @@ def var_parse(exp, lvars):
 
 
 def get_logs(args, logs, pvars):
-    """ Finds the minimum global interesection of the variables to plot and the log
-        files available """
-    logset = set([])
+    """ Finds the cheapest set of log files to read to get all of the variables to plot, and
+        which log each variable is read from """
     # Create dictionary of log files for every variable to plot
     vldict = {}
     for v in pvars:
@@ -259,27 +308,11 @@ def get_logs(args, logs, pvars):
         print("\nInfo: Variables and their logs:")
         print(vldict)
 
-    # Find lowest common denominator of log files
-    for i in range(0, len(vldict)):
-        v = list(vldict.keys())[i]
-        vl = set(vldict[v])
-        for j in range(i + 1, len(vldict)):
-            u = list(vldict.keys())[j]
-            ul = set(vldict[u])
-            if not vl == ul:
-                ls = vl.intersection(ul)
-                if not ls:
-                    if not logset.intersection(vl):
-                        logset.update(vl)
-                    if not logset.intersection(ul):
-                        logset.update(ul)
-                else:
-                    logset.update(ls)
-            else:
-                logset.update(ul)
-                continue  # next one
-    # Prioritize hdf5 files
-    loglist = list(logset)
+    # Find the cheapest set of log files to read that has all of the variables
+    root = os.path.join(args.sim, args.runs[0])
+    costs = dict((l, pp.log_cost(os.path.join(root, l))) for l in logs)
+    loglist, vlog = pp.select_logs(vldict, costs)
+    # Prioritize binary (Trick binary and hdf5) files
     loglist.sort(key=lambda l: os.path.splitext(l)[1], reverse=True)
 
     if not loglist:
@@ -288,180 +321,566 @@ def get_logs(args, logs, pvars):
     if args.verbose:
         print("\nInfo: Logs to plot from: ")
         print(loglist)
-    if args.verbose:
-        print("\nTiming: get_logs at " + str(timer() - args.time))
-        args.time = timer()
 
-    return loglist
+    return loglist, vlog
 
 
-def extract_data(args, pvars, loglist):
-    """ Extracts all data for variables to plot """
+def log_variables(loglist, pvars, vlog=None):
+    """ Variables to read from each log """
+    for l in loglist:
+        if os.path.splitext(l)[1] not in ['.h5', '.csv', '.trk']:
+            print("\nOnly csv, hdf5 and Trick binary logs are supported, not: " + l)
+            pp.end_script(-1)
+    return dict((l, [v for v in pvars if vlog is None or vlog.get(v) == l]) for l in loglist)
+
+
+def extract_data(args, pvars, loglist, vlog=None):
+    """ Extracts all data for variables to plot, each from the log it was assigned to, if given """
+    lvars = log_variables(loglist, pvars, vlog)
+    jobs = [(args, lvars, loglist, r) for r in args.runs]
+    if args.jobs > 1 and len(jobs) > 1:
+        # HDF5 reads are I/O bound, but parsing csv needs separate processes
+        if any(l.endswith('.csv') for l in loglist):
+            from multiprocessing import Pool
+        else:
+            from multiprocessing.pool import ThreadPool as Pool
+        pool = Pool(min(args.jobs, len(jobs)))
+        try:
+            results = pool.map(trace.Traced(extract_run), jobs,
+                               chunksize=max(1, len(jobs) // (4 * args.jobs)))
+            results = [trace.tracer.merge(result) for result in results]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [extract_run(job) for job in jobs]
+
     data = {}
     time = {}
-    for r in args.runs:
-        data[r] = {}
-        time[r] = {}
+    source = {}  # Log each variable was extracted from
+    runs = []
+    for r, rdata, rtime, rsource, error in results:
+        if error:
+            print("\nError: Could not extract " + r + ": " + error)
+            continue
+        data[r] = rdata
+        time[r] = rtime
+        source[r] = rsource
+        runs.append(r)
+    if not runs:
+        print("\nError: No runs could be extracted")
+        pp.end_script(-1)
+    args.runs = runs
+
+    return data, time, source
+
+
+def extract_run(job):
+    """ Extracts the data for variables to plot from the logs of a single run. Failures are returned
+        rather than ending the script, so one bad run doesn't stop the rest """
+    args, lvars, loglist, r = job
+    data = {}
+    time = {}
+    source = {}
+    try:
         # Extract based on file type
         for l in loglist:
             lfile = os.path.join(args.sim, r, l)
             name, ext = os.path.splitext(lfile)
-            if ext == '.h5':
-                data[r], time[r][l] = pp.extract_h5(
-                    args, pvars, data[r], lfile)
-            elif ext == '.csv':
-                data[r], time[r][l] = pp.extract_csv(
-                    args, pvars, data[r], lfile)
+            with span('extract_log', run=r, log=l) as info:
+                extracted_vars = set(data)
+                if ext == '.h5':
+                    extracted = pp.extract_h5(args, lvars[l], data, lfile)
+                elif ext == '.trk':
+                    extracted = pp.extract_trk(args, lvars[l], data, lfile)
+                else:
+                    extracted = pp.extract_csv(args, lvars[l], data, lfile)
+                if extracted is None:
+                    return r, data, time, source, "log could not be read: " + l
+                data, time[l] = extracted
+                info['samples'] = len(time[l])
+                info['bytes'] = int(time[l].nbytes + sum(data[v].nbytes for v in data
+                                                         if v not in extracted_vars))
+            for v in data:
+                source.setdefault(v, l)
+    except Exception as e:
+        return r, data, time, source, repr(e)
+    if time and all(len(time[l]) == 0 for l in time):
+        return r, data, time, source, "no samples in the time window [" + \
+            str(args.tmin) + ", " + str(args.tmax) + "]"
+    return r, data, time, source, None
+
+
+def process_data(args, figs, rdata, time, source):
+    """ Preps data for generating plots, including evaluating simple math """
+    from . import simple_math as sm
+    import numpy as np
+    # Scale variables for single length: TODO: Maybe not all variables?
+    length = {}
+    for r in args.runs:
+        with span('variable_meld', run=r) as info:
+            rdata[r], length[r] = variable_meld(args, rdata[r], time[r], source[r])
+            info['samples'] = length[r]
+    with span('stack_runs', runs=len(args.runs)):
+        batch = stack_runs(args, rdata, length)
+
+    fout = [figure_info(args, f) for f in figs]
+    # Expressions of all figures, sharing the evaluation of common subexpressions. Scopes are kept
+    # for each time window, so shared values are found once per run, or batch of runs
+    program = sm.Program([d['exp'] for fig in fout for d in [fig['x']] + fig['y']])
+    scopes = {}
+    for f, fig in zip(figs, fout):
+
+        # Process data
+        window = tuple(f['trange']) if 'trange' in f else None
+        if window not in scopes:
+            fbatch, fdata, flength = batch, rdata, length
+            if window:
+                fbatch, fdata, flength = time_window(args, f['trange'], batch, rdata)
+            if fbatch:
+                scopes[window] = True, program.scope(fbatch, ndim=2), flength
             else:
-                print("\nOnly csv and hdf5 is supported, not: " + l)
-                pp.end_script(-1)
+                scopes[window] = False, dict((r, program.scope(fdata[r])) for r in args.runs), \
+                    flength
+        batched, scope, flength = scopes[window]
+        for d in [fig['x']] + fig['y']:
+            with span('evaluate', figure=str(fig['figure']), expression=str(d['exp']),
+                      runs=len(args.runs), batched=batched) as info:
+                if batched:
+                    # Evaluate the expression for all runs at once
+                    value, data_sets = program.evaluate(
+                        d['exp'], scope, flength[args.runs[0]], len(args.runs))
+                    for i, r in enumerate(args.runs):
+                        d['data'][r] = value[..., i, :]
+                else:
+                    for r in args.runs:
+                        d['data'][r], data_sets = program.evaluate(d['exp'], scope[r], flength[r])
+                info['samples'] = int(sum(np.size(d['data'][r]) for r in args.runs))
 
     if args.verbose:
-        print("\nTiming: extract_data at " + str(timer() - args.time))
-        args.time = timer()
+        print("\nInfo: Expression cache: " + str(sm.cache_info()))
+        print("Info: Subexpressions shared by figures: " + str(len(program.shared)))
 
-    return data, time
+    return fout
 
 
-def process_data(args, figs, rdata, time):
-    """ Preps data for generating plots, including evaluating simple math """
+def figure_info(args, f):
+    """ Constructs the dictionary of expressions, labels and options of a figure, to which the data
+        of each expression are added """
+    # Start constructing the massive, all inclusive fout
+    # list of dictionaries of data and stuff for each figure
+    fig = {}
+    fig['x'] = {'exp': f['x'], 'data': {}}
+    fig['y'] = []
+    if type(f['y']) == type([]):
+        for y in f['y']:
+            fig['y'].append({'exp': y, 'data': {}})
+    else:
+        fig['y'].append({'exp': f['y'], 'data': {}})
+
+    if not f['figure']:
+        fig['figure'] = f['y'][-1] if type(f['y']) == type([]) else f['y']
+    else:
+        fig['figure'] = f['figure']
+    if 'xlabel' in f:
+        fig['xlabel'] = f['xlabel']
+    else:
+        fig['xlabel'] = f['x']
+    if 'ylabel' in f:
+        fig['ylabel'] = f['ylabel']
+    else:
+        fig['ylabel'] = f['y'][-1] if type(f['y']) == type([]) else f['y']
+    if 'xrange' in f:
+        fig['xrange'] = f['xrange']
+    if 'yrange' in f:
+        fig['yrange'] = f['yrange']
+    if 'type' in f:
+        fig['type'] = f['type']
+    else:
+        fig['type'] = 'default'
+    if 'legend' in f:
+        fig['legend'] = f['legend']
+        args.legend = True
+    if 'trange' in f:
+        fig['trange'] = f['trange']
+    # Envelope options: band width in standard deviations, percentiles and runs to highlight
+    for option in ['sigma', 'percentiles', 'highlight']:
+        if option in f:
+            fig[option] = f[option]
+    # Add new features here
+    return fig
+
+
+def stream_data(args, figs, pvars, loglist, vlog=None):
+    """ Extracts and processes data a chunk of samples at a time, so memory is bounded by the chunk
+        size rather than the length of the logs. Lines are decimated as they are read, and
+        reductions such as mean() are accumulated over the chunks """
     from . import simple_math as sm
-    fout = []
-    for f in figs:
-
-        # Start constructing the massive, all inclusive fout
-        # list of dictionaries of data and stuff for each figure
-        fig = {}
-        fig['x'] = {'exp': f['x'], 'data': {}}
-        fig['y'] = []
-        if type(f['y']) == type([]):
-            for y in f['y']:
-                fig['y'].append({'exp': y, 'data': {}})
-        else:
-            fig['y'].append({'exp': f['y'], 'data': {}})
+    from . import stream
+    fout = [figure_info(args, f) for f in figs]
+    if not all(sm.streamable(sm.compile(d['exp'])) for fig in fout for d in [fig['x']] + fig['y']):
+        print("\nWarning: Expressions with nested reductions or functions of time can't be streamed, "
+              "reading logs whole")
+        rdata, time, source = extract_data(args, pvars, loglist, vlog)
+        return process_data(args, figs, rdata, time, source)
+    lvars = log_variables(loglist, pvars, vlog)
+    points = args.max_points or STREAM_POINTS
+
+    runs = []
+    for r in args.runs:
+        reducers = [stream.FigureReducer(fig, points) for fig in fout]
+        data = {}
+        with span('stream_run', run=r):
+            try:
+                for data in stream.iter_run_chunks(args, r, loglist, lvars, args.chunk_size):
+                    if data is None:
+                        break
+                    for reducer in reducers:
+                        reducer.add(data)
+                if data is None:
+                    # Logs at different rates are resampled onto one time base, so read them whole
+                    reducers = [stream.FigureReducer(fig, points) for fig in fout]
+                    r, data, time, source, error = extract_run((args, lvars, loglist, r))
+                    if error:
+                        raise RuntimeError(error)
+                    data, length = variable_meld(args, data, time, source)
+                    for reducer in reducers:
+                        reducer.add(data)
+            except Exception as e:
+                print("\nError: Could not extract " + r + ": " + repr(e))
+                continue
+        if all(reducer.rows is None for reducer in reducers):
+            print("\nError: Could not extract " + r + ": no samples in the time window [" +
+                  str(args.tmin) + ", " + str(args.tmax) + "]")
+            continue
+        for fig, reducer in zip(fout, reducers):
+            x, ys = reducer.result()
+            fig['x']['data'][r] = x
+            for y, value in zip(fig['y'], ys):
+                y['data'][r] = value
+        runs.append(r)
+    if not runs:
+        print("\nError: No runs could be extracted")
+        pp.end_script(-1)
+    args.runs = runs
 
-        if not f['figure']:
-            fig['figure'] = f['y'][-1] if type(f['y']) == type([]) else f['y']
-        else:
-            fig['figure'] = f['figure']
-        if 'xlabel' in f:
-            fig['xlabel'] = f['xlabel']
-        else:
-            fig['xlabel'] = f['x']
-        if 'ylabel' in f:
-            fig['ylabel'] = f['ylabel']
-        else:
-            fig['ylabel'] = f['y'][-1] if type(f['y']) == type([]) else f['y']
-        if 'xrange' in f:
-            fig['xrange'] = f['xrange']
-        if 'yrange' in f:
-            fig['yrange'] = f['yrange']
-        if 'type' in f:
-            fig['type'] = f['type']
-        else:
-            fig['type'] = 'default'
-        if 'legend' in f:
-            fig['legend'] = f['legend']
-            args.legend = True
-        # Add new features here
+    return fout
 
-        # Process data
-        for r in args.runs:
-            # Scale variables for single length: TODO: Maybe not all variables?
-            rdata[r], length = variable_meld(args, rdata[r], time[r])
-            # Evaluate all figure expressions
-            fig['x']['data'][r], data_sets = sm.evaluate(
-                fig['x']['exp'], rdata[r], length)
-            for y in fig['y']:
-                y['data'][r], data_sets = sm.evaluate(
-                    y['exp'], rdata[r], length)
-                # TODO: need vector expression support here
-
-        # Append figure to fout
-        fout.append(fig)
 
-    if args.verbose:
-        print("\nTiming: process_data at " + str(timer() - args.time))
-        args.time = timer()
+def follow_run(args, figs, pvars, loglist, vlog=None):
+    """ Plots a run while the sim is logging it, reading and evaluating only the samples logged
+        since the last poll, until the figures are closed """
+    from . import simple_math as sm
+    from . import follow
+    from .plot import set_style
+    if len(args.runs) != 1 or args.output:
+        print("\nError: --follow shows a single run, not " + str(len(args.runs)) +
+              (", and can't write figures to files" if args.output else ""))
+        pp.end_script(-1)
+    fout = [figure_info(args, f) for f in figs]
+    if not all(sm.streamable(sm.compile(d['exp'])) for fig in fout for d in [fig['x']] + fig['y']):
+        print("\nError: Expressions with nested reductions or functions of time can't be followed")
+        pp.end_script(-1)
+    set_style(args)
+    follow.follow(args, fout, loglist, log_variables(loglist, pvars, vlog),
+                  args.max_points or STREAM_POINTS)
+
+
+def stream_runs(args, figs, pvars, loglist, vlog=None):
+    """ Extracts and processes runs one at a time, so memory doesn't grow with the number of runs.
+        Each run is folded into the statistics of envelope figures and of expressions that reduce
+        to a single value, and only decimated lines are kept of other figures. Parallel jobs fold
+        separate runs, and their statistics are merged """
+    fout = [figure_info(args, f) for f in figs]
+    for fig in fout:
+        if 'highlight' in fig:
+            fig['highlight'] = [args.runs[h] if isinstance(h, int) else h for h in fig['highlight']]
+    lvars = log_variables(loglist, pvars, vlog)
+    points = args.max_points or STREAM_POINTS
+
+    # The first run extracted sets the x that the envelopes of the rest are interpolated onto, so
+    # runs are folded one at a time until one is, before the rest are shared out between jobs
+    errors = []
+    for n, r in enumerate(args.runs):
+        fold = fold_runs((args, fout, lvars, loglist, [r], {}, points))
+        errors.extend(fold['errors'])
+        if fold['runs']:
+            break
+    fold['errors'] = errors
+    runs = args.runs[n + 1:]
+    jobs = [(args, fout, lvars, loglist, runs[i::args.jobs], fold['x'], points)
+            for i in range(min(args.jobs, len(runs)))]
+    if len(jobs) > 1:
+        if any(l.endswith('.csv') for l in loglist):
+            from multiprocessing import Pool
+        else:
+            from multiprocessing.pool import ThreadPool as Pool
+        pool = Pool(len(jobs))
+        try:
+            folds = pool.map(trace.Traced(fold_runs), jobs, chunksize=1)
+            folds = [trace.tracer.merge(f) for f in folds]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        folds = [fold_runs(job) for job in jobs]
+    for other in folds:
+        merge_folds(fold, other)
+
+    for r, error in fold['errors']:
+        print("\nError: Could not extract " + r + ": " + error)
+    args.runs = [r for r in args.runs if r in fold['runs']]
+    if not args.runs:
+        print("\nError: No runs could be extracted")
+        pp.end_script(-1)
+
+    for i, fig in enumerate(fout):
+        for j, d in enumerate([fig['x']] + fig['y']):
+            d['data'] = fold['data'].get((i, j), {})
+            if (i, j) in fold['stats']:
+                stats = fold['stats'][i, j].result()
+                if len(stats['mean']) == 1:
+                    # Statistics of a single value, rather than an envelope over x
+                    print("\nInfo: " + d['exp'] + " over " + str(stats['runs']) + " runs:")
+                    for k in ['mean', 'std', 'min', 'max']:
+                        print("  " + k + ": " + str(stats[k][0]))
+                    for p in sorted(stats['percentiles']):
+                        print("  p{:g}: ".format(p) + str(stats['percentiles'][p][0]))
+                else:
+                    stats['x'] = fold['x'][i]
+                    d['envelope'] = stats
 
     return fout
 
 
-def variable_meld(args, data, time):
-    """ Makes all variables the same length pseudo-intelligently """
+def fold_runs(job):
+    """ Folds a set of runs into the statistics of each figure, one run at a time """
+    from . import simple_math as sm
+    from . import decimate as dm
+    from . import envelope as ev
     import numpy as np
+    args, fout, lvars, loglist, runs, bases, points = job
+    fold = {'x': dict(bases), 'stats': {}, 'data': {}, 'runs': [], 'errors': []}
+    program = sm.Program([d['exp'] for fig in fout for d in [fig['x']] + fig['y']])
+    for r in runs:
+        r, data, time, source, error = extract_run((args, lvars, loglist, r))
+        if error:
+            fold['errors'].append((r, error))
+            continue
+        data, length = variable_meld(args, data, time, source)
+        with span('fold_run', run=r, samples=length):
+            scopes = {}
+            for i, fig in enumerate(fout):
+                trange = tuple(fig['trange']) if 'trange' in fig else None
+                if trange not in scopes:
+                    fdata, flength = data, length
+                    if trange:
+                        window = pp.time_slice(data['sys.exec.out.time'], trange[0], trange[-1])
+                        fdata = dict((v, data[v][..., window]) for v in data)
+                        flength = window.stop - window.start
+                    scopes[trange] = program.scope(fdata), flength
+                scope, flength = scopes[trange]
+                values = [program.evaluate(d['exp'], scope, flength)[0]
+                          for d in [fig['x']] + fig['y']]
+                envelope = fig['type'] == 'envelope'
+                if envelope:
+                    fold['x'].setdefault(i, np.asarray(values[0], dtype=float))
+                for j, value in enumerate(values):
+                    scalar = np.shape(value)[-1] == 1
+                    if j > 0 and (envelope or scalar):
+                        if (i, j) not in fold['stats']:
+                            fold['stats'][i, j] = ev.EnvelopeAccumulator(
+                                fig.get('sigma', ev.SIGMA), fig.get('percentiles', ev.PERCENTILES))
+                        fold['stats'][i, j].add(ev.align(values[0], value, fold['x'][i])
+                                                if envelope and not scalar else value)
+                if envelope and r not in fig.get('highlight', []):
+                    continue
+                # Keep the lines of the run, decimated to where any of them peak
+                x = np.asarray(values[0])
+                keep = slice(None)
+                if 0 < points < len(x) and all(np.shape(v)[-1] == len(x) for v in values[1:]):
+                    rows = [np.reshape(v, (-1, len(x))) for v in values[1:]] or [x[np.newaxis]]
+                    keep = np.unique(np.concatenate([dm.minmax_indices(row, points)
+                                                     for v in rows for row in v]))
+                for j, value in enumerate(values):
+                    value = np.asarray(value)
+                    fold['data'].setdefault((i, j), {})[r] = \
+                        value[..., keep] if np.shape(value)[-1] == len(x) else value
+        fold['runs'].append(r)
+    return fold
+
+
+def merge_folds(fold, other):
+    """ Merges the statistics and lines of another set of runs into a fold """
+    for key in other['stats']:
+        if key in fold['stats']:
+            fold['stats'][key].merge(other['stats'][key])
+        else:
+            fold['stats'][key] = other['stats'][key]
+    for key in other['data']:
+        fold['data'].setdefault(key, {}).update(other['data'][key])
+    fold['runs'].extend(other['runs'])
+    fold['errors'].extend(other['errors'])
+
+
+def time_window(args, trange, batch, rdata):
+    """ Restricts the data of each run, and the batch if there is one, to a figure's time range.
+        The data are sliced rather than copied """
+    windows = {}
+    data = {}
+    length = {}
+    for r in args.runs:
+        windows[r] = pp.time_slice(rdata[r]['sys.exec.out.time'], trange[0], trange[-1])
+        data[r] = dict((v, rdata[r][v][..., windows[r]]) for v in rdata[r])
+        length[r] = windows[r].stop - windows[r].start
+    # The batch can only be sliced if every run has the same window
+    if batch and len(set((w.start, w.stop) for w in windows.values())) == 1:
+        window = windows[args.runs[0]]
+        batch = dict((v, batch[v][..., window]) for v in batch)
+    else:
+        batch = None
+    return batch, data, length
+
+
+def stack_runs(args, rdata, length):
+    """ Stacks each variable of equal-length runs into a single (runs x samples) array, so
+        expressions can be evaluated for all runs at once. Returns None if runs can't be stacked """
+    import numpy as np
+    runs = args.runs
+    if len(runs) < 2 or len(set(length[r] for r in runs)) > 1:
+        return None
+    names = set(rdata[runs[0]])
+    if any(set(rdata[r]) != names for r in runs):
+        return None
+    if any(len(set(np.shape(rdata[r][v]) for r in runs)) > 1 for v in names):
+        return None
+    batch = {}
+    for v in names:
+        batch[v] = np.stack([rdata[r][v] for r in runs])
+        # Share memory with the stack rather than holding two copies
+        for i, r in enumerate(runs):
+            rdata[r][v] = batch[v][i]
+    if args.verbose:
+        print("\nInfo: Evaluating " + str(len(runs)) + " runs as a batch")
+    return batch
+
+
+def variable_meld(args, data, time, source):
+    """ Resamples all variables onto a common time base, using the time vector of the log each
+        variable was extracted from """
+    from . import resample as rs
     # Checks
     if not list(time.keys()):  # Nothing logged...
         return data, 1
-    n = len(time[list(time.keys())[0]])
-    # Check if everything is already the same length
-    if all(len(time[t]) == n for t in time):
-        return data, n
-    else:  # We get to have fun!
-        # Find the maximum, we never want to lose fidelity
-        n = max(len(time[t]) for t in time)
-        # Meld data
-        for v in data:
-            m = len(data[v])
-            if m <= 1:
-                print("Error: Could not meld variable because there is no data")
-                pp.end_script(-1)
-            if n == m:  # same length?
-                continue  # next variable
-            else:  # meld this variable to the new, correct length
-                mlt = old_div((n - 1), (m - 1))
-                mod = (n - 1) % (m - 1) + 1
-                # Handle multiple of new length
-                if mlt > 1:  # interpolate
-                    y = []
-                    x = list(range(mlt))
-                    xp = [0, mlt - 1]
-                    for i in range(1, m):
-                        y.extend(
-                            np.interp(x, xp, [data[v][i - 1], data[v][i]]))
-                    data[v] = y
-                elif mlt > 0:
-                    print("\nError: Didnt find the max... " + str(m) + " > " + str(n) + " ?")
-                    pp.end_script(-1)
-                elif mlt <= 0:
-                    print("\nError: Cannot meld variable: " + v)
-                    print("Meld conditions:\nn = " + str(n) + "\nm = " + str(m))
-                    print("mlt = " + str(mlt))
-                    print("mod = " + str(mod))
-                    pp.end_script(-1)
-                else:
-                    pass  # mlt == 1, so that isnt the issue here
-                # Handle modulus of new length
-                if mod > 0:
-                    # Putting these extra steps almost at the end...
-                    # this makes the variable step get geometrically
-                    # smaller between the second to last step and the last step
-                    x = 0.5
-                    xp = list(range(2))
-                    last_index = len(data[v]) - 1
-                    index = list(range(last_index, last_index + mod))
-                    for i in index:
-                        data[v].insert(i, np.interp(
-                            x, xp, [data[v][i - 1], data[v][i]]))
-                elif mod < 0:
-                    print("\nError: Cannot meld variable: " + v)
-                    pp.end_script(-1)
-                else:
-                    pass  # do nothing!
-                # Check
-                if len(data[v]) != n:
-                    print("\nError: Melding did not work! " + str(len(data[v])) + " != " + str(n))
-                    print("Meld conditions:\nn = " + str(n) + "\nm = " + str(m))
-                    print("mlt = " + str(mlt))
-                    print("mod = " + str(mod))
-                    pp.end_script(-1)
-    return data, n
+    base = rs.time_base([time[l] for l in sorted(time)], args.grid, args.dt)
+    for v in data:
+        if v == 'sys.exec.out.time':
+            continue
+        t = time[source[v]]
+        if len(data[v]) != len(t) or len(t) == 0:
+            print("\nError: Cannot meld variable: " + v)
+            print("Meld conditions:\nsamples = " + str(len(data[v])) + "\ntimes = " + str(len(t)))
+            pp.end_script(-1)
+        data[v] = rs.resample(t, data[v], base, args.resample)
+    data['sys.exec.out.time'] = base
+    return data, len(base)
 
 
 def complete_variable(prefix, parsed_args, **kwargs):
-    logs, lvars = get_logged_vars(parsed_args)
+    """ Completes variable names from the log index of the first run. This runs on every tab
+        press, so it only reads the index and never imports the plotting or data libraries """
+    if not parsed_args.sim or not parsed_args.runs:
+        return []
+    runs = pp.check_monte(parsed_args.sim, parsed_args.runs)
+    logs = logindex.get_index(os.path.join(parsed_args.sim, runs[0]), samples=False).logs()
+    if parsed_args.log:  # Only variables in specific log files
+        logs = dict((l, logs[l]) for l in parsed_args.log if l in logs)
     last = prefix.split(" ")[-1]
-    return [var for var in lvars if var.startswith(last)]
+    return sorted(set(var for l in logs for var in logs[l] if var.startswith(last)))
+
+
+def profile_startup(args):
+    """ Reports how long starting up takes, and how long each of the libraries muse defers
+        importing until it needs them would take to import """
+    import importlib
+    print("Startup profile:")
+    print("  {:<24}{:8.1f} ms".format("import muse.cli", 1000 * (args.start - START)))
+    print("  {:<24}{:8.1f} ms".format("parse arguments", 1000 * (args.time - args.start)))
+    if args.sim and args.runs:
+        start = timer()
+        runs = pp.check_monte(args.sim, args.runs)
+        logindex.get_index(os.path.join(args.sim, runs[0]), samples=False).variables()
+        print("  {:<24}{:8.1f} ms".format("load log index", 1000 * (timer() - start)))
+    print("Deferred imports:")
+    for module in ['numpy', 'yaml', 'pandas', 'h5py', 'matplotlib.pyplot', 'seaborn']:
+        start = timer()
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            print("  {:<24}{:>8}".format(module, "missing"))
+            continue
+        print("  {:<24}{:8.1f} ms".format(module, 1000 * (timer() - start)))
+
+
+def ingest(argv):
+    """ Converts csv logs to columnar stores, so plotting them later reads only the columns needed,
+        with no parsing """
+    args = parse_ingest_args(argv)
+    pp.check_csv_engine(args.csv_engine)
+    logs = colstore.find_logs(args.paths)
+    if not logs:
+        print("\nError: No csv logs found in: " + ' '.join(args.paths))
+        pp.end_script(-1)
+    jobs = [(lfile, args.csv_engine, args.force) for lfile in logs]
+    if args.jobs > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(args.jobs, len(jobs)))
+        try:
+            results = pool.map(ingest_log, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [ingest_log(job) for job in jobs]
+
+    status = 0
+    for lfile, seconds, error in results:
+        if error:
+            print("Error: Could not ingest " + lfile + ": " + error)
+            status = 1
+        elif seconds is None:
+            print("Info: Up to date: " + lfile)
+        else:
+            print("Info: Ingested {} in {:.3f} s".format(lfile, seconds))
+    return status
+
+
+def ingest_log(job):
+    """ Converts a single csv log, returning the time it took, or None if it was up to date """
+    lfile, engine, force = job
+    start = timer()
+    try:
+        if not colstore.ingest(lfile, engine, force):
+            return lfile, None, None
+    except Exception as e:
+        return lfile, None, repr(e)
+    return lfile, timer() - start, None
+
+
+def parse_ingest_args(argv):
+    """ Parses the arguments of the ingest subcommand """
+    parser = ap.ArgumentParser(prog="muse ingest",
+                               description="muse ingest: convert csv logs to columnar stores that plotting reads instead",
+                               formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('paths', help="RUN/MONTE directory(ies) or csv log file(s) to convert",
+                        nargs='+', type=str)
+    parser.add_argument('--csv-engine', help="Parser engine used to read csv logs",
+                        choices=['c', 'python', 'pyarrow'], default='c')
+    parser.add_argument('-j', '--jobs', type=int, help="Number of logs to convert in parallel",
+                        default=1)
+    parser.add_argument('--force', help="Convert logs even if their stores are up to date",
+                        default=False, action='store_true')
+    return parser.parse_args(argv)
 
 
 def parse_user_args():
@@ -485,12 +904,48 @@ def parse_user_args():
                         nargs='+', type=str,  default=[])
     parser.add_argument('--legend', help="Adds a legend to the plot",
                         default=False, action='store_true')
+    parser.add_argument('--max-points', type=int, help="Most points drawn per line, keeping the minima and maxima of the samples left out; 0 draws every sample. By default, twice the width of the axes in pixels",
+                        default=None)
+    parser.add_argument('-o', '--output', type=str, help="Write the figures to files in this directory instead of showing them",
+                        default=None)
+    parser.add_argument('--format', help="File format of figures written with --output",
+                        choices=['png', 'pdf', 'svg'], default='png')
     parser.add_argument('--style', help="Sets the style for the plots",
                         default='classic')
     parser.add_argument('-s', '--sim', type=str, help="Location of RUN/MONTE directory(ies) of interest",
                         default=None)
     parser.add_argument('-p', '--ploc', type=str,  help="Location of yaml plot file(s) of interest",
                         default=None)
+    parser.add_argument('--tmin', type=float, help="Start of the time window to read from the logs",
+                        default=None)
+    parser.add_argument('--tmax', type=float, help="End of the time window to read from the logs",
+                        default=None)
+    parser.add_argument('--resample', help="Method to resample variables logged at different rates onto a common time base",
+                        choices=rs.METHODS, default='linear')
+    parser.add_argument('--grid', help="Common time base: the time of the log with the finest or coarsest time step",
+                        choices=rs.GRIDS, default='finest')
+    parser.add_argument('--dt', type=float, help="Use a uniform common time base with this time step instead",
+                        default=None)
+    parser.add_argument('--csv-engine', help="Parser engine used to read csv logs",
+                        choices=['c', 'python', 'pyarrow'], default='c')
+    parser.add_argument('--ingest', help="Convert csv logs to columnar stores as they are first read, so later plots of them don't parse csv",
+                        default=False, action='store_true')
+    parser.add_argument('--stream-runs', help="Read Monte Carlo runs one at a time, folding them into running statistics, so memory doesn't grow with the number of runs. Only envelopes, statistics and decimated lines are kept",
+                        default=False, action='store_true')
+    parser.add_argument('--chunk-size', type=int, help="Read and process logs this many samples at a time, so logs larger than memory can be plotted. Lines are decimated as they are read",
+                        default=None)
+    parser.add_argument('--follow', help="Follow a run while the sim is logging it, plotting samples as they are logged",
+                        default=False, action='store_true')
+    parser.add_argument('--frame-rate', type=float, help="Most times a second figures are redrawn when following a run",
+                        default=None)
+    parser.add_argument('-j', '--jobs', type=int, help="Number of runs to extract, and of figures to render, in parallel",
+                        default=1)
+    parser.add_argument('--trace', type=str, help="Write a trace of the time taken by each stage, run, log, expression and figure to this file, in Chrome's trace-event format",
+                        default=None)
+    parser.add_argument('--profile', type=str, help="Profile with cProfile and write the statistics to this file",
+                        default=None)
+    parser.add_argument('--profile-startup', help="Report how long starting up and importing libraries takes, then exit",
+                        default=False, action='store_true')
     parser.add_argument('--verbose', help="Verbose command-line output for diagnostics",
                         default=False, action='store_true')
 
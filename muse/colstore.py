@@ -0,0 +1,113 @@
+"""
+Columnar store of csv logs: each column of a log is converted once to its own .npy file, so later
+reads load only the columns asked for, memory-mapped, with no parsing. A store is kept next to its
+log (or in the user's cache directory, if the run directory isn't writable) and is used only while
+the log's modification time and size match the ones it was made from.
+"""
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import shutil
+
+from . import pputils as pp
+
+STORE_EXT = '.cols'
+MANIFEST_FILENAME = 'manifest.json'
+STORE_VERSION = 1
+
+
+def store_dir(lfile):
+    """ Where the store of a log is kept """
+    lfile = os.path.abspath(lfile)
+    if os.access(os.path.dirname(lfile), os.W_OK):
+        return lfile + STORE_EXT
+    key = hashlib.sha1(lfile.encode('utf-8')).hexdigest()
+    return os.path.join(pp.cache_dir('columns'), key + STORE_EXT)
+
+
+def load_manifest(lfile):
+    """ The manifest of a log's store, or None if there is no store or the log changed since """
+    try:
+        with open(os.path.join(store_dir(lfile), MANIFEST_FILENAME)) as fh:
+            manifest = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('version') != STORE_VERSION or manifest.get('stamp') != pp.file_stamp(lfile):
+        return None
+    return manifest
+
+
+def is_current(lfile):
+    return load_manifest(lfile) is not None
+
+
+def ensure(lfile, engine='c'):
+    """ Makes the store of a log if it isn't current. The store is only a cache, so failing to
+        write it isn't an error """
+    try:
+        ingest(lfile, engine)
+    except (IOError, OSError):
+        pass
+
+
+def ingest(lfile, engine='c', force=False):
+    """ Converts a csv log to a store with one .npy file per column. Returns whether it did, which
+        it doesn't if the store is already current """
+    import numpy as np
+    if not force and is_current(lfile):
+        return False
+    stamp = pp.file_stamp(lfile)
+    header = pp.get_csv_header(lfile)
+    raw = pp.read_csv_columns(lfile, list(range(len(header))), engine)
+    sdir = store_dir(lfile)
+    tmp_dir = sdir + '.' + str(os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    files = []
+    for i in range(len(header)):
+        files.append('c{:05d}.npy'.format(i))
+        np.save(os.path.join(tmp_dir, files[-1]), raw[i])
+    with open(os.path.join(tmp_dir, MANIFEST_FILENAME), 'w') as fh:
+        json.dump({'version': STORE_VERSION, 'stamp': stamp, 'columns': header,
+                   'files': files}, fh)
+    # Swap the new store in whole, so readers never see half of one
+    if os.path.isdir(sdir):
+        shutil.rmtree(sdir)
+    os.rename(tmp_dir, sdir)
+    return True
+
+
+def read_columns(lfile, columns, tmin=None, tmax=None):
+    """ Reads the columns at the given positions from a log's store, as memory-mapped arrays keyed
+        by position, restricted to a time window if one is given. Returns None if the log has no
+        current store """
+    import numpy as np
+    manifest = load_manifest(lfile)
+    if manifest is None:
+        return None
+    sdir = store_dir(lfile)
+    window = slice(None)
+    if tmin is not None or tmax is not None:
+        time = np.load(os.path.join(sdir, manifest['files'][0]), mmap_mode='r')
+        window = pp.time_slice(time, tmin, tmax)
+    data = {}
+    for c in sorted(set(columns)):
+        data[c] = np.load(os.path.join(sdir, manifest['files'][c]), mmap_mode='r')[window]
+    return data
+
+
+def find_logs(paths):
+    """ Finds the csv logs in run directories, Monte Carlo directories or given directly """
+    logs = []
+    for path in paths:
+        if os.path.isfile(path):
+            logs.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            logs.extend(os.path.join(root, f) for f in sorted(files)
+                        if f.startswith('log_') and f.endswith('.csv'))
+    return logs
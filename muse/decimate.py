@@ -0,0 +1,52 @@
+"""
+Decimation of long lines for plotting, keeping the peaks and transients a full-resolution plot
+would show
+"""
+from __future__ import division
+
+
+def minmax_indices(y, points):
+    """ Indices of the samples kept when decimating y to about `points` points: the first and
+        last samples, and the minimum and maximum of each of points / 2 equal-size buckets """
+    import numpy as np
+    n = len(y)
+    width = int(np.ceil(n / max(points // 2, 1)))
+    full = n // width  # Buckets with all of their samples
+    pieces = [[0]]
+    if full:
+        buckets = y[:full * width].reshape(full, width)
+        imin = np.argmin(buckets, axis=1)
+        imax = np.argmax(buckets, axis=1)
+        offsets = np.arange(full) * width
+        # Keep each bucket's pair in sample order
+        pair = np.empty((full, 2), dtype=np.intp)
+        pair[:, 0] = np.minimum(imin, imax) + offsets
+        pair[:, 1] = np.maximum(imin, imax) + offsets
+        pieces.append(pair.ravel())
+    if full * width < n:
+        tail = y[full * width:]
+        pieces.append(np.sort([np.argmin(tail), np.argmax(tail)]) + full * width)
+    pieces.append([n - 1])
+    return np.unique(np.concatenate(pieces))
+
+
+def minmax(x, y, points):
+    """ Decimates a line to about `points` points, preserving the minimum and maximum of y over
+        each small span of samples. Lines that are already short enough are returned as is """
+    import numpy as np
+    y = np.asarray(y)
+    if points <= 0 or len(y) <= points or np.ndim(y) != 1 or np.shape(x) != y.shape:
+        return x, y
+    indices = minmax_indices(y, points)
+    return np.asarray(x)[indices], y[indices]
+
+
+def window(x, start, stop):
+    """ Slice of the samples of a monotonic x within [start, stop], plus one more on either side
+        so the line runs off the edges of the plot """
+    import numpy as np
+    if start > stop:
+        start, stop = stop, start
+    i = max(np.searchsorted(x, start, side='left') - 1, 0)
+    j = min(np.searchsorted(x, stop, side='right') + 1, len(x))
+    return slice(i, j)
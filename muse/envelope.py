@@ -0,0 +1,158 @@
+"""
+Statistics across the runs of a Monte Carlo at each time step, drawn as the envelope of the runs
+rather than a line per run
+
+Runs can also be folded in one at a time, so the statistics of many runs are found without holding
+them all in memory at once.
+"""
+from __future__ import division
+from builtins import object
+
+from .stream import RunningStats
+
+# Standard deviations either side of the mean of the inner band
+SIGMA = 3
+# Percentiles drawn as lines within the bands
+PERCENTILES = [1, 50, 99]
+# Items per level of a quantile sketch; percentiles are exact up to this many runs
+SKETCH_SIZE = 256
+
+
+def stack_runs(x, y, runs):
+    """ Stacks the y of each run along a new first axis, on the x of the first run. Runs with a
+        different x are interpolated onto it """
+    import numpy as np
+    base = np.asarray(x[runs[0]], dtype=float)
+    return base, np.stack([align(x[r], y[r], base) for r in runs])
+
+
+def align(x, y, base):
+    """ Interpolates y, at samples x along its last axis, onto the base x """
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.shape == base.shape and np.array_equal(x, base):
+        return y
+    values = np.array([np.interp(base, x, c) for c in y.reshape(-1, len(x))])
+    return values.reshape(y.shape[:-1] + base.shape)
+
+
+def envelope_stats(values, sigma=SIGMA, percentiles=PERCENTILES):
+    """ Mean, mean -/+ sigma standard deviations, percentiles, minimum and maximum across runs, of
+        values with runs along the first axis. The minimum, maximum and percentiles come from a
+        single partition of the run axis """
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    mean = values.mean(axis=0)
+    std = values.std(axis=0)
+    q = np.percentile(values, [0] + list(percentiles) + [100], axis=0)
+    return {'runs': len(values), 'mean': mean, 'std': std, 'sigma': sigma,
+            'lower': mean - sigma * std, 'upper': mean + sigma * std,
+            'min': q[0], 'max': q[-1], 'percentiles': dict(zip(percentiles, q[1:-1]))}
+
+
+class QuantileSketch(object):
+    """
+    Mergeable sketch of the distribution of values across runs, at many points at once, such as
+    each time step, in the style of the compactor sketches of Munro-Paterson and KLL. Level k holds
+    up to `size` items of weight 2 ** k. When a level fills, its items are sorted at each point
+    and every other one is promoted to the level above, so memory grows with the logarithm of the
+    number of runs.
+    """
+    def __init__(self, size=SKETCH_SIZE):
+        self.size = max(size, 2)
+        self.levels = []
+        self.count = 0
+        self.parity = 0  # Alternates which half of a compacted level is promoted
+
+    def add(self, value):
+        """ Adds the values of one run """
+        import numpy as np
+        self.count += 1
+        self.insert([[np.asarray(value, dtype=float)]])
+
+    def merge(self, other):
+        """ Merges another sketch into this one """
+        self.count += other.count
+        self.insert(other.levels)
+
+    def insert(self, levels):
+        import numpy as np
+        for level, items in enumerate(levels):
+            if len(self.levels) <= level:
+                self.levels.append([])
+            self.levels[level].extend(items)
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.size:
+                items = np.sort(np.stack(self.levels[level]), axis=0)
+                pairs = len(items) // 2
+                if len(self.levels) == level + 1:
+                    self.levels.append([])
+                self.levels[level + 1].extend(items[self.parity:2 * pairs:2])
+                self.levels[level] = list(items[2 * pairs:])
+                self.parity ^= 1
+            level += 1
+
+    def quantiles(self, percentiles):
+        """ Estimated percentiles at each point. With fewer runs than the size of a level, these
+            are exact, interpolated like numpy's percentile """
+        import numpy as np
+        items = []
+        weights = []
+        for level, level_items in enumerate(self.levels):
+            items.extend(level_items)
+            weights.extend([2 ** level] * len(level_items))
+        values = np.stack(items)
+        if len(values) == 1:
+            return [values[0]] * len(percentiles)
+        order = np.argsort(values, axis=0)
+        values = np.take_along_axis(values, order, axis=0)
+        weights = np.asarray(weights, dtype=float)[order]
+        # Rank at the middle of each item, which for unit weights is its index
+        cum = np.cumsum(weights, axis=0)
+        centers = cum - (weights + 1) / 2
+        results = []
+        for p in percentiles:
+            rank = (cum[-1] - 1) * p / 100
+            hi = np.clip(np.sum(centers <= rank, axis=0), 1, len(values) - 1)[np.newaxis]
+            c0 = np.take_along_axis(centers, hi - 1, axis=0)[0]
+            c1 = np.take_along_axis(centers, hi, axis=0)[0]
+            v0 = np.take_along_axis(values, hi - 1, axis=0)[0]
+            v1 = np.take_along_axis(values, hi, axis=0)[0]
+            frac = np.clip((rank - c0) / np.where(c1 > c0, c1 - c0, 1), 0, 1)
+            results.append(v0 + frac * (v1 - v0))
+        return results
+
+
+class EnvelopeAccumulator(object):
+    """
+    Statistics of an envelope, with runs folded in one at a time: the running mean and variance,
+    minimum and maximum, and a quantile sketch for the percentiles. Accumulators of separate sets
+    of runs, such as those of parallel workers, can be merged.
+    """
+    def __init__(self, sigma=SIGMA, percentiles=PERCENTILES, size=SKETCH_SIZE):
+        self.sigma = sigma
+        self.percentiles = list(percentiles)
+        self.stats = RunningStats()
+        self.sketch = QuantileSketch(size)
+
+    def add(self, value):
+        """ Adds the values of one run """
+        import numpy as np
+        value = np.asarray(value, dtype=float)
+        self.stats.add(value[np.newaxis], axis=0)
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+
+    def result(self):
+        """ The statistics, as given by envelope_stats """
+        mean = self.stats.mean
+        std = self.stats.std()
+        return {'runs': self.stats.count, 'mean': mean, 'std': std, 'sigma': self.sigma,
+                'lower': mean - self.sigma * std, 'upper': mean + self.sigma * std,
+                'min': self.stats.min, 'max': self.stats.max,
+                'percentiles': dict(zip(self.percentiles, self.sketch.quantiles(self.percentiles)))}
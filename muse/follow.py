@@ -0,0 +1,322 @@
+"""
+Live tail of a running sim: the logs of a run are polled, only the samples appended since the last
+read are read, the expressions of each figure are evaluated on just those samples and folded into
+decimated lines, and the lines are redrawn by blitting at a fixed frame rate.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+
+import os
+import time
+import struct
+
+from . import pputils as pp
+from . import resample as rs
+from .stream import FigureReducer, INDEX_VAR
+
+# Frames drawn per second, at most
+FRAME_RATE = 10
+# Fraction of the span of the data added to the limits of axes the lines outgrow
+HEADROOM = 0.5
+
+
+class LogTail(object):
+    """ Reads the samples appended to a log since the last read """
+    def __init__(self, lfile, names):
+        self.lfile = lfile
+        self.names = names
+        self.offset = 0  # Samples, or bytes, read so far
+        self.stat = None
+
+    def changed(self):
+        """ Whether the log was written since the last poll, by its size and modification time """
+        try:
+            st = os.stat(self.lfile)
+        except OSError:
+            return False
+        stat = (st.st_size, st.st_mtime)
+        if stat == self.stat:
+            return False
+        self.stat = stat
+        return True
+
+    def read(self):
+        """ The new samples of each variable, or None if there are none yet """
+        raise NotImplementedError
+
+
+class H5Tail(LogTail):
+    """ Tail of an HDF5 log, by the length of its datasets """
+    def read(self):
+        import h5py
+        try:
+            try:
+                raw = h5py.File(self.lfile, 'r', swmr=True)
+            except (TypeError, ValueError):
+                raw = h5py.File(self.lfile, 'r')
+        except (IOError, OSError):
+            return None  # Not yet created, or locked by the writer; try again at the next poll
+        with raw:
+            if INDEX_VAR not in raw:
+                return None
+            names = [INDEX_VAR] + [v for v in self.names if v in raw]
+            # Datasets are extended one at a time, so only read the samples all of them have
+            stop = min(raw[v].shape[0] for v in names)
+            if stop <= self.offset:
+                return None
+            data = dict((v, raw[v][self.offset:stop]) for v in names)
+        self.offset = stop
+        return data
+
+
+class TrkTail(LogTail):
+    """ Tail of a Trick binary log, by its number of complete records """
+    def read(self):
+        import numpy as np
+        try:
+            raw = pp.trk_memmap(self.lfile)
+        except (IOError, OSError, ValueError, struct.error):
+            return None  # Header not yet written
+        if len(raw) <= self.offset:
+            return None
+        names = [INDEX_VAR] + [v for v in self.names if v in raw.dtype.names]
+        data = dict((v, np.array(raw[v][self.offset:])) for v in names)
+        self.offset = len(raw)
+        return data
+
+
+class CsvTail(LogTail):
+    """ Tail of a csv log, by the byte offset of the end of its last complete row """
+    def __init__(self, lfile, names):
+        super(CsvTail, self).__init__(lfile, names)
+        self.columns = None
+
+    def read(self):
+        import io
+        import pandas as pd
+        import numpy as np
+        with open(self.lfile, 'rb') as fh:
+            if self.columns is None:
+                line = fh.readline()
+                if not line.endswith(b'\n'):
+                    self.stat = None  # Read the header again at the next poll
+                    return None
+                header = pp.get_csv_header(self.lfile)
+                self.columns = pp.csv_positions(header, [INDEX_VAR] + list(self.names))
+                self.offset = len(line)
+            fh.seek(self.offset)
+            text = fh.read()
+        # A row still being written is left for the next poll, which reads it whether or not the
+        # log has been written to since
+        end = text.rfind(b'\n') + 1
+        if end < len(text):
+            self.stat = None
+        if not text[:end].strip():
+            return None
+        usecols = sorted(set(self.columns.values()))
+        raw = pd.read_csv(io.BytesIO(text[:end]), header=None, usecols=usecols, dtype=np.float64)
+        self.offset += end
+        return dict((v, raw[self.columns[v]].values) for v in self.columns)
+
+
+def log_tail(lfile, names):
+    if lfile.endswith('.h5'):
+        return H5Tail(lfile, names)
+    elif lfile.endswith('.trk'):
+        return TrkTail(lfile, names)
+    return CsvTail(lfile, names)
+
+
+class RunTail(object):
+    """
+    Tails the logs of a run, melding their new samples onto the time of the log with the finest
+    time step. Samples of the base log are given once every other log has been logged up to
+    their time, so they can be resampled to it.
+    """
+    def __init__(self, args, r, loglist, lvars):
+        self.args = args
+        self.tails = [(l, log_tail(os.path.join(args.sim, r, l), lvars[l])) for l in loglist]
+        self.pending = dict((l, None) for l in loglist)  # Samples not yet given, of each log
+        self.base = None
+
+    def read(self):
+        """ The new samples of the variables of every log, on one time base, or None """
+        import numpy as np
+        for l, tail in self.tails:
+            if not tail.changed():
+                continue
+            new = tail.read()
+            if new is None:
+                continue
+            if self.pending[l] is None:
+                self.pending[l] = new
+            else:
+                self.pending[l] = dict((v, np.concatenate([self.pending[l][v], new[v]]))
+                                       for v in new)
+        if any(p is None for p in self.pending.values()):
+            return None
+        if self.base is None:
+            # The finest time step, once every log has enough samples to tell
+            if any(len(p[INDEX_VAR]) < 2 for p in self.pending.values()) and len(self.tails) > 1:
+                return None
+            self.base = min(self.pending, key=lambda l: rs.time_step(self.pending[l][INDEX_VAR]))
+        if any(len(p[INDEX_VAR]) == 0 for p in self.pending.values()):
+            return None
+        base = self.pending[self.base]
+        t = base[INDEX_VAR]
+        # Up to the time every log has reached
+        stop = min(p[INDEX_VAR][-1] for p in self.pending.values())
+        n = np.searchsorted(t, stop, side='right')
+        if n == 0:
+            return None
+        data = dict((v, base[v][:n]) for v in base)
+        for l in self.pending:
+            if l == self.base:
+                continue
+            p = self.pending[l]
+            for v in p:
+                if v != INDEX_VAR:
+                    data.setdefault(v, rs.resample(p[INDEX_VAR], p[v], data[INDEX_VAR],
+                                                   self.args.resample))
+            # Keep the last sample before the end, to resample the next samples against
+            keep = max(np.searchsorted(p[INDEX_VAR], data[INDEX_VAR][-1], side='right') - 1, 0)
+            self.pending[l] = dict((v, p[v][keep:]) for v in p)
+        self.pending[self.base] = dict((v, base[v][n:]) for v in base)
+        window = pp.time_slice(data[INDEX_VAR], self.args.tmin, self.args.tmax)
+        if window.stop <= window.start:
+            return None
+        return dict((v, data[v][window]) for v in data)
+
+
+class LiveFigure(object):
+    """
+    A figure whose lines grow as samples are added. The lines are animated artists drawn over a
+    saved background of the rest of the figure, which is only redrawn when the lines outgrow the
+    limits of the axes or the figure is resized.
+    """
+    def __init__(self, args, fig, i, points):
+        import matplotlib.pyplot as mp
+        self.fig = fig
+        self.reducer = FigureReducer(fig, points)
+        self.figure = mp.figure(i)
+        self.ax = mp.gca()
+        self.lines = []
+        for y in fig['y']:
+            label = y['legend'] if 'legend' in y else y['exp']
+            self.lines.append([self.ax.plot([], [], animated=True, label=label)[0]])
+        mp.title(fig['figure'])
+        mp.xlabel(fig['xlabel'])
+        mp.ylabel(fig['ylabel'])
+        if 'xrange' in fig:
+            mp.xlim(fig['xrange'][0], fig['xrange'][-1])
+        if 'yrange' in fig:
+            mp.ylim(fig['yrange'])
+        if args.legend:
+            mp.legend(loc='best')
+        self.background = None
+        self.limits = {'x': None, 'y': None}
+        self.dirty = False
+        self.figure.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def add(self, data):
+        self.reducer.add(data)
+        self.dirty = True
+
+    def on_draw(self, event):
+        """ Saves the background after a full redraw, and draws the lines over it """
+        self.background = self.figure.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        for lines in self.lines:
+            for line in lines:
+                self.ax.draw_artist(line)
+
+    def update(self):
+        """ Sets the data of the lines and blits them, redrawing the whole figure only if the
+            lines outgrow the axes """
+        import numpy as np
+        if not self.dirty:
+            return
+        self.dirty = False
+        x, ys = self.reducer.result()
+        if x is None:
+            return
+        x = np.asarray(x, dtype=float)
+        for j, (y, lines) in enumerate(zip(ys, self.lines)):
+            if y is None:
+                continue
+            y = np.asarray(y, dtype=float)
+            rows = y.reshape(-1, y.shape[-1])
+            if rows.shape[-1] == 1 and len(x) > 1:
+                # A reduction, drawn across the data
+                rows = np.repeat(rows, 2, axis=-1)
+                xs = x[[0, -1]]
+            else:
+                xs = x
+            while len(lines) < len(rows):
+                lines.append(self.ax.plot([], [], animated=True, color=lines[0].get_color())[0])
+            for line, row in zip(lines, rows):
+                line.set_data(xs, row)
+        canvas = self.figure.canvas
+        if self.rescale() or self.background is None:
+            canvas.draw()  # Saves the background and draws the lines, in on_draw
+        else:
+            canvas.restore_region(self.background)
+            self.draw_lines()
+        canvas.blit(self.ax.bbox)
+
+    def rescale(self):
+        """ Grows the limits of the axes, with headroom, to fit the lines. Returns whether they
+            changed """
+        import numpy as np
+        values = [(line.get_xdata(), line.get_ydata()) for lines in self.lines for line in lines
+                  if len(line.get_xdata())]
+        if not values:
+            return False
+        x = np.concatenate([v[0] for v in values])
+        y = np.concatenate([v[1] for v in values])
+        changed = False
+        if 'xrange' not in self.fig:
+            changed |= self.grow('x', self.ax.set_xlim, np.nanmin(x), np.nanmax(x))
+        if 'yrange' not in self.fig:
+            changed |= self.grow('y', self.ax.set_ylim, np.nanmin(y), np.nanmax(y))
+        return changed
+
+    def grow(self, axis, set, low, high):
+        """ Widens the limits of an axis to fit low to high, with headroom on the sides that
+            grow, other than the start of time along x """
+        limits = self.limits[axis]
+        if limits is not None and limits[0] <= low and high <= limits[1]:
+            return False
+        span = (high - low) or abs(high) or 1.0
+        lo, hi = limits or (low, high)
+        if low < lo or (limits is None and axis == 'y'):
+            lo = low - HEADROOM * span
+        if high > hi or limits is None:
+            hi = high + HEADROOM * span
+        self.limits[axis] = (lo, hi)
+        set(lo, hi)
+        return True
+
+
+def follow(args, figs, loglist, lvars, points):
+    """ Follows the logs of a run as the sim writes them, until every figure is closed """
+    import matplotlib.pyplot as mp
+    from timeit import default_timer as timer
+    run = RunTail(args, args.runs[0], loglist, lvars)
+    live = [LiveFigure(args, f, i, points) for i, f in enumerate(figs)]
+    mp.show(block=False)
+    period = 1 / (args.frame_rate or FRAME_RATE)
+    while any(mp.fignum_exists(f.figure.number) for f in live):
+        start = timer()
+        data = run.read()
+        if data is not None:
+            for f in live:
+                f.add(data)
+        for f in live:
+            if mp.fignum_exists(f.figure.number):
+                f.update()
+                f.figure.canvas.flush_events()
+        time.sleep(max(period - (timer() - start), 0))
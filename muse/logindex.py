@@ -0,0 +1,201 @@
+"""
+Persistent index of the variables logged in a run: the log each variable is in, with its ctype,
+unit and number of samples. The index is kept in a small file in the run directory (or the user's
+cache directory, if the run directory isn't writable) and entries are refreshed only when a header
+or log file changes, so looking up variables doesn't reparse every header every time.
+"""
+from __future__ import print_function
+from builtins import object
+
+import os
+import json
+import struct
+import hashlib
+import collections
+
+from . import pputils as pp
+
+INDEX_FILENAME = '.muse_index.json'
+INDEX_VERSION = 1
+HEADER_EXT = '.header'
+INDEX_VAR = 'sys.exec.out.time'
+# Log file extension for each Trick log format named in a header
+LOG_FORMATS = {
+    'ASCII': '.csv',
+    'HDF5': '.h5',
+    'little_endian': '.trk',
+    'big_endian': '.trk',
+}
+
+IndexedVar = collections.namedtuple('IndexedVar', 'log ctype unit samples')
+
+
+def index_filename(run_dir):
+    """ Where the index of a run is kept """
+    run_dir = os.path.abspath(run_dir)
+    if os.access(run_dir, os.W_OK):
+        return os.path.join(run_dir, INDEX_FILENAME)
+    key = hashlib.sha1(run_dir.encode('utf-8')).hexdigest()
+    return os.path.join(pp.cache_dir('index'), key + '.json')
+
+
+def parse_header(fn):
+    """ Parses a Trick log header into its log file name and [ctype, unit, name] of each variable.
+        The log file name is None for unsupported log formats """
+    with open(fn) as fh:
+        lines = fh.readlines()
+    fmt = lines[0].split()[-1]
+    log = None
+    if fmt in LOG_FORMATS:
+        log = os.path.splitext(os.path.basename(fn))[0] + LOG_FORMATS[fmt]
+    logged_vars = [line.split()[1:4] for line in lines[1:] if len(line.split()) >= 4]
+    return log, logged_vars
+
+
+def count_samples(fn):
+    """ Counts the samples in a log file. None if they can't be counted, such as for a log that's
+        corrupt or locked by the sim writing it """
+    try:
+        return read_sample_count(fn)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+
+
+def read_sample_count(fn):
+    ext = os.path.splitext(fn)[1]
+    if ext == '.h5':
+        import h5py
+        with h5py.File(fn, 'r') as hdf_file:
+            if INDEX_VAR in hdf_file:
+                return len(hdf_file[INDEX_VAR])
+            return None
+    elif ext == '.csv':
+        lines = 0
+        last = b''
+        with open(fn, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                lines += block.count(b'\n')
+                last = block[-1:]
+        if last and last != b'\n':
+            lines += 1  # No newline at the end of the last row
+        return max(lines - 1, 0)  # First line is the header
+    elif ext == '.trk':
+        order, params, offset = pp.read_trk_header(fn)
+        itemsize = sum(size for name, unit, ptype, size in params)
+        return (os.path.getsize(fn) - offset) // itemsize if itemsize else 0
+    return None
+
+
+class LogIndex(object):
+    """
+    The index of the logs in a single run directory
+    """
+
+    def __init__(self, run_dir, samples=True):
+        self.run_dir = os.path.abspath(run_dir)
+        self.filename = index_filename(self.run_dir)
+        self.headers = {}
+        self.vars = {}
+        self.samples = False  # Whether sample counts are up to date
+        self.load()
+        self.refresh(samples)
+
+    def refresh(self, samples=True):
+        """ Updates the index, saving it if it changed, and rebuilds the lookup table """
+        if self.update(samples):
+            self.save()
+        self.samples = self.samples or samples
+        self.build()
+
+    def load(self):
+        try:
+            with open(self.filename) as fh:
+                index = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return
+        if index.get('version') == INDEX_VERSION:
+            self.headers = index.get('headers', {})
+
+    def save(self):
+        try:
+            if not os.path.isdir(os.path.dirname(self.filename)):
+                os.makedirs(os.path.dirname(self.filename))
+            tmp_fn = self.filename + '.' + str(os.getpid())
+            with open(tmp_fn, 'w') as fh:
+                json.dump({'version': INDEX_VERSION, 'headers': self.headers}, fh)
+            os.rename(tmp_fn, self.filename)  # Atomic, so readers never see half an index
+        except (IOError, OSError):
+            pass  # The index is only a cache
+
+    def update(self, samples=True):
+        """ Refreshes the entries of headers and logs that changed. Returns whether any did. Sample
+            counts of changed logs are left as they are if samples is False """
+        changed = False
+        try:
+            fns = sorted(f for f in os.listdir(self.run_dir) if f.endswith(HEADER_EXT))
+        except OSError:
+            fns = []
+        for fn in set(self.headers) - set(fns):
+            del self.headers[fn]
+            changed = True
+        for fn in fns:
+            path = os.path.join(self.run_dir, fn)
+            stamp = pp.file_stamp(path)
+            entry = self.headers.get(fn)
+            if entry is None or entry['stamp'] != stamp:
+                log, logged_vars = parse_header(path)
+                entry = {'stamp': stamp, 'log': log, 'vars': logged_vars,
+                         'log_stamp': None, 'samples': None}
+                self.headers[fn] = entry
+                changed = True
+            if entry['log'] and samples:
+                log_path = os.path.join(self.run_dir, entry['log'])
+                log_stamp = pp.file_stamp(log_path)
+                if entry['log_stamp'] != log_stamp:
+                    entry['log_stamp'] = log_stamp
+                    entry['samples'] = count_samples(log_path) if log_stamp else None
+                    changed = True
+        return changed
+
+    def build(self):
+        """ Builds the variable lookup table from the header entries """
+        self.vars = {}
+        for fn in sorted(self.headers):
+            entry = self.headers[fn]
+            if not entry['log']:
+                continue
+            for ctype, unit, name in entry['vars']:
+                self.vars.setdefault(name, []).append(
+                    IndexedVar(entry['log'], ctype, unit, entry['samples']))
+
+    def variables(self):
+        """ Names of all variables logged in the run """
+        return list(self.vars.keys())
+
+    def lookup(self, name):
+        """ Where a variable is logged, one IndexedVar for each log it is in """
+        return self.vars.get(name, [])
+
+    def logs(self):
+        """ Each log file in the run and the names of the variables logged in it """
+        logs = collections.OrderedDict()
+        for fn in sorted(self.headers):
+            entry = self.headers[fn]
+            if entry['log']:
+                logs[entry['log']] = [name for ctype, unit, name in entry['vars']]
+        return logs
+
+
+_indexes = {}
+
+
+def get_index(run_dir, samples=True):
+    """ Gets the index of a run directory, refreshed at most once per process, and once more if
+        sample counts are wanted after an index without them. Counting samples can be skipped when
+        only variable names are needed, since it has to read the logs """
+    run_dir = os.path.abspath(run_dir)
+    if run_dir not in _indexes:
+        _indexes[run_dir] = LogIndex(run_dir, samples)
+    elif samples and not _indexes[run_dir].samples:
+        _indexes[run_dir].refresh(samples)
+    return _indexes[run_dir]
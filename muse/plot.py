@@ -2,53 +2,128 @@ from __future__ import print_function
 from builtins import str
 from builtins import range
 
+from .trace import span, tracer, Traced
+
+# Runs from which line plots draw all the lines of an expression as a single collection
+COLLECTION_RUNS = 20
+# Line styles of successive expressions of a figure drawn as collections, whose colors are the runs
+COLLECTION_STYLES = ['solid', 'dashed', 'dotted', 'dashdot']
+
 def generate_plots(args, figs):
     """ Actually generates the plot figures """
+    if args.output:
+        save_plots(args, figs)
+        return
     import matplotlib.pyplot as mp
-    # General plotting options
-    try:
-        mp.style.use(args.style)
-    except AttributeError:
-        print("Info: Style feature requires matplotlib 1.5")
+    set_style(args)
 
     i = 0
     for f in figs:
-        # Create figure
-        fig = mp.figure(i)
-
-        # Plot based on type
-        if f['type'] == 'default':
-            plot_default(args, f)
-        elif f['type'] == 'hist' or f['type'] == 'kde':
-            plot_stat(args, f)
-        elif f['type'] == 'scatter':
-            plot_scatter(args, f)
-        else:
-            plot_default(args, f)
-
-        # Add descriptors
-        mp.title(f['figure'])
-        mp.xlabel(f['xlabel'])
-        mp.ylabel(f['ylabel'])
-        if 'xrange' in f:
-            mp.xlim(f['xrange'][0], f['xrange'][-1])
-        if 'yrange' in f:
-            mp.ylim(f['yrange'])
-        if args.legend and len(args.runs) < 10:  # Arbitrary supression at 10 runs
-            if 'legend' in f:
-                mp.legend(f['legend'], loc='best')
-            else:
-                mp.legend(loc='best')
-        # Set options
-        mp.tight_layout()
+        with span('render', figure=str(f['figure']), type=f['type']):
+            fig = draw_figure(args, f, i)
         fig.canvas.mpl_connect('pick_event', onpick)
         i = i + 1
 
     mp.show()
 
 
+def set_style(args):
+    """ General plotting options """
+    import matplotlib.pyplot as mp
+    try:
+        mp.style.use(args.style)
+    except AttributeError:
+        print("Info: Style feature requires matplotlib 1.5")
+
+
+def draw_figure(args, f, i):
+    """ Creates and draws a single figure """
+    import matplotlib.pyplot as mp
+    # Create figure
+    fig = mp.figure(i)
+
+    # Plot based on type
+    if f['type'] == 'default':
+        plot_default(args, f)
+    elif f['type'] == 'hist' or f['type'] == 'kde':
+        plot_stat(args, f)
+    elif f['type'] == 'scatter':
+        plot_scatter(args, f)
+    elif f['type'] == 'envelope':
+        plot_envelope(args, f)
+    else:
+        plot_default(args, f)
+
+    # Add descriptors
+    mp.title(f['figure'])
+    mp.xlabel(f['xlabel'])
+    mp.ylabel(f['ylabel'])
+    if 'xrange' in f:
+        mp.xlim(f['xrange'][0], f['xrange'][-1])
+    if 'yrange' in f:
+        mp.ylim(f['yrange'])
+    # Arbitrary supression at 10 runs, but an envelope has a few entries however many runs
+    if args.legend and (len(args.runs) < 10 or f['type'] == 'envelope'):
+        if 'legend' in f:
+            mp.legend(f['legend'], loc='best')
+        else:
+            mp.legend(loc='best')
+    # Set options
+    mp.tight_layout()
+    return fig
+
+
+def save_plots(args, figs):
+    """ Renders the figures to files, without a display, in parallel worker processes """
+    import os
+    import matplotlib
+    matplotlib.use('Agg')  # Before pyplot is imported
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    jobs = [(args, f, i) for i, f in enumerate(figs)]
+    if args.jobs > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(args.jobs, len(jobs)))
+        try:
+            results = [tracer.merge(result)
+                       for result in pool.map(Traced(save_figure), jobs, chunksize=1)]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [save_figure(job) for job in jobs]
+    for fn, elapsed in results:
+        print("Info: Saved " + fn + " in " + "{:.3f}".format(elapsed) + " s")
+
+
+def save_figure(job):
+    """ Draws a figure and writes it to the output directory. Returns its file name and how long
+        it took """
+    import os
+    import re
+    import matplotlib.pyplot as mp
+    from timeit import default_timer as timer
+    args, f, i = job
+    start = timer()
+    name = re.sub(r'[^\w.-]+', '_', str(f['figure'])).strip('_')
+    fn = os.path.join(args.output, "{:03d}_{}.{}".format(i, name, args.format))
+    with span('render', figure=str(f['figure']), type=f['type'], file=fn) as info:
+        set_style(args)
+        fig = draw_figure(args, f, i)
+        fig.savefig(fn)
+        mp.close(fig)
+        info['bytes'] = os.path.getsize(fn)
+    return fn, timer() - start
+
+
 def onpick(event):
     thisline = event.artist
+    labels = getattr(thisline, 'labels', None)
+    if labels is not None:
+        # A collection of lines: the label of each line picked
+        for i in event.ind:
+            print(labels[i])
+        return
     label = thisline.get_label()
     print(label)
 
@@ -57,6 +132,16 @@ def plot_default(args, f):
     """ Default matplotlib line plotting """
     import matplotlib.pyplot as mp
     import numpy as np
+    from . import decimate as dm
+    if len(args.runs) >= COLLECTION_RUNS:
+        plot_collection(args, f)
+        return
+    # Long lines are decimated to the resolution of the axes
+    ax = mp.gca()
+    points = args.max_points
+    if points is None:
+        points = 2 * int(ax.bbox.width)
+    lines = []
     # Finally we are plotting something
     x = f['x']['data']
     for yy in f['y']:
@@ -72,15 +157,174 @@ def plot_default(args, f):
                     y_i = y[r]
                 else:
                     y_i = y[r][i]
+                y_i = stretch(x[r], y_i)
                 try:
-                    mp.plot(x[r], y_i, label=get_label(
+                    x_d, y_d = dm.minmax(x[r], y_i, points)
+                    line, = mp.plot(x_d, y_d, label=get_label(
                         r, yy['exp'], len(args.runs)), picker=5)
+                    if len(y_d) < len(y_i):
+                        lines.append((line, np.asarray(x[r]), np.asarray(y_i)))
                 except:
                     print("\nWarning: x or y could not be plotted:\n" + f['x']['exp'] + " or " + yy['exp'] + " for " + r)
                     if args.verbose:
                         print("x length: " + str(len(x[r])))
                         print("y length: " + str(len(y[r])))
                     continue
+    if lines:
+        # Redecimate from the full-resolution data when zoomed
+        ax.callbacks.connect('xlim_changed', lambda ax: redecimate(ax, lines, points))
+
+
+def plot_collection(args, f):
+    """ Line plotting of many runs: the lines of each expression are a single LineCollection,
+        colored by run, rather than an artist per line. The collection keeps the label of each
+        of its lines, for onpick to report the run of a line that is clicked """
+    import matplotlib.pyplot as mp
+    import numpy as np
+    from matplotlib.collections import LineCollection
+    from . import decimate as dm
+    ax = mp.gca()
+    points = args.max_points
+    if points is None:
+        points = 2 * int(ax.bbox.width)
+    colors = mp.rcParams['axes.prop_cycle'].by_key().get('color', ['C0'])
+    collections = []
+    x = f['x']['data']
+    for k, yy in enumerate(f['y']):
+        y = yy['data']
+        lines = []
+        labels = []
+        line_colors = []
+        for n, r in enumerate(args.runs):
+            x_r = np.asarray(x[r])
+            rows = np.atleast_2d(np.asarray(y[r], dtype=float))
+            rows = stretch(x_r, rows)
+            if rows.shape[-1] != len(x_r):
+                print("\nWarning: x or y could not be plotted:\n" + f['x']['exp'] + " or " + yy['exp'] + " for " + r)
+                if args.verbose:
+                    print("x length: " + str(len(x_r)))
+                    print("y length: " + str(rows.shape[-1]))
+                continue
+            for i, y_i in enumerate(rows):
+                lines.append((x_r, y_i))
+                labels.append(get_label(r, yy['exp'], len(args.runs)) +
+                              ('[' + str(i) + ']' if len(rows) > 1 else ''))
+                line_colors.append(colors[n % len(colors)])
+        if not lines:
+            continue
+        segments = [np.column_stack(dm.minmax(x_i, y_i, points)) for x_i, y_i in lines]
+        collection = LineCollection(segments, colors=line_colors, label=yy['exp'], picker=5,
+                                    linestyles=COLLECTION_STYLES[k % len(COLLECTION_STYLES)])
+        collection.labels = labels
+        ax.add_collection(collection)
+        collections.append((collection, lines))
+    ax.autoscale_view()
+    if collections and any(len(x_i) > points > 0 for c, lines in collections for x_i, y_i in lines):
+        # Redecimate from the full-resolution data when zoomed
+        ax.callbacks.connect('xlim_changed',
+                             lambda ax: redecimate_collections(ax, collections, points))
+
+
+def stretch(x, y):
+    """ Stretches the single value a reduction such as std() gives across every sample of x, so it
+        is drawn as a line """
+    import numpy as np
+    y = np.asarray(y)
+    if np.shape(y)[-1:] == (1,) and np.size(x) > 1:
+        return np.repeat(y, np.size(x), axis=-1)
+    return y
+
+
+def redecimate_collections(ax, collections, points):
+    """ Decimates the lines of collections again over just the visible x range """
+    from . import decimate as dm
+    import numpy as np
+    x0, x1 = ax.get_xlim()
+    for collection, lines in collections:
+        segments = []
+        for x, y in lines:
+            if x[0] <= x[-1] and np.all(x[1:] >= x[:-1]):
+                window = dm.window(x, x0, x1)
+                segments.append(np.column_stack(dm.minmax(x[window], y[window], points)))
+            else:  # Can only zoom in on monotonic x
+                segments.append(np.column_stack(dm.minmax(x, y, points)))
+        collection.set_segments(segments)
+
+
+def redecimate(ax, lines, points):
+    """ Decimates lines again over just the visible x range """
+    from . import decimate as dm
+    import numpy as np
+    x0, x1 = ax.get_xlim()
+    for line, x, y in lines:
+        if x[0] <= x[-1] and np.all(x[1:] >= x[:-1]):
+            window = dm.window(x, x0, x1)
+            line.set_data(*dm.minmax(x[window], y[window], points))
+        else:  # Can only zoom in on monotonic x
+            line.set_data(*dm.minmax(x, y, points))
+
+
+def plot_envelope(args, f):
+    """ Plots the envelope of Monte Carlo runs: shaded bands of the minimum to maximum and the mean
+        plus or minus N standard deviations, lines of the mean and percentiles, and any runs to
+        highlight drawn over them """
+    import matplotlib.pyplot as mp
+    import numpy as np
+    from . import decimate as dm
+    from . import envelope as ev
+    ax = mp.gca()
+    points = args.max_points
+    if points is None:
+        points = 2 * int(ax.bbox.width)
+    highlight = [args.runs[h] if isinstance(h, int) else h for h in f.get('highlight', [])]
+    labelled = set()
+    for yy in f['y']:
+        stats = yy.get('envelope')
+        if stats is None:
+            try:
+                x, values = ev.stack_runs(f['x']['data'], yy['data'], args.runs)
+            except:
+                print("\nWarning: envelope could not be plotted for:\n" + yy['exp'])
+                continue
+            stats = ev.envelope_stats(values, f.get('sigma', ev.SIGMA),
+                                      f.get('percentiles', ev.PERCENTILES))
+            stats['x'] = x
+        x = stats['x']
+        # Keep the samples where the outer band peaks, like a decimated line
+        keep = slice(None)
+        if 0 < points < len(x):
+            upper = np.max(np.reshape(stats['max'], (-1, len(x))), axis=0)
+            lower = np.min(np.reshape(stats['min'], (-1, len(x))), axis=0)
+            keep = np.union1d(dm.minmax_indices(upper, points), dm.minmax_indices(lower, points))
+        components = range(len(stats['mean'])) if np.ndim(stats['mean']) > 1 else [None]
+        for c in components:
+            label = yy['exp'] if c is None else yy['exp'] + '[' + str(c) + ']'
+            line, = mp.plot(x[keep], component(stats['mean'], c, keep), label=label)
+            color = line.get_color()
+            mp.fill_between(x[keep], component(stats['min'], c, keep),
+                            component(stats['max'], c, keep),
+                            color=color, alpha=0.15, linewidth=0)
+            mp.fill_between(x[keep], component(stats['lower'], c, keep),
+                            component(stats['upper'], c, keep), color=color, alpha=0.3,
+                            linewidth=0, label=label + r' $\pm${:g}$\sigma$'.format(stats['sigma']))
+            for p in sorted(stats['percentiles']):
+                mp.plot(x[keep], component(stats['percentiles'][p], c, keep), color=color,
+                        linestyle='--', linewidth=0.8)
+        for r in highlight:
+            if r not in yy['data']:
+                print("\nWarning: run to highlight not found: " + str(r))
+                continue
+            y = np.asarray(yy['data'][r])
+            for y_i in (y if y.ndim > 1 else [y]):
+                x_d, y_d = dm.minmax(f['x']['data'][r], y_i, points)
+                mp.plot(x_d, y_d, color='k', linewidth=1, picker=5,
+                        label='_' + r if r in labelled else r)  # Once in the legend
+                labelled.add(r)
+
+
+def component(value, c, keep):
+    """ Samples of a statistic to draw, of one component of it if it is a vector """
+    return (value if c is None else value[c])[keep]
 
 
 def plot_stat(args, f):
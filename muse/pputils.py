@@ -8,7 +8,6 @@ from builtins import str
 
 import sys
 import os
-import re
 
 
 def end_script(status):
@@ -18,6 +17,18 @@ def end_script(status):
     sys.exit(status)
 
 
+def check_csv_engine(engine):
+    """ Ends the script if the csv parser engine asked for can't be imported """
+    if engine != 'pyarrow':
+        return
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("\nThe pyarrow csv engine needs pyarrow, which is not installed; use --csv-engine c "
+              "or python")
+        end_script(-1)
+
+
 def get_vars_h5(lfile):
     import h5py
     """ Gets the variables logged from a hdf5 file """
@@ -42,72 +53,178 @@ def get_vars_header(lfile):
         ext = ".csv"
     elif vlist[0] == "HDF5":
         ext = ".h5"
+    elif vlist[0] in ["little_endian", "big_endian"]:
+        ext = ".trk"
     else:  # Unsupported type
         pass
     return vlist[1:], ext  # First line is a header line of sorts
 
 
 def get_vars_csv(lfile):
-    import pandas as pd
     """ Gets the variables logged from a csv file """
     try:
-        raw = pd.read_csv(lfile, header=0, index_col=0)
+        header = get_csv_header(lfile)
     except:
         print("Error: File could not be read: " + lfile)
         return
-    return list(raw.keys())
+    return header[1:]  # First column is the index
 
 
-def extract_csv(args, var, data, lfile):
-    """ Extracts data from csv files """
+def cache_dir(kind):
+    """ User cache directory for a kind of file muse keeps about runs that aren't writable """
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'muse', kind)
+
+
+def file_stamp(fn):
+    """ Modification time and size of a file, used to tell when it changes """
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def get_csv_header(lfile):
+    """ Gets the column names from the header row of a csv file """
+    import csv
+    with open(lfile) as fh:
+        line = fh.readline()
+    return [c.strip() for c in next(csv.reader([line]))]
+
+
+def csv_name(column):
+    """ Strips the ' {unit}' suffix from a csv column name """
+    return column.split('{')[0].strip()
+
+
+def csv_positions(header, names):
+    """ Positions in a csv header of the named variables, matched with or without their ' {unit}'
+        suffix. The index is found by name too, or else taken to be the first column """
+    positions = {}
+    for i, c in enumerate(header):
+        positions.setdefault(csv_name(c), i)
+    positions.setdefault('sys.exec.out.time', 0)
+    return dict((csv_name(v), positions[csv_name(v)]) for v in names
+                if csv_name(v) in positions)
+
+
+def read_csv_columns(lfile, columns, engine='c', tmin=None, tmax=None):
+    """ Reads only the columns at the given positions from a csv file, as arrays keyed by position.
+        If a time window is given, only the bytes of the rows within it are read """
+    import io
     import pandas as pd
     import numpy as np
+    columns = sorted(set(columns))
+    if tmin is None and tmax is None:
+        raw = pd.read_csv(lfile, header=None, skiprows=1, usecols=columns,
+                          dtype=np.float64, engine=engine)
+    else:
+        start, stop = csv_window(lfile, tmin, tmax)
+        if stop <= start:
+            return dict((c, np.array([], dtype=np.float64)) for c in columns)
+        with open(lfile, 'rb') as fh:
+            fh.seek(start)
+            rows = fh.read(stop - start)
+        raw = pd.read_csv(io.BytesIO(rows), header=None, usecols=columns,
+                          dtype=np.float64, engine=engine)
+    return dict((c, raw[c].values) for c in columns)
+
+
+def read_columns(lfile, columns, engine='c', tmin=None, tmax=None, ingest=False):
+    """ Reads columns of a csv log from its columnar store if it has a current one, or else from
+        the csv itself. If ingest is set, the store is made first, so later reads are fast """
+    from . import colstore
+    if ingest:
+        colstore.ensure(lfile, engine)
+    raw = colstore.read_columns(lfile, columns, tmin, tmax)
+    if raw is None:
+        raw = read_csv_columns(lfile, columns, engine, tmin, tmax)
+    return raw
+
+
+def csv_window(lfile, tmin=None, tmax=None):
+    """ Byte range of the rows of a csv log with times within [tmin, tmax]. Rows are found by binary
+        search on byte offsets, reading only the first column of the rows it compares """
+    with open(lfile, 'rb') as fh:
+        fh.readline()  # Header
+        first = fh.tell()
+        fh.seek(0, 2)
+        end = fh.tell()
+
+        def row_at(offset):
+            """ Start and time of the first row starting at or after offset """
+            if offset <= first:
+                fh.seek(first)
+            else:
+                fh.seek(offset - 1)
+                fh.readline()  # Finish the row the offset is in
+            pos = fh.tell()
+            line = fh.readline()
+            if not line.strip():
+                return end, None
+            return pos, float(line.split(b',', 1)[0])
+
+        def search(value, side):
+            lo = first
+            hi = end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                pos, t = row_at(mid)
+                if t is None or t > value or (side == 'left' and t == value):
+                    hi = mid
+                else:
+                    lo = pos + 1
+            return row_at(lo)[0]
+
+        start = first if tmin is None else search(tmin, 'left')
+        stop = end if tmax is None else search(tmax, 'right')
+    return start, stop
+
+
+def extract_csv(args, var, data, lfile):
+    """ Extracts data from csv files, reading only the columns of the requested variables """
     try:
-        raw = pd.read_csv(lfile, header=0, index_col=0, dtype=np.float64)
+        header = get_csv_header(lfile)
+    except:
+        print("Error: File could not be read: " + lfile)
+        return
+    # Resolve variables against the header, with or without their ' {unit}' suffix
+    columns = csv_positions(header, [v for v in var if csv_name(v) not in data])
+    try:
+        raw = read_columns(lfile, [0] + list(columns.values()), args.csv_engine,
+                           args.tmin, args.tmax, args.ingest)
+    except ImportError as e:
+        print("Error: File could not be read with the " + args.csv_engine + " csv engine (" +
+              str(e) + "): " + lfile)
+        return
     except:
         print("Error: File could not be read: " + lfile)
         return
     # Get time
-    time = np.array(raw.index.get_values())
+    time = raw[0]
     # Get data
-    for v in var:
-        if v not in data:
-            if v == 'sys.exec.out.time':
-                data[v] = np.array(raw.index.get_values())
-            else:
-                regex = re.compile(' \{.*\}')
-                if regex.search(v):
-                    vv = v.split()[0]
-                else:
-                    regex = re.compile(re.escape(v) + ' \{.*\}')
-                    v = [c for c in raw
-                         for m in [regex.search(c)] if m]  # Find the firs
-                    if not v:
-                        continue
-                    v = v[0]
-                    vv = v.split()[0]
-                data[vv] = np.array(raw[v].get_values())
-        else:
-            continue  # already extracted
+    for vv in columns:
+        data[vv] = raw[columns[vv]]
     return data, time
 
 
 def extract_h5(args, var, data, lfile):
     """ Extracts data from hdf5 files """
     import h5py
-    import numpy as np
     try:
         raw = h5py.File(lfile, 'r')
     except:
         print("Error: File could not be read: " + lfile)
         return
-    # Get time
-    time = np.array(raw['sys.exec.out.time'])
+    # Get time, reading only the samples within the time window
+    window = time_slice(raw['sys.exec.out.time'], args.tmin, args.tmax)
+    time = h5_read(lfile, raw['sys.exec.out.time'], window)
     # Get data
     for v in var:
         if v not in data:  # havent extracted yet
             if v in raw:
-                data[v] = np.array(raw[v])
+                data[v] = h5_read(lfile, raw[v], window)
             else:
                 # if args.verbose :
                 # print "Warning: " + v + " not found in " +
@@ -119,6 +236,255 @@ def extract_h5(args, var, data, lfile):
     return data, time
 
 
+# Maps of whole files, shared by the reads of each file, by file name
+FILE_MAPS = {}
+
+
+def max_mapped_files():
+    """ Most files kept mapped at once. Before Python 3.13, each map holds a file descriptor for as
+        long as arrays read through it are in use, so maps are kept to half the descriptors the
+        process may open """
+    if sys.version_info >= (3, 13):
+        return None
+    try:
+        import resource
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2
+    except (ImportError, ValueError):
+        return 128
+
+
+def file_map(lfile):
+    """ Read-only memory map of a whole file, so arrays in it are read from the page cache as they
+        are used instead of being copied. Every read of the file shares the map until the file
+        changes. Returns None for empty files, or once too many files are mapped """
+    import mmap
+    stamp = file_stamp(lfile)
+    if lfile in FILE_MAPS and FILE_MAPS[lfile][0] == stamp:
+        return FILE_MAPS[lfile][1]
+    limit = max_mapped_files()
+    if stamp is None or not stamp[1] or (limit is not None and lfile not in FILE_MAPS and
+                                         len(FILE_MAPS) >= limit):
+        return None
+    kwargs = {} if limit is not None else {'trackfd': False}
+    with open(lfile, 'rb') as fh:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ, **kwargs)
+    FILE_MAPS[lfile] = (stamp, mapped)
+    return mapped
+
+
+def h5_memmap(lfile, dataset):
+    """ Memory-maps an HDF5 dataset that is stored contiguously and uncompressed, as a read-only
+        view of the map of its file. Returns None for datasets that are chunked, compressed or not
+        allocated, or that can't be mapped """
+    import numpy as np
+    import h5py
+    if dataset.chunks is not None or dataset.size == 0 or dataset.dtype.kind not in 'biufc':
+        return None
+    if dataset.id.get_create_plist().get_layout() != h5py.h5d.CONTIGUOUS:
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    mapped = file_map(lfile)
+    if mapped is None or offset + dataset.size * dataset.dtype.itemsize > len(mapped):
+        return None
+    return np.ndarray(dataset.shape, dtype=dataset.dtype, buffer=mapped, offset=offset)
+
+
+def h5_read(lfile, dataset, window=slice(None)):
+    """ Reads a slice of an HDF5 dataset: a read-only view of the map of its file where it can be
+        mapped, otherwise a copy read through h5py """
+    mapped = h5_memmap(lfile, dataset)
+    if mapped is not None:
+        return mapped[window]
+    return dataset[window]
+
+
+# Trick type codes of floating-point, unsigned and string values; others are signed integers
+TRK_FLOAT_TYPES = [10, 11]
+TRK_UNSIGNED_TYPES = [2, 5, 7, 9, 13, 15, 17]
+TRK_STRING_TYPES = [3]
+
+
+def read_trk_header(lfile):
+    """ Reads the header of a Trick binary log: its byte order, the [name, unit, type, size] of
+        each variable in a record, and the offset of the first record """
+    import struct
+    with open(lfile, 'rb') as fh:
+        tag = fh.read(10)  # Trick-<version>-<L|B>
+        if not tag.startswith(b'Trick-') or tag[-1:] not in [b'L', b'B']:
+            raise ValueError('Not a Trick binary log: ' + lfile)
+        order = '<' if tag[-1:] == b'L' else '>'
+
+        def read_int():
+            return struct.unpack(order + 'i', fh.read(4))[0]
+
+        def read_str():
+            return fh.read(read_int()).decode('ascii', 'replace')
+
+        params = []
+        for i in range(read_int()):
+            name = read_str()
+            unit = read_str()
+            params.append([name, unit, read_int(), read_int()])
+        return order, params, fh.tell()
+
+
+def trk_format(order, ptype, size):
+    """ NumPy format of a value of a Trick type """
+    if ptype in TRK_STRING_TYPES:
+        return 'S' + str(size)
+    elif ptype in TRK_FLOAT_TYPES:
+        return order + 'f' + str(size)
+    elif ptype in TRK_UNSIGNED_TYPES:
+        return order + 'u' + str(size)
+    elif size in [1, 2, 4, 8]:
+        return order + 'i' + str(size)
+    return 'V' + str(size)
+
+
+def trk_memmap(lfile):
+    """ Memory-maps the records of a Trick binary log as a read-only structured array, so each
+        variable is a view of the file rather than a parsed copy. A record still being written is
+        left out """
+    import numpy as np
+    order, params, offset = read_trk_header(lfile)
+    names, formats, offsets = [], [], []
+    itemsize = 0
+    for name, unit, ptype, size in params:
+        if name not in names:
+            names.append(name)
+            formats.append(trk_format(order, ptype, size))
+            offsets.append(itemsize)
+        itemsize += size
+    dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                      'itemsize': itemsize})
+    records = (os.path.getsize(lfile) - offset) // itemsize if itemsize else 0
+    if not records:
+        return np.zeros(0, dtype=dtype)
+    mapped = file_map(lfile)
+    if mapped is None:
+        # Too many files mapped already, so the records are read instead
+        return np.fromfile(lfile, dtype=dtype, count=records, offset=offset)
+    return np.ndarray((records,), dtype=dtype, buffer=mapped, offset=offset)
+
+
+def get_vars_trk(lfile):
+    """ Gets the variables logged from a Trick binary log """
+    try:
+        order, params, offset = read_trk_header(lfile)
+    except:
+        print("Error: File could not be read: " + lfile)
+        return
+    return [name for name, unit, ptype, size in params[1:]]  # First variable is the index
+
+
+def extract_trk(args, var, data, lfile):
+    """ Extracts data from Trick binary logs, as views of the samples within the time window of a
+        memory map of the log """
+    try:
+        raw = trk_memmap(lfile)
+    except:
+        print("Error: File could not be read: " + lfile)
+        return
+    # Get time, and the samples within the time window
+    window = time_slice(raw['sys.exec.out.time'], args.tmin, args.tmax)
+    time = raw['sys.exec.out.time'][window]
+    # Get data
+    for v in var:
+        if v not in data and v in raw.dtype.names:
+            data[v] = raw[v][window]
+    return data, time
+
+
+def bisect_sorted(seq, value, side='left'):
+    """ Binary search of a sorted sequence with random access, such as an HDF5 dataset, reading
+        only the elements it needs to compare """
+    lo = 0
+    hi = len(seq)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        item = seq[mid]
+        if item < value or (side == 'right' and item == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def time_slice(time, tmin=None, tmax=None):
+    """ Slice of the samples of a sorted time sequence within [tmin, tmax] """
+    start = 0 if tmin is None else bisect_sorted(time, tmin, 'left')
+    stop = len(time) if tmax is None else bisect_sorted(time, tmax, 'right')
+    return slice(start, max(start, stop))
+
+
+# Relative cost of reading a byte of each log format; csv has to be parsed
+LOG_COST_FACTORS = {'.h5': 1.0, '.trk': 1.0, '.npy': 1.0, '.csv': 8.0}
+# Fixed cost of opening a log, in bytes
+LOG_OPEN_COST = 64 * 1024
+# Most candidate logs for which the cheapest set is found exactly, rather than greedily
+EXACT_MAX_LOGS = 12
+
+
+def log_cost(lfile):
+    """ Estimated cost of reading from a log file, from its size and format """
+    try:
+        size = os.path.getsize(lfile)
+    except OSError:
+        size = 0
+    ext = os.path.splitext(lfile)[1]
+    if ext == '.csv':
+        from . import colstore
+        if colstore.is_current(lfile):
+            ext = '.npy'  # Read from its columnar store
+    return LOG_OPEN_COST + size * LOG_COST_FACTORS.get(ext, 1.0)
+
+
+def select_logs(vldict, costs):
+    """ Solves the weighted set cover of variables by logs: finds the cheapest set of logs that has
+        every variable, given the logs each variable is in and the cost of reading each log. The
+        set is exact for a few candidate logs and greedy otherwise. Also returns the cheapest
+        selected log to read each variable from """
+    candidates = sorted(set(l for v in vldict for l in vldict[v]))
+    variables = list(vldict.keys())
+    # Bit mask of the variables in each log
+    masks = dict((l, 0) for l in candidates)
+    for i, v in enumerate(variables):
+        for l in vldict[v]:
+            masks[l] |= 1 << i
+    everything = (1 << len(variables)) - 1
+
+    if len(candidates) <= EXACT_MAX_LOGS:
+        best = None
+        for subset in range(1, 1 << len(candidates)):
+            covered = 0
+            cost = 0
+            chosen = []
+            for j, l in enumerate(candidates):
+                if subset >> j & 1:
+                    covered |= masks[l]
+                    cost += costs[l]
+                    chosen.append(l)
+            if covered == everything and (best is None or (cost, len(chosen)) < best[0]):
+                best = ((cost, len(chosen)), chosen)
+        selected = best[1] if best else []
+    else:
+        selected = []
+        covered = 0
+        while covered != everything:
+            # Cheapest log per newly covered variable
+            l = min((l for l in candidates if masks[l] & ~covered),
+                    key=lambda l: costs[l] / bin(masks[l] & ~covered).count('1'))
+            selected.append(l)
+            covered |= masks[l]
+
+    vlog = {}
+    for v in variables:
+        vlog[v] = min((l for l in selected if l in vldict[v]), key=lambda l: costs[l])
+    return selected, vlog
+
+
 def check_monte(loc, runs):
     """ If a MONTE_*/ directory is provided, it goes and gets all the
         sub-RUN directories """
@@ -126,7 +492,7 @@ def check_monte(loc, runs):
     for r in runs:
         if 'MONTE' in r:
             for root, dirs, files in os.walk(os.path.join(loc, r)):
-                for d in dirs:
+                for d in sorted(dirs):
                     if 'RUN' in d:
                         new_runs.append(os.path.join(r, d))
                 break  # only goes 1-level deep
@@ -0,0 +1,54 @@
+"""
+Resampling of logged variables onto a common time base
+"""
+from __future__ import division
+
+METHODS = ['linear', 'zoh', 'nearest']
+GRIDS = ['finest', 'coarsest']
+
+
+def time_step(t):
+    """ Average time step of a time vector """
+    import numpy as np
+    if len(t) < 2:
+        return np.inf
+    return (t[-1] - t[0]) / (len(t) - 1)
+
+
+def time_base(times, grid='finest', dt=None):
+    """ Chooses the common time base for a set of log time vectors: the log with the finest or
+        coarsest time step, or a uniform grid with step dt spanning all of the logs """
+    import numpy as np
+    times = [t for t in times if len(t) > 0]
+    if dt:
+        start = min(t[0] for t in times)
+        stop = max(t[-1] for t in times)
+        # Tolerate round-off so the last log time is kept when it lands on the grid
+        n = int(np.floor((stop - start) / dt + 1e-9)) + 1
+        return start + dt * np.arange(n)
+    if grid == 'coarsest':
+        return max(times, key=time_step)
+    return min(times, key=time_step)
+
+
+def resample(t, y, base, method='linear'):
+    """ Resamples y, logged at times t, onto the time base. Outside of t, the first and last values
+        are held. Methods are linear interpolation, zero-order-hold and nearest sample """
+    import numpy as np
+    if t is base or (len(t) == len(base) and np.array_equal(t, base)):
+        return y
+    if len(t) == 1:
+        return np.full(len(base), y[0])
+    if method == 'linear':
+        return np.interp(base, t, y)
+    elif method == 'zoh':
+        i = np.searchsorted(t, base, side='right') - 1
+        np.clip(i, 0, len(t) - 1, out=i)
+    elif method == 'nearest':
+        i = np.searchsorted(t, base)
+        np.clip(i, 1, len(t) - 1, out=i)
+        # Step back where the previous sample is at least as close
+        i -= (base - t[i - 1]) <= (t[i] - base)
+    else:
+        raise ValueError('Unsupported resampling method: {}'.format(method))
+    return np.asarray(y)[i]
@@ -1,11 +1,9 @@
 from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
-from builtins import map
 from builtins import str
 from builtins import range
 from builtins import object
-from past.utils import old_div
 #\!/usr/bin/python2.4
 
 # A really simple expression evaluator supporting the
@@ -18,82 +16,529 @@ from past.utils import old_div
 # Dax Garner 4/2012 Modified for initial use in trick_plot
 #                   Removed exception handling; added functionality (std, mean, ...)
 #                   Supports simple element operations on time-series vectors of length three
-#                      - Note: vector * vector is not a dot or cross product!
-
-import sys
-from . import pputils
+#                      - Note: vector * vector is not a dot or cross product! Use dot() and cross()
+#
+# Expressions are compiled once into a tree of nodes, which is then evaluated
+# with whole-array numpy operations. Time-series are numpy arrays with samples
+# along the last axis; vectors are stacked with their components along the
+# first axis, so scalars, time-series and vectors all broadcast together.
+# Quaternions are vectors of four components, scalar first. Functions of time,
+# such as ddt() and movmean(), use the time-series of sys.exec.out.time.
+#
+# Subexpressions are identified by their structure, so a Program of many
+# expressions evaluates the subexpressions they share once per Scope.
+
+import collections
 import numpy as np
-import math
 from . import pputils as pp
 
+# Values closer than this to an integer are snapped to it
+EPSILON = 0.0000000001
+# Number of compiled expressions kept by the expression cache
+CACHE_SIZE = 512
+# Time-series that functions of time are evaluated against
+TIME = 'sys.exec.out.time'
 
-class Parser(object):
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses maxsize currsize')
 
-    def __init__(self, string, vars={}):
-        self.string = string
-        self.index = 0
-        self.expand = True
+
+class Scope(object):
+    """ Variables against which a compiled expression is evaluated """
+
+    def __init__(self, vars={}, ndim=1):
+        self.ndim = ndim  # Dimensions of a scalar time-series
         self.vars = {
             'pi': np.pi
         }
-        self.funcs = {
-            'std': lambda x: np.std(x),
-            'mean': lambda x: [np.mean(x)],
-            'log': lambda x: self.parseFuncArguments('LOG10', x, 1),
-            'rss': lambda x: self.parseFuncArguments('RSS',   x, 3),
-            'last': lambda x: self.LAST(x),
-            'max': lambda x: [max(x)],
-        }
+        self.vectors = {}
+        self.shared = set()  # Keys of subexpressions whose values are kept
+        self.memo = {}
+        self.results = {}
         for var in vars:
-            if self.vars.get(var) != None:
+            if self.vars.get(var) is not None:
                 print("Cannot redefine the value of " + var)
             self.vars[var] = vars[var]
 
-    def getValue(self, size=1):
+    def lookup(self, name):
+        """ Gets the value of a variable, assembling vectors from their components """
+        value = self.vars.get(name, None)
+        if type(value) == type({}):
+            value = value.get('data', None)
+        if value is None:
+            if name in self.vectors:
+                value = self.vectors[name]
+            elif self.findKey(name):
+                value = self.parseKey(name)
+                self.vectors[name] = value
+            else:
+                print("Unknown variable or function: " + name + ", in plot definition.")
+                pp.end_script(-1)
+        return np.asarray(value)
+
+    def findKey(self, key):
+        flag = True
+        for i in range(3):  # Vectors (arrays of length 3) and quaternions (length 4)
+            key_full = key + '[' + str(i) + ']'
+            if key_full not in self.vars:
+                flag = flag and False
+        return flag
+
+    def components(self, key):
+        """ Number of components of a vector: 4 for a quaternion, otherwise 3 """
+        if key + '[3]' in self.vars and key + '[4]' not in self.vars:
+            return 4
+        return 3
+
+    def parseKey(self, key):
+        return np.stack([np.asarray(self.vars.get(key + '[' + str(i) + ']'))
+                         for i in range(self.components(key))])
+
+    def value(self, node):
+        """ Evaluates a node, once if it's shared """
+        if node.key in self.memo:
+            return self.memo[node.key]
+        value = node.evaluate(self)
+        if node.key in self.shared:
+            self.memo[node.key] = value
+        return value
+
+    def is_vector(self, value):
+        """ Whether the value has a leading component axis """
+        return np.ndim(value) > self.ndim
+
+    def time(self):
+        """ The time of each sample, as a float time-series """
+        if TIME not in self.vars:
+            print("Functions of time need " + TIME + ", which is not in the data")
+            pp.end_script(-1)
+        return np.asarray(self.lookup(TIME), dtype=float)
+
+
+class Node(object):
+    """ A compiled (sub)expression """
+
+    @property
+    def key(self):
+        """ Structural key: equal for nodes that compute the same thing """
+        try:
+            return self._key
+        except AttributeError:
+            self._key = repr(self)
+            return self._key
+
+    def evaluate(self, scope):
+        raise NotImplementedError
+
+    def children(self):
+        return []
+
+
+class Number(Node):
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, scope):
+        return self.value
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class Variable(Node):
+
+    def __init__(self, name):
+        self.name = name
+
+    def evaluate(self, scope):
+        return scope.lookup(self.name)
+
+    def __repr__(self):
+        return self.name
+
+
+class Negative(Node):
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, scope):
+        return np.negative(scope.value(self.operand))
+
+    def children(self):
+        return [self.operand]
+
+    def __repr__(self):
+        return '-(' + repr(self.operand) + ')'
+
+
+class Sum(Node):
+    """ Sum of terms; subtracted terms are wrapped in a Negative """
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def evaluate(self, scope):
+        value = scope.value(self.terms[0])
+        for term in self.terms[1:]:
+            value = np.add(value, scope.value(term))
+        return value
+
+    def children(self):
+        return self.terms
+
+    def __repr__(self):
+        return '(' + ' + '.join(repr(t) for t in self.terms) + ')'
+
+
+class Product(Node):
+    """ Left-to-right product of factors, each either multiplied ('*') or divided ('/') """
+
+    def __init__(self, factors):
+        self.factors = factors  # List of (operator, node, string index)
+
+    def evaluate(self, scope):
+        value = scope.value(self.factors[0][1])
+        for op, node, index in self.factors[1:]:
+            other = scope.value(node)
+            if op == '*':
+                value = np.multiply(value, other)
+            else:
+                if np.any(np.equal(other, 0)):
+                    print("Division by 0 kills baby whales (occured at index " + str(index) + ")")
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    value = np.true_divide(value, other)
+        return value
+
+    def children(self):
+        return [node for op, node, index in self.factors]
+
+    def __repr__(self):
+        s = repr(self.factors[0][1])
+        for op, node, index in self.factors[1:]:
+            s += ' ' + op + ' ' + repr(node)
+        return '(' + s + ')'
+
+
+class Power(Node):
+    """ Right-associative exponentiation """
+
+    def __init__(self, operands):
+        self.operands = operands
+
+    def evaluate(self, scope):
+        value = scope.value(self.operands[-1])
+        for node in reversed(self.operands[:-1]):
+            value = np.power(np.asarray(scope.value(node), dtype=float), value)
+        return value
+
+    def children(self):
+        return self.operands
+
+    def __repr__(self):
+        return '(' + ' ^ '.join(repr(o) for o in self.operands) + ')'
+
+
+class Function(Node):
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def evaluate(self, scope):
+        return FUNCTIONS[self.name](scope, *[scope.value(a) for a in self.args])
+
+    def children(self):
+        return self.args
+
+    def __repr__(self):
+        return self.name + '(' + ', '.join(repr(a) for a in self.args) + ')'
+
+
+def RSS(scope, x):
+    if scope.is_vector(x):
+        return np.sqrt(np.sum(np.square(x), axis=0))
+    return np.abs(x)
+
+
+def LOG10(scope, x):
+    return np.log10(x)
+
+
+def check_vector(name, x, scope, components=3):
+    if not scope.is_vector(x) or len(x) != components:
+        print("Function " + name + " needs " + ("a quaternion" if components == 4 else "a vector") +
+              " of " + str(components) + " components, found " + str(np.shape(x)))
+        pp.end_script(-1)
+
+
+def NORM(scope, x):
+    return RSS(scope, x)
+
+
+def DOT(scope, a, b):
+    return np.sum(np.multiply(a, b), axis=0)
+
+
+def CROSS(scope, a, b):
+    check_vector('cross', a, scope)
+    check_vector('cross', b, scope)
+    return np.cross(a, b, axis=0)
+
+
+def UNIT(scope, x):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.true_divide(x, NORM(scope, x))
+
+
+def ANGLE_BETWEEN(scope, a, b):
+    """ Angle between two vectors, in radians; accurate for small and near-opposite angles """
+    return np.arctan2(NORM(scope, CROSS(scope, a, b)), DOT(scope, a, b))
+
+
+def QCONJ(scope, q):
+    check_vector('qconj', q, scope, 4)
+    return q * np.array([1.0, -1.0, -1.0, -1.0]).reshape((4,) + (1,) * (np.ndim(q) - 1))
+
+
+def QMUL(scope, p, q):
+    """ Hamilton product of two quaternions """
+    check_vector('qmul', p, scope, 4)
+    check_vector('qmul', q, scope, 4)
+    pw, pv = p[0], p[1:]
+    qw, qv = q[0], q[1:]
+    return np.concatenate([(pw * qw - np.sum(pv * qv, axis=0))[np.newaxis],
+                           pw * qv + qw * pv + np.cross(pv, qv, axis=0)])
+
+
+def QROT(scope, q, v):
+    """ Rotates a vector by a unit quaternion, q v q* """
+    check_vector('qrot', q, scope, 4)
+    check_vector('qrot', v, scope)
+    w, u = q[0], q[1:]
+    t = 2 * np.cross(u, v, axis=0)
+    return v + w * t + np.cross(u, t, axis=0)
+
+
+def QTRANS(scope, q, v):
+    """ Transforms a vector into the frame a unit quaternion rotates to, q* v q """
+    return QROT(scope, QCONJ(scope, q), v)
+
+
+def LAST(scope, x):
+    return np.asarray(x)[..., -1:]
+
+
+# Functions of time. These work along the sample axis of whole time-series with cumulative sums
+# and block-wise array operations rather than a loop over samples; windows and time constants in
+# seconds are converted to samples with the median time step.
+
+def parameter(name, value):
+    if np.ndim(value) > 0:
+        print("The second argument of " + name + " must be a number, found " + str(np.shape(value)))
+        pp.end_script(-1)
+    return float(value)
+
+
+def time_step(t):
+    if t.shape[-1] < 2:
+        return 0.0
+    return float(np.median(np.diff(t, axis=-1)))
+
+
+def DIFF(scope, x):
+    """ Change from the previous sample, 0 at the first """
+    x = np.asarray(x, dtype=float)
+    return np.concatenate([np.zeros_like(x[..., :1]), np.diff(x, axis=-1)], axis=-1)
+
+
+def DDT(scope, x):
+    """ Derivative with respect to time: second order central differences, allowing for uneven
+        time steps, and first order differences at the ends """
+    x = np.asarray(x, dtype=float)
+    t = scope.time()
+    if x.shape[-1] < 2:
+        return np.zeros_like(x)
+    dt = np.diff(t, axis=-1)
+    dx = np.diff(x, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h0, h1 = dt[..., :-1], dt[..., 1:]
+        inner = (h0 * h0 * x[..., 2:] - h1 * h1 * x[..., :-2] + (h1 * h1 - h0 * h0) * x[..., 1:-1]) \
+            / (h0 * h1 * (h0 + h1))
+        return np.concatenate([dx[..., :1] / dt[..., :1], inner, dx[..., -1:] / dt[..., -1:]], axis=-1)
+
+
+def CUMTRAPZ(scope, x):
+    """ Integral over time from the first sample, by the trapezoidal rule """
+    x = np.asarray(x, dtype=float)
+    areas = 0.5 * (x[..., 1:] + x[..., :-1]) * np.diff(scope.time(), axis=-1)
+    return np.concatenate([np.zeros_like(x[..., :1]), np.cumsum(areas, axis=-1)], axis=-1)
+
+
+def window(scope, name, width, n):
+    """ Samples in a window of the given width in seconds, and the offset of its first sample
+        from the center """
+    dt = time_step(scope.time())
+    width = parameter(name, width)
+    k = int(min(max(round(width / dt), 1), n)) if dt > 0 else 1
+    return k, k // 2
+
+
+def MOVMEAN(scope, x, width):
+    """ Mean over a centered window of time, from differences of a cumulative sum. The window
+        is cut short at the ends """
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1]
+    k, h = window(scope, 'movmean', width, n)
+    # Sum values relative to the first to limit the round-off of long cumulative sums
+    x0 = x[..., :1]
+    c = np.concatenate([np.zeros_like(x0), np.cumsum(x - x0, axis=-1)], axis=-1)
+    i = np.arange(n)
+    lo = np.clip(i - h, 0, n)
+    hi = np.clip(i - h + k, 0, n)
+    return (c[..., hi] - c[..., lo]) / (hi - lo) + x0
+
+
+def MOVMAX(scope, x, width):
+    """ Maximum over a centered window of time, by the van Herk/Gil-Werman algorithm: running
+        maxima forward and backward within blocks of the window's length, so each sample costs a
+        few comparisons whatever the window """
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1]
+    k, h = window(scope, 'movmax', width, n)
+    if k == 1:
+        return x
+    blocks = -(-(n + k - 1) // k)
+    pad = [(0, 0)] * (x.ndim - 1) + [(h, blocks * k - n - h)]
+    padded = np.pad(x, pad, mode='constant', constant_values=-np.inf)
+    shape = padded.shape[:-1] + (blocks, k)
+    forward = np.maximum.accumulate(padded.reshape(shape), axis=-1).reshape(padded.shape)
+    backward = np.maximum.accumulate(padded.reshape(shape)[..., ::-1], axis=-1)[..., ::-1] \
+        .reshape(padded.shape)
+    # The window starting at sample i spans the end of one block and the start of the next
+    return np.maximum(backward[..., :n], forward[..., k - 1:k - 1 + n])
+
+
+def LOWPASS(scope, x, tau):
+    """ First order low-pass filter with time constant tau, starting from the first sample. Each
+        block of samples is filtered in closed form, as a cumulative sum weighted by powers of the
+        decay, sized so the weights don't overflow """
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1]
+    tau = parameter('lowpass', tau)
+    dt = time_step(scope.time())
+    if tau <= 0 or dt <= 0 or dt / tau > 30:
+        return x
+    # y[i] = b y[i-1] + a x[i]
+    b = np.exp(-dt / tau)
+    a = 1 - b
+    size = int(min(max(600 * tau / dt, 1), n))
+    y = np.empty_like(x)
+    state = x[..., :1]
+    for start in range(0, n, size):
+        stop = min(start + size, n)
+        p = b ** np.arange(1, stop - start + 1)
+        block = p * (state + np.cumsum(a * x[..., start:stop] / p, axis=-1))
+        y[..., start:stop] = block
+        state = block[..., -1:]
+    return y
+
+
+def RESAMPLE(scope, x, dt):
+    """ Samples every dt seconds from the first sample, held until the next, on the time of
+        the original samples """
+    x = np.asarray(x, dtype=float)
+    dt = parameter('resample', dt)
+    t = scope.time()
+    if dt <= 0:
+        return x
+    held = t[..., :1] + np.floor((t - t[..., :1]) / dt + EPSILON) * dt
+    rows_t = t.reshape(-1, t.shape[-1])
+    rows_held = held.reshape(rows_t.shape)
+    index = np.stack([np.searchsorted(rt, rh + EPSILON, side='right') - 1
+                      for rt, rh in zip(rows_t, rows_held)]).reshape(t.shape)
+    return np.take_along_axis(x, np.broadcast_to(index, x.shape), axis=-1)
+
+
+# Reductions operate along the sample axis and keep it, with length 1
+FUNCTIONS = {
+    'std': lambda scope, x: np.std(x, axis=-1, keepdims=True),
+    'mean': lambda scope, x: np.mean(x, axis=-1, keepdims=True),
+    'log': LOG10,
+    'rss': RSS,
+    'last': LAST,
+    'max': lambda scope, x: np.max(x, axis=-1, keepdims=True),
+    'norm': NORM,
+    'unit': UNIT,
+    'dot': DOT,
+    'cross': CROSS,
+    'angle_between': ANGLE_BETWEEN,
+    'qconj': QCONJ,
+    'qmul': QMUL,
+    'qrot': QROT,
+    'qtrans': QTRANS,
+    'diff': DIFF,
+    'ddt': DDT,
+    'cumtrapz': CUMTRAPZ,
+    'movmean': MOVMEAN,
+    'movmax': MOVMAX,
+    'lowpass': LOWPASS,
+    'resample': RESAMPLE,
+}
+# Number of arguments of functions that take more than one
+ARGUMENTS = {
+    'dot': 2,
+    'cross': 2,
+    'angle_between': 2,
+    'qmul': 2,
+    'qrot': 2,
+    'qtrans': 2,
+    'movmean': 2,
+    'movmax': 2,
+    'lowpass': 2,
+    'resample': 2,
+}
+REDUCTIONS = set(['std', 'mean', 'max', 'last'])
+# Functions of the whole time-series, which depend on neighbouring samples
+TIME_FUNCTIONS = set(['diff', 'ddt', 'cumtrapz', 'movmean', 'movmax', 'lowpass', 'resample'])
+
+
+def is_reduction(node):
+    return isinstance(node, Function) and node.name in REDUCTIONS
+
+
+def streamable(node):
+    """ Whether an expression can be evaluated a chunk of samples at a time: it is either
+        element-wise, or a reduction of an element-wise expression """
+    if is_reduction(node):
+        node = node.args[0]
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if is_reduction(node) or (isinstance(node, Function) and node.name in TIME_FUNCTIONS):
+            return False
+        stack.extend(node.children())
+    return True
+
+
+class Parser(object):
+    """ Compiles an expression string into a tree of Nodes """
+
+    def __init__(self, string, vars={}):
+        self.string = string
+        self.index = 0
+        self.vars = vars
+
+    def compile(self):
         value = self.parseExpression()
-        if type(value) == type([]) or type(value) == type(np.array([])):
-            value = list(value)
         self.skipWhitespace()
         if self.hasNext():
             print("Unexpected character found: '" + self.peek() + "' at index " + str(self.index))
-        value, length = self.getBaseValue(value)
-
-        if self.expand and size > 1 and (type(value) != type([]) and type(value) != type(np.array([]))):
-            val_array = []
-            for i in range(size):
-                val_array.append(value)
-            value = val_array
-
-        return value, length
-
-    def getBaseValue(self, value):
-        if type(value) != type([]) and type(value) != type(np.array([])):
-            length = 1
-            value = self.getPrecision(value)
-        else:
-            length = len(value)
-            for i in range(length):
-                value[i], l = self.getBaseValue(value[i])
-        return value, length
-
-    def getPrecision(self, value):
-        if math.isnan(value):
-            return float(0.0)
-        # Return a negative integer value
-        if value < 0 and int(-value) == -value:
-            return -int(-value)
-        # Return a positive integer type if the answer is an integer
-        if int(value) == value:
-            return int(value)
-        # If Python made some silly precision error
-        # like x.99999999999996, just return x + 1 as an integer
-        epsilon = 0.0000000001
-        if int(value + epsilon) != int(value):
-            value = int(value + epsilon)
-        elif int(value - epsilon) != int(value):
-            value = int(value)
         return value
 
+    def getValue(self, size=1):
+        return evaluate_node(self.compile(), Scope(self.vars), size)
+
     def peek(self):
         return self.string[self.index:self.index + 1]
 
@@ -111,145 +556,36 @@ class Parser(object):
         return self.parseAddition()
 
     def parseAddition(self):
-        flag = False
         values = [self.parseMultiplication()]
         while True:
             self.skipWhitespace()
             char = self.peek()
             if char == '+':
-                flag = True
                 self.index += 1
                 values.append(self.parseMultiplication())
             elif char == '-':
-                flag = True
                 self.index += 1
-                negative = self.parseMultiplication()
-                values.append(self.applyNegative(negative))
+                values.append(Negative(self.parseMultiplication()))
             else:
                 break
-        value = self.Array_Op('Add', values, flag)
-        return value
-
-    def applyNegative(self, values):
-        negative = 0
-        if type(values) == type([]) or type(values) == type(np.array([])):
-            negative = []
-            for v in values:
-                negative.append(self.applyNegative(v))
-        else:
-            negative = -values
-        return negative
-
-    def Array_Op(self, Op, A, flag):
-        if flag:                                                                 # Operate
-            # Gather information about any arrays present
-            array_info = self.array_check(A)
-            # If all arrays are the same length,
-            if self.length_check(A, array_info['lengths']):
-                if array_info['flag']:  # If there is at least one array, repackage and regress
-                    B = []  # Set B to empty array, B will be of array type
-                    # For each index in an array of A
-                    for i in range(len(A[array_info['index']])):
-                        C = []  # Construct new array for regression operation
-                        for j in range(len(A)):  # For each index in A
-                            if type(A[j]) == type([]) or type(A[j]) == type(np.array([])):  # If value is an array
-                                C.append(A[j][i])  # Append value in new array
-                            else:  # Else, value is a scalar
-                                # Append scalar value in new array
-                                C.append(A[j])
-                        # Operate on constructed array
-                        B.append(self.Array_Op(Op, C, flag))
-                else:  # Else, operate on the scalar values
-                    B = eval('self.' + Op + '(A)')  # Operate on scalar values
-            else:  # Else, arrays not the same length
-                print('Error: Inconsistent Array Lengths')  # Print error.
-        # Do not operate, pass through.
-        else:
-            if type(A) == type([]) or type(A) == type(np.array([])):  # If A is an array.
-                if len(A) == 1:  # If A is a single array within a
-                    B = A[0]  # Remove extra array structure.
-                else:  # Else, multiple values (either array or scalars).
-                    B = A  # Direct pass through.
-            else:  # Else, no array
-                B = A  # Direct pass through.
-        # Return result.
-        return B
-
-    def array_check(self, A):
-        # Default false. If at least one array is within A, flag becomes true
-        array_flag = False
-        # Index for an array if present. Happens to be the last array in A
-        last_array = 0
-        # Array of array lengths for check later.
-        array_length = []
-        # For each index in A, determine if array and length of array
-        for i in range(len(A)):
-            if type(A[i]) == type([]) or type(A[i]) == type(np.array([])):  # If array
-                array_flag = True  # Set array flag, at least one value is an array
-                last_array = i  # Set index for the last array in A
-                array_length.append(len(A[i]))  # Set array length
-            else:  # Otherwise, not an array
-                array_length.append(1)  # Set array length as 1
-        # Return array information
-        return {'flag': array_flag, 'index': last_array, 'lengths': array_length}
-
-    def length_check(self, A, lengths):
-        # Default True. Only two arrays with unequal lengths set False
-        check = True
-        # For each index in A, check for consistent array lengths
-        for i in range(len(A)):
-            if type(A[i]) == type([]) or type(A[i]) == type(np.array([])):  # If array
-                for j in range(len(A)):  # For each index in A
-                    if (type(A[j]) == type([]) or type(A[j]) == type(np.array([]))) and i != j:  # If array and not the same array
-                        check = check and lengths[i] == lengths[j]  # Check length
-        # Return whether the array match (True) or not (False)
-        return check
-
-    def Add(self, values):
-        value = sum(values)
-        return value
+        if len(values) == 1:
+            return values[0]
+        return Sum(values)
 
     def parseMultiplication(self):
-        flag = False
-        values = [self.parseExponent()]
+        values = [('*', self.parseExponent(), self.index)]
         while True:
             self.skipWhitespace()
             char = self.peek()
-            if char == '*':
-                flag = True
-                self.index += 1
-                values.append(self.parseExponent())
-            elif char == '/':
-                flag = True
-                div_index = self.index
+            if char == '*' or char == '/':
+                op_index = self.index
                 self.index += 1
-                denominator = self.parseExponent()
-                values.append(self.applyDivision(denominator, div_index))
+                values.append((char, self.parseExponent(), op_index))
             else:
                 break
-        value = self.Array_Op('Mult', values, flag)
-        return value
-
-    def applyDivision(self, values, index):
-        if type(values) == type([]) or type(values) == type(np.array([])):
-            denominator = []
-            for d in values:
-                if d == 0:
-                    print("Division by 0 kills baby whales (occured at index " + str(index) + ")")
-                denominator.append(self.applyDivision(d, index))
-        else:
-            if values == 0:
-                print("Division by 0 kills baby whales (occured at index " + str(index) + ")")
-            denominator = old_div(1.0, values)
-        return denominator
-
-    def Mult(self, A):
-        # Set B to one for multiplication
-        B = 1
-        for value in A:                                                          # For each value in A
-            B *= value  # Multiply
-        # Return result.
-        return B
+        if len(values) == 1:
+            return values[0][1]
+        return Product(values)
 
     def parseParenthesis(self):
         self.skipWhitespace()
@@ -266,38 +602,25 @@ class Parser(object):
             return self.parseNegative()
 
     def parseExponent(self):
-        flag = False
         values = [self.parseParenthesis()]
         while True:
             self.skipWhitespace()
             char = self.peek()
             if char == '^':
-                flag = True
                 self.index += 1
                 values.append(self.parseParenthesis())
             else:
                 break
-        value = self.Array_Op('Exp', values, flag)
-        return value
-
-    def Exp(self, A):
-        # Set counter to length of array minus one
-        n = len(A) - 1
-        # Initialize B to last value in array
-        B = A[n]
-        # While n is greater than one. (move through the array backwards)
-        while n >= 1:
-            n = n - 1  # Iterate n one less
-            B = A[n]**B  # Raise the next value by the exponent
-        # Return result
-        return B
+        if len(values) == 1:
+            return values[0]
+        return Power(values)
 
     def parseNegative(self):
         self.skipWhitespace()
         char = self.peek()
         if char == '-':
             self.index += 1
-            return -1 * self.parseParenthesis()
+            return Negative(self.parseParenthesis())
         else:
             return self.parseValue()
 
@@ -319,35 +642,31 @@ class Parser(object):
                 self.index += 1
             else:
                 break
-        value = self.vars.get(var, None)
-        if type(value) == type({}):
-            value = self.vars.get(var, None).get('data', None)
-        elif value == None:
-            if self.findKey(var):
-                value = self.parseKey(var)
-            elif value == None:
-                try:
-                    value = self.funcs[var](self.parseParenthesis())
-                except KeyError:
-                    print("Unknown variable or function: " + var + ", in plot definition.")
-                    pp.end_script(-1)
-            else:
-                print("Unrecognized variable or function: '" + var + "'")
-        return value
-
-    def findKey(self, key):
-        flag = True
-        for i in range(3):  # Currently only works for vectors (arrays of length 3)
-            key_full = key + '[' + str(i) + ']'
-            if key_full not in self.vars:
-                flag = flag and False
-        return flag
-
-    def parseKey(self, key):
-        x = self.vars.get(key + '[0]')  # .get('data', None)
-        y = self.vars.get(key + '[1]')  # .get('data', None)
-        z = self.vars.get(key + '[2]')  # .get('data', None)
-        return [x, y, z]
+        if var in FUNCTIONS:
+            args = self.parseArguments()
+            if len(args) != ARGUMENTS.get(var, 1):
+                print("Function " + var + " takes " + str(ARGUMENTS.get(var, 1)) +
+                      " argument(s), found " + str(len(args)))
+                pp.end_script(-1)
+            return Function(var, args)
+        return Variable(var)
+
+    def parseArguments(self):
+        """ Parses the comma-separated arguments of a function, in parentheses """
+        self.skipWhitespace()
+        if self.peek() != '(':
+            return [self.parseParenthesis()]
+        self.index += 1
+        args = [self.parseExpression()]
+        self.skipWhitespace()
+        while self.peek() == ',':
+            self.index += 1
+            args.append(self.parseExpression())
+            self.skipWhitespace()
+        if self.peek() != ')':
+            print("No closing parenthesis found at character " + str(self.index))
+        self.index += 1
+        return args
 
     def parseNumber(self):
         self.skipWhitespace()
@@ -372,47 +691,123 @@ class Parser(object):
                 print("Unexpected end found")
             else:
                 print("I was expecting to find a number at character " + str(self.index) + " but instead I found a '" + char + "'. What's up with that?")
-        return float(strValue)
-
-    def parseFuncArguments(self, Op, x, num_args):
-        # If the argument is a list/array
-        if type(x) == type([]) or type(x) == type(np.array([])):
-            args = ''  # Instantiate string list of arguments
-            for i in range(len(x) - 1):  # For each argument in list, except the last
-                # Append the argument in the argument string list
-                args = args + 'x[' + str(i) + '], '
-            # Append the last argument to the string, with no comma
-            args = args + 'x[' + str(len(x) - 1) + ']'
-            # If the first argument is an array/list and the number of
-            # arguments is expected
-            if (type(x[0]) == type([]) or type(x[0]) == type(np.array([]))) and len(x) == num_args:
-                # Apply funtion iteratively (map) through the list of
-                # arguments, return
-                return eval('map(' + 'self.' + Op + ', ' + args + ')')
-            # Else, If only the length of the x matches the number of expected
-            # arguments
-            elif len(x) == num_args:
-                # Evaluate function with arguments and return
-                return eval('self.' + Op + '(' + args + ')')
-            else:  # Else,
-                # Apply function iteratively (map) with the list of arguemnts
-                # directly passed, return
-                return list(map(eval('self.' + Op), x))
-        else:                                                                  # Else, argument is a scalar
-            # Valuate function with argument and return
-            return eval('self.' + Op + '(x)')
-
-    def RSS(self, a, b, c):
-        return math.sqrt(a * a + b * b + c * c)
-
-    def LOG10(self, x):
-        return np.log10(x)
-
-    def LAST(self, x):
-        self.expand = False
-        return x[-1]
+        return Number(float(strValue))
+
+
+def getPrecision(value):
+    """ Replaces NaNs with zero and snaps values within EPSILON of an integer to it """
+    value = np.where(np.isnan(value), 0.0, value)
+    # Infinities are left as they are, rather than compared with themselves
+    finite = np.isfinite(value)
+    masked = np.where(finite, value, 0.0)
+    nearest = np.round(masked)
+    return np.where(finite & (np.abs(masked - nearest) < EPSILON), nearest, value)
+
+
+def evaluate_node(node, scope, size=1, runs=None):
+    """ Evaluates a compiled expression, expanding constants to the time-series size. Results
+        are kept by the scope, for expressions evaluated again against it """
+    if (node.key, size, runs) in scope.results:
+        return scope.results[node.key, size, runs]
+    value = getPrecision(scope.value(node))
+    if np.ndim(value) == 0:
+        if runs is not None:
+            value = np.full((runs, size), value)
+        elif size > 1:
+            value = np.full(size, value)
+        else:
+            value = value[()]
+    result = value, np.shape(value)[-1] if np.ndim(value) else 1
+    scope.results[node.key, size, runs] = result
+    return result
+
+
+class ExpressionCache(object):
+    """ Bounded least-recently-used cache of compiled expressions, keyed by expression text """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.nodes = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, expression):
+        try:
+            node = self.nodes.pop(expression)
+            self.hits += 1
+        except KeyError:
+            node = Parser(expression).compile()
+            self.misses += 1
+            if len(self.nodes) >= self.maxsize:
+                self.nodes.popitem(last=False)  # Least recently used
+        self.nodes[expression] = node
+        return node
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.nodes))
+
+    def clear(self):
+        self.nodes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_cache = ExpressionCache()
+
+
+def compile(expression):
+    """ Compiles an expression string into a tree of Nodes, parsing each distinct string once """
+    return _cache.get(str(expression))
+
+
+def cache_info():
+    """ Hits, misses and size of the compiled expression cache """
+    return _cache.info()
+
+
+def cache_clear():
+    _cache.clear()
+
+
+class Program(object):
+    """
+    Expressions compiled together, such as those of all the figures of a report, as a graph of
+    distinct subexpressions. Subexpressions used more than once are evaluated once per scope, that
+    is once per run or batch of runs, and kept for as long as the scope.
+    """
+    def __init__(self, expressions):
+        self.roots = collections.OrderedDict()
+        self.uses = collections.Counter()
+        for expression in expressions:
+            node = compile(expression)
+            self.roots[str(expression)] = node
+            self.add(node)
+        self.shared = set(k for k in self.uses if self.uses[k] > 1)
+
+    def add(self, node):
+        """ Counts the uses of a node and, the first time it's seen, its children """
+        if isinstance(node, (Number, Variable)):
+            return
+        self.uses[node.key] += 1
+        if self.uses[node.key] == 1:
+            for child in node.children():
+                self.add(child)
+
+    def scope(self, vars, ndim=1):
+        scope = Scope(vars, ndim)
+        scope.shared = self.shared
+        return scope
+
+    def evaluate(self, expression, scope, size=1, runs=None):
+        return evaluate_node(self.roots[str(expression)], scope, size, runs)
 
 
 def evaluate(expression, vars={}, size=1):
-    p = Parser(expression, vars)
-    return p.getValue(size)
+    return evaluate_node(compile(expression), Scope(vars), size)
+
+
+def evaluate_runs(expression, vars, size, runs):
+    """ Evaluates an expression once over many runs at a time. Variables are (runs x samples)
+        arrays, and so is the result, with vectors stacked along a leading component axis.
+        Reductions apply per run, along the sample axis. """
+    return evaluate_node(compile(expression), Scope(vars, ndim=2), size, runs)
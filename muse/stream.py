@@ -0,0 +1,367 @@
+"""
+Out-of-core processing: logs are read in aligned chunks of samples, expressions are evaluated a
+chunk at a time and the results are folded into streaming reducers, so memory is bounded by the
+chunk size rather than the length of the logs.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+
+import os
+
+from . import pputils as pp
+from . import colstore
+
+INDEX_VAR = 'sys.exec.out.time'
+
+
+class RunningStats(object):
+    """
+    Running count, mean, variance, minimum, maximum and last value of values added in batches
+    along an axis. Means and variances are combined with the parallel form of Welford's algorithm,
+    so states can also be merged.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, values, axis=-1):
+        """ Adds a batch of values, along the given axis """
+        import numpy as np
+        values = np.asarray(values, dtype=float)
+        n = values.shape[axis]
+        if n == 0:
+            return
+        mean = np.mean(values, axis=axis)
+        m2 = np.sum(np.square(values - np.expand_dims(mean, axis)), axis=axis)
+        self.combine(n, mean, m2, np.min(values, axis=axis), np.max(values, axis=axis),
+                     np.take(values, -1, axis=axis))
+
+    def merge(self, other):
+        """ Merges another state into this one. The other state's values come after these """
+        if other.count:
+            self.combine(other.count, other.mean, other.m2, other.min, other.max, other.last)
+
+    def combine(self, n, mean, m2, low, high, last):
+        import numpy as np
+        if not self.count:
+            self.count, self.mean, self.m2, self.min, self.max = n, mean, m2, low, high
+        else:
+            count = self.count + n
+            delta = mean - self.mean
+            self.mean = self.mean + delta * (n / count)
+            self.m2 = self.m2 + m2 + np.square(delta) * (self.count * n / count)
+            self.min = np.minimum(self.min, low)
+            self.max = np.maximum(self.max, high)
+            self.count = count
+        self.last = last
+
+    def variance(self):
+        return self.m2 / self.count
+
+    def std(self):
+        import numpy as np
+        return np.sqrt(self.variance())
+
+    def reduce(self, name):
+        """ Result of a simple_math reduction, keeping a length-1 sample axis """
+        import numpy as np
+        values = {'mean': self.mean, 'std': self.std(), 'max': self.max, 'last': self.last}[name]
+        return np.expand_dims(values, -1)
+
+
+class MinMaxReducer(object):
+    """
+    Streaming min/max decimation of lines for plotting. Samples are grouped in buckets and, for
+    each line, the samples with the minimum and maximum value in each bucket are kept. When there
+    are more buckets than wanted, neighbouring buckets are merged and new buckets are made twice
+    as wide, so the length of the lines doesn't need to be known up front.
+
+    Lines are given as rows of y, sharing x; a kept sample keeps x and every row.
+    """
+    def __init__(self, points):
+        self.buckets = max(points // 2, 1)
+        self.width = 1
+        self.offset = 0  # Index of the next sample added
+        self.pending = None  # Samples not yet in a full bucket
+        self.index = []  # Per bucket, the sample index of each slot
+        self.x = []
+        self.y = []
+        self.first = None
+        self.last = None
+
+    def add(self, x, y):
+        """ Adds a chunk of samples: x has shape (n,) and y has shape (lines, n) """
+        import numpy as np
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if x.shape[-1] == 0:
+            return
+        index = np.arange(self.offset, self.offset + x.shape[-1])
+        self.offset += x.shape[-1]
+        if self.first is None:
+            self.first = (index[:1], x[:1], y[:, :1])
+        if self.pending is not None:
+            index = np.concatenate([self.pending[0], index])
+            x = np.concatenate([self.pending[1], x])
+            y = np.concatenate([self.pending[2], y], axis=1)
+        # Adding buckets can merge them and widen new buckets, so the samples bucketed are
+        # counted at the width before
+        rest = x.shape[-1] // self.width * self.width
+        if rest:
+            self.add_buckets(index[:rest], x[:rest], y[:, :rest])
+        self.pending = (index[rest:], x[rest:], y[:, rest:]) if rest < x.shape[-1] else None
+        self.last = (index[-1:], x[-1:], y[:, -1:])
+
+    def add_buckets(self, index, x, y):
+        import numpy as np
+        lines = y.shape[0]
+        buckets = y.reshape(lines, -1, self.width)
+        # Slots 2k and 2k + 1 of a bucket hold the minimum and maximum samples of line k
+        slots = np.empty((buckets.shape[1], 2 * lines), dtype=np.intp)
+        slots[:, 0::2] = np.argmin(buckets, axis=2).T
+        slots[:, 1::2] = np.argmax(buckets, axis=2).T
+        slots += (np.arange(buckets.shape[1]) * self.width)[:, None]
+        self.index.append(index[slots])
+        self.x.append(x[slots])
+        self.y.append(y[:, slots])
+        if sum(len(i) for i in self.index) > self.buckets:
+            self.merge()
+
+    def merge(self):
+        """ Merges neighbouring pairs of buckets until there are few enough """
+        import numpy as np
+        index = np.concatenate(self.index)
+        x = np.concatenate(self.x)
+        y = np.concatenate(self.y, axis=1)
+        while len(index) > self.buckets:
+            pairs = len(index) // 2
+            a = slice(0, 2 * pairs, 2)
+            b = slice(1, 2 * pairs, 2)
+            lines = y.shape[0]
+            # Take each slot from whichever bucket of the pair has the more extreme sample
+            take_a = np.empty((pairs, 2 * lines), dtype=bool)
+            for k in range(lines):
+                take_a[:, 2 * k] = y[k, a, 2 * k] <= y[k, b, 2 * k]
+                take_a[:, 2 * k + 1] = y[k, a, 2 * k + 1] >= y[k, b, 2 * k + 1]
+            merged = (np.where(take_a, index[a], index[b]),
+                      np.where(take_a, x[a], x[b]),
+                      np.where(take_a, y[:, a], y[:, b]))
+            if len(index) % 2:  # Odd bucket out stays as it is
+                merged = (np.concatenate([merged[0], index[-1:]]),
+                          np.concatenate([merged[1], x[-1:]]),
+                          np.concatenate([merged[2], y[:, -1:]], axis=1))
+            index, x, y = merged
+            self.width *= 2
+        self.index = [index]
+        self.x = [x]
+        self.y = [y]
+
+    def result(self):
+        """ The decimated lines, as x with shape (m,) and y with shape (lines, m) """
+        import numpy as np
+        if self.first is None:
+            return np.array([]), np.array([[]])
+        index = [self.first[0]] + [i.ravel() for i in self.index]
+        x = [self.first[1]] + [v.ravel() for v in self.x]
+        y = [self.first[2]] + [v.reshape(v.shape[0], -1) for v in self.y]
+        if self.pending is not None:
+            # Samples short of a full bucket, down to their minima and maxima
+            keep = np.unique(np.concatenate([np.argmin(self.pending[2], axis=1),
+                                             np.argmax(self.pending[2], axis=1)]))
+            index.append(self.pending[0][keep])
+            x.append(self.pending[1][keep])
+            y.append(self.pending[2][:, keep])
+        index.append(self.last[0])
+        x.append(self.last[1])
+        y.append(self.last[2])
+        index = np.concatenate(index)
+        keep = np.unique(index, return_index=True)[1]  # Sorted by sample, without repeats
+        return np.concatenate(x)[keep], np.concatenate(y, axis=1)[:, keep]
+
+
+class ByteRange(object):
+    """ File-like reader of a range of bytes of a file, read whole or by line, as bytes or, for
+        parsers that need them, text """
+    def __init__(self, fh, start, stop, text=False):
+        self.fh = fh
+        self.fh.seek(start)
+        self.remaining = stop - start
+        self.text = text
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data.decode('utf-8') if self.text else data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self.fh.readline(size)
+        self.remaining -= len(line)
+        return line.decode('utf-8') if self.text else line
+
+    def __iter__(self):
+        return iter(self.readline, '' if self.text else b'')
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    next = __next__
+
+
+def iter_h5_chunks(args, lfile, names, chunk):
+    """ Reads variables from an HDF5 log a chunk of samples at a time """
+    import h5py
+    with h5py.File(lfile, 'r') as raw:
+        window = pp.time_slice(raw[INDEX_VAR], args.tmin, args.tmax)
+        # Contiguous datasets are memory-mapped, the rest read through h5py
+        sources = {}
+        for v in [INDEX_VAR] + [v for v in names if v in raw]:
+            mapped = pp.h5_memmap(lfile, raw[v])
+            sources[v] = raw[v] if mapped is None else mapped
+        for start in range(window.start, window.stop, chunk):
+            stop = min(start + chunk, window.stop)
+            data = dict((v, sources[v][start:stop]) for v in sources if v != INDEX_VAR)
+            yield sources[INDEX_VAR][start:stop], data
+
+
+def iter_trk_chunks(args, lfile, names, chunk):
+    """ Reads variables from a memory-mapped Trick binary log a chunk of samples at a time """
+    raw = pp.trk_memmap(lfile)
+    window = pp.time_slice(raw[INDEX_VAR], args.tmin, args.tmax)
+    names = [v for v in names if v in raw.dtype.names]
+    for start in range(window.start, window.stop, chunk):
+        stop = min(start + chunk, window.stop)
+        yield raw[INDEX_VAR][start:stop], dict((v, raw[v][start:stop]) for v in names)
+
+
+def iter_csv_chunks(args, lfile, names, chunk):
+    """ Reads variables from a csv log a chunk of rows at a time """
+    import pandas as pd
+    import numpy as np
+    columns = pp.csv_positions(pp.get_csv_header(lfile), names)
+    usecols = sorted(set([0] + list(columns.values())))
+    if args.ingest:
+        colstore.ensure(lfile, args.csv_engine)
+    stored = colstore.read_columns(lfile, usecols, args.tmin, args.tmax)
+    if stored is not None:
+        # Memory-mapped columns of the log's store
+        for start in range(0, len(stored[0]), chunk):
+            yield stored[0][start:start + chunk], \
+                dict((v, stored[columns[v]][start:start + chunk]) for v in columns)
+        return
+    start, stop = pp.csv_window(lfile, args.tmin, args.tmax)
+    if stop <= start:
+        return
+    with open(lfile, 'rb') as fh:
+        rows = ByteRange(fh, start, stop, text=args.csv_engine == 'python')
+        reader = pd.read_csv(rows, header=None, usecols=usecols,
+                             dtype=np.float64, engine=args.csv_engine, chunksize=chunk)
+        for raw in reader:
+            yield raw[0].values, dict((v, raw[columns[v]].values) for v in columns)
+
+
+def iter_run_chunks(args, r, loglist, lvars, chunk):
+    """ Reads the variables of a run in chunks aligned across its logs. Yields None and stops if
+        the logs don't share a time base, since their chunks can't be aligned """
+    import numpy as np
+    iters = []
+    for l in loglist:
+        lfile = os.path.join(args.sim, r, l)
+        if l.endswith('.h5'):
+            iters.append(iter_h5_chunks(args, lfile, lvars[l], chunk))
+        elif l.endswith('.trk'):
+            iters.append(iter_trk_chunks(args, lfile, lvars[l], chunk))
+        else:
+            iters.append(iter_csv_chunks(args, lfile, lvars[l], chunk))
+    while True:
+        chunks = []
+        for it in iters:
+            try:
+                chunks.append(next(it))
+            except StopIteration:
+                chunks.append(None)
+        if all(c is None for c in chunks):
+            return
+        if any(c is None for c in chunks) or \
+                any(not np.array_equal(c[0], chunks[0][0]) for c in chunks[1:]):
+            yield None
+            return
+        data = {INDEX_VAR: chunks[0][0]}
+        for time, cdata in chunks:
+            for v in cdata:
+                data.setdefault(v, cdata[v])
+        yield data
+
+
+class FigureReducer(object):
+    """
+    Evaluates the expressions of a figure a chunk at a time. Element-wise expressions are decimated
+    together, so they share their x samples; reductions such as mean() are accumulated.
+    """
+    def __init__(self, fig, points):
+        from . import simple_math as sm
+        self.fig = fig
+        self.nodes = [sm.compile(d['exp']) for d in [fig['x']] + fig['y']]
+        self.stats = [RunningStats() if sm.is_reduction(n) else None for n in self.nodes]
+        self.lines = MinMaxReducer(points)
+        self.rows = None  # Rows of the decimated lines of each expression
+
+    def add(self, data):
+        """ Adds a chunk of variables, each with samples along the last axis """
+        from . import simple_math as sm
+        import numpy as np
+        if 'trange' in self.fig:
+            t = data[INDEX_VAR]
+            keep = (t >= self.fig['trange'][0]) & (t <= self.fig['trange'][-1])
+            if not keep.all():
+                data = dict((v, data[v][..., keep]) for v in data)
+        n = len(data[INDEX_VAR])
+        if n == 0:
+            return
+        scope = sm.Scope(data)
+        values = []
+        for node, stats in zip(self.nodes, self.stats):
+            if stats:
+                stats.add(sm.evaluate_node(node.args[0], scope, n)[0])
+                values.append(None)
+            else:
+                values.append(sm.evaluate_node(node, scope, n)[0])
+        # Decimate element-wise y expressions against x; x itself if there are none
+        x = values[0] if values[0] is not None else data[INDEX_VAR]
+        lines = [v for v in values[1:] if v is not None] or [x]
+        if self.rows is None:
+            self.rows = [None]  # x is the decimated x
+            row = 0
+            for v in values[1:]:
+                if v is None:
+                    self.rows.append(None)
+                else:
+                    vector = np.ndim(v) > 1
+                    self.rows.append((row, row + (len(v) if vector else 1), vector))
+                    row = self.rows[-1][1]
+        self.lines.add(x, np.vstack([np.atleast_2d(v) for v in lines]))
+
+    def result(self):
+        """ Data of the x and each y expression, None for those without any samples """
+        x, y = self.lines.result()
+        results = []
+        for node, stats, rows in zip(self.nodes, self.stats, self.rows or [None] * len(self.nodes)):
+            if stats:
+                results.append(stats.reduce(node.name) if stats.count else None)
+            elif rows is None:
+                results.append(x if self.rows else None)
+            else:
+                start, stop, vector = rows
+                results.append(y[start:stop] if vector else y[start])
+        return results[0], results[1:]
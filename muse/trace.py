@@ -0,0 +1,94 @@
+"""
+Instrumentation of the stages of plotting: named spans of wall and CPU time, with counts such as
+bytes read and samples, that can be written as a Chrome trace-event file (for chrome://tracing or
+Perfetto) to find which stage, run, log, expression or figure takes the time.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+from timeit import default_timer as timer
+
+
+class Tracer(object):
+    """
+    Records spans as complete ('X') trace events. Spans cost next to nothing unless tracing or
+    verbose reporting of stages is on.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.verbose = False
+        self.events = []
+        self.pid = os.getpid()
+        self.origin = timer()
+        self.lock = threading.Lock()
+
+    def start(self, enabled=False, verbose=False):
+        self.enabled = enabled
+        self.verbose = verbose
+        self.events = []
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def span(self, name, cat='muse', **info):
+        """ Times the enclosed code. Yields a dict of information about the span, such as bytes
+            read or samples, which the code can add to. Stages are reported when verbose """
+        if not self.enabled and not (self.verbose and cat == 'stage'):
+            yield info
+            return
+        start = timer()
+        cpu = time.process_time() if hasattr(time, 'process_time') else time.clock()
+        try:
+            yield info
+        finally:
+            wall = timer() - start
+            cpu = (time.process_time() if hasattr(time, 'process_time') else time.clock()) - cpu
+            if self.verbose and cat == 'stage':
+                print("\nTiming: {} took {:.6f} s ({:.6f} s CPU)".format(name, wall, cpu))
+            if self.enabled:
+                info['cpu_ms'] = 1000 * cpu
+                event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': 1e6 * (start - self.origin),
+                         'dur': 1e6 * wall, 'pid': os.getpid(),
+                         'tid': threading.current_thread().ident, 'args': info}
+                with self.lock:
+                    self.events.append(event)
+
+    def merge(self, result):
+        """ Adds the events that a worker process returned with its result, as wrapped by Traced,
+            and returns the result """
+        result, events = result
+        with self.lock:
+            self.events.extend(events)
+        return result
+
+    def write(self, fn):
+        """ Writes the events in Chrome's trace-event format """
+        with open(fn, 'w') as fh:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fh)
+
+
+class Traced(object):
+    """
+    Wraps a function run by a pool of workers, returning the events recorded while it ran along
+    with its result, since worker processes don't share the tracer. Events of worker threads are
+    recorded directly.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, job):
+        start = len(tracer.events)
+        result = self.func(job)
+        if os.getpid() == tracer.pid:
+            return result, []
+        return result, tracer.events[start:]
+
+
+tracer = Tracer()
+span = tracer.span
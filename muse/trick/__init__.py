@@ -8,15 +8,60 @@ import os
 import collections
 from yaml import YAMLObject
 
-import muse
+from muse import api
+from muse import pputils as pp
+from muse import logindex
 LOG_PREFIX = 'log_'
 HEADER_EXT = '.header'
 INDEX_VAR = 'sys.exec.out.time'
 
 LoggedVar = collections.namedtuple('TrickVar', 'log ctype unit name')
 
+# Most HDF5 files kept open at once, across all runs
+MAX_OPEN_FILES = 64
+
+
 class LogFile(object):
-    pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class HdfFileCache(object):
+    """
+    Least-recently-used set of open HDF5 files, so files are opened once and reused rather than
+    reopened for every variable, without running out of file handles on large Monte Carlo runs.
+    """
+    def __init__(self, maxsize=MAX_OPEN_FILES):
+        self.maxsize = maxsize
+        self.files = collections.OrderedDict()
+
+    def open(self, filename):
+        import h5py
+        try:
+            hdf_file = self.files.pop(filename)
+        except KeyError:
+            hdf_file = h5py.File(filename, 'r')
+            if len(self.files) >= self.maxsize:
+                self.files.popitem(last=False)[1].close()  # Least recently used
+        self.files[filename] = hdf_file
+        return hdf_file
+
+    def close(self, filename=None):
+        for fn in ([filename] if filename else list(self.files.keys())):
+            hdf_file = self.files.pop(fn, None)
+            if hdf_file:
+                hdf_file.close()
+
+
+hdf_files = HdfFileCache()
+
 
 class HdfLogFile(LogFile):
     """
@@ -27,38 +72,96 @@ class HdfLogFile(LogFile):
         self.filename = filename
         self.cache = {}
 
-    def get_var(self, name):
-        import h5py
+    def get_file(self):
+        return hdf_files.open(self.filename)
+
+    def get_var(self, name, start=None, stop=None, step=None):
+        """ Reads a variable, or just a slice of its samples. Contiguous datasets are
+            memory-mapped rather than read """
+        if name not in self.cache:
+            mapped = pp.h5_memmap(self.filename, self.get_file()[name])
+            if mapped is not None:
+                self.cache[name] = mapped
+        if start is None and stop is None and step is None:
+            if not name in self.cache:
+                self.cache[name] = self.get_file()[name][:]
+            return self.cache[name]
+        if name in self.cache:
+            return self.cache[name][start:stop:step]
+        return self.get_file()[name][start:stop:step]
+
+    def get_window(self, tmin=None, tmax=None, index=INDEX_VAR):
+        """ Slice of the samples within [tmin, tmax], found by binary search of the index variable """
+        return pp.time_slice(self.get_file()[index], tmin, tmax)
+
+    def get_series(self, name, index=INDEX_VAR, tmin=None, tmax=None, step=None):
         import pandas as pd
-        if not name in self.cache:
-            with h5py.File(self.filename, 'r') as hdf_file:
-                self.cache[name] = hdf_file[name][:]
+        window = self.get_window(tmin, tmax, index)
+        return pd.Series(self.get_var(name, window.start, window.stop, step),
+                         index=pd.Index(self.get_var(index, window.start, window.stop, step), name=index),
+                         name=name)
+
+    def close(self):
+        hdf_files.close(self.filename)
+
+class CsvLogFile(LogFile):
+    """
+    A Trick-style ASCII log file. Only the header is read up front; columns are read as they are
+    requested.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.columns = [pp.csv_name(name) for name in pp.get_csv_header(self.filename)]
+        self.cache = {}
+
+    def get_arr(self, name):
+        if name not in self.cache:
+            position = self.columns.index(name)
+            self.cache[name] = pp.read_columns(self.filename, [position])[position]
         return self.cache[name]
 
     def get_series(self, name, index=INDEX_VAR):
         import pandas as pd
-        return pd.Series(self.get_var(name), index=pd.Index(self.get_var(index), name=index), name=name)
+        return pd.Series(self.get_arr(name), index=pd.Index(self.get_arr(index), name=index), name=name)
 
-class CsvLogFile(LogFile):
+
+class TrkLogFile(LogFile):
+    """
+    A Trick binary log file, memory-mapped as an array of records so each variable is a view of
+    the file, with nothing to parse.
+    """
     def __init__(self, filename):
-        import pandas as pd
         self.filename = filename
-        self.cache    = pd.read_csv(self.filename, index_col=None)
-        self.cache.columns = [(name.split('{')[0]).strip() for name in self.cache.columns]
+        self.records = None
+
+    def get_records(self):
+        if self.records is None:
+            self.records = pp.trk_memmap(self.filename)
+        return self.records
 
     def get_arr(self, name):
-        return self.cache[name].as_matrix()
+        return self.get_records()[name]
 
-    def get_series(self, name, index=INDEX_VAR):
-        tmp = self.cache.set_index(index)
-        return tmp[name]
+    def get_var(self, name, start=None, stop=None, step=None):
+        return self.get_arr(name)[start:stop:step]
+
+    def get_window(self, tmin=None, tmax=None, index=INDEX_VAR):
+        return pp.time_slice(self.get_arr(index), tmin, tmax)
+
+    def get_series(self, name, index=INDEX_VAR, tmin=None, tmax=None, step=None):
+        import pandas as pd
+        window = self.get_window(tmin, tmax, index)
+        return pd.Series(self.get_var(name, window.start, window.stop, step),
+                         index=pd.Index(self.get_var(index, window.start, window.stop, step), name=index),
+                         name=name)
+
+    def close(self):
+        self.records = None  # The file is unmapped once no views of it are left
 
 
 def map_format(fmt):
-    if fmt == 'ASCII':
-        return '.csv'
-    elif fmt == 'HDF5':
-        return '.h5'
+    if fmt in logindex.LOG_FORMATS:
+        return logindex.LOG_FORMATS[fmt]
     else:
         raise NotImplementedError('Unsupported format: {}'.format(fmt))
 
@@ -78,7 +181,7 @@ def parse_header(fn):
 
     return log_fn, logged_vars
 
-class TrickSim(muse.ContextHandler, YAMLObject):
+class TrickSim(api.ContextHandler, YAMLObject):
     """
     A Trick simulation. Contexts within the simulation correspond to runs (single or Monte Carlo) of the simulation.
     """
@@ -120,7 +223,7 @@ class TrickSim(muse.ContextHandler, YAMLObject):
         return "{}({!r})".format(self.__class__.__name__, self.sim_dir)
 
 
-class Context(muse.Context):
+class Context(api.Context):
     """
     A context in which some variables are evaluated. Can be one or more runs.
     """
@@ -133,12 +236,25 @@ class Context(muse.Context):
             self.logs[name] = HdfLogFile(name)
         elif name.endswith('csv'):
             self.logs[name] = CsvLogFile(name)
+        elif name.endswith('trk'):
+            self.logs[name] = TrkLogFile(name)
 
     def get_log(self, name):
         if name not in self.logs:
             self.load_log(name)
         return self.logs[name]
 
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+        self.logs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def get_var(self, name, index=INDEX_VAR):
         log_fn = next(self.get_var_log(name))
         log = self.get_log(log_fn)
@@ -186,13 +302,17 @@ class SingleRun(Context, YAMLObject):
             if p:
                 yield p
 
+    def get_index(self):
+        # Only the names and logs of variables are looked up, so samples aren't counted
+        return logindex.get_index(os.path.join(self.sim_dir, self.run_dir), samples=False)
+
     def list_variables(self):
-       return  [lv.name for log_fn, logged_vars in self.iter_headers() for lv in logged_vars]
+        return self.get_index().variables()
 
     def get_var_log(self, name):
-        for log_fn, logged_vars in self.iter_headers():
-            if name in [lv.name for lv in logged_vars]:
-                yield log_fn
+        search_dir = os.path.join(self.sim_dir, self.run_dir)
+        for indexed_var in self.get_index().lookup(name):
+            yield os.path.join(search_dir, indexed_var.log)
 
 
     def __repr__(self):
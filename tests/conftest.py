@@ -0,0 +1,76 @@
+"""
+Fixtures for the benchmarks: synthetic runs, sized by the MUSE_BENCH_* environment variables, and
+a stand-in for pytest-benchmark's benchmark fixture when the plugin isn't installed.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import collections
+from timeit import default_timer as timer
+
+import pytest
+
+from tests import synthetic
+
+SAMPLES = int(os.environ.get('MUSE_BENCH_SAMPLES', 2000))
+RUNS = int(os.environ.get('MUSE_BENCH_RUNS', 8))
+VARIABLES = int(os.environ.get('MUSE_BENCH_VARS', 12))
+# Rounds of each benchmark timed by the stand-in fixture
+ROUNDS = int(os.environ.get('MUSE_BENCH_ROUNDS', 3))
+
+
+@pytest.fixture(scope='session')
+def sim(tmp_path_factory):
+    """ A sim directory with a single run and a Monte Carlo of synthetic runs """
+    sim_dir = str(tmp_path_factory.mktemp('sim'))
+    Sim = collections.namedtuple('Sim', 'dir single monte runs samples')
+    return Sim(sim_dir,
+               synthetic.make_sim(sim_dir, 1, SAMPLES, VARIABLES),
+               synthetic.make_sim(sim_dir, RUNS, SAMPLES, VARIABLES),
+               RUNS, SAMPLES)
+
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    _results = []
+
+    class Benchmark(object):
+        """ The parts of pytest-benchmark's fixture the benchmarks use: calling it, pedantic() and
+            extra_info. Times a few rounds and reports the fastest """
+        def __init__(self, name):
+            self.name = name
+            self.extra_info = {}
+
+        def __call__(self, func, *args, **kwargs):
+            return self.pedantic(func, args, kwargs, rounds=ROUNDS)
+
+        def pedantic(self, func, args=(), kwargs=None, setup=None, rounds=1, iterations=1):
+            times = []
+            result = None
+            for i in range(rounds):
+                if setup:
+                    # As in pytest-benchmark, setup can return the arguments of each round
+                    arguments = setup()
+                    if arguments is not None:
+                        args, kwargs = arguments
+                start = timer()
+                for j in range(iterations):
+                    result = func(*args, **(kwargs or {}))
+                times.append((timer() - start) / iterations)
+            _results.append((self.name, min(times), sum(times) / len(times), self.extra_info))
+            return result
+
+    @pytest.fixture
+    def benchmark(request):
+        return Benchmark(request.node.name)
+
+    def pytest_terminal_summary(terminalreporter):
+        if not _results:
+            return
+        terminalreporter.write_sep('-', 'benchmarks (install pytest-benchmark for more)')
+        for name, fastest, mean, info in _results:
+            extra = ' '.join('{}={}'.format(k, info[k]) for k in sorted(info))
+            terminalreporter.write_line('{:<40} min {:9.2f} ms  mean {:9.2f} ms  {}'.format(
+                name, 1000 * fastest, 1000 * mean, extra))
@@ -0,0 +1,126 @@
+"""
+Generator of synthetic Trick run directories, for benchmarks: RUN_ and MONTE_ trees with log
+headers and HDF5, csv and Trick binary logs, logged at different rates.
+
+    $ python -m tests.synthetic SIM_DIR --runs 100 --samples 100000 --vars 30
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import struct
+import argparse as ap
+import collections
+
+INDEX_VAR = 'sys.exec.out.time'
+
+# A log: its name, format (h5, csv or trk) and how many base time steps apart its samples are
+LogSpec = collections.namedtuple('LogSpec', 'name fmt divisor')
+
+LOGS = [
+    LogSpec('log_dyn', 'h5', 1),
+    LogSpec('log_ctl', 'csv', 10),
+    LogSpec('log_gnc', 'trk', 2),
+]
+HEADER_FORMATS = {'h5': 'HDF5', 'csv': 'ASCII', 'trk': 'little_endian'}
+TRICK_DOUBLE = 11
+
+
+def variable_names(log, count):
+    """ Names of the variables of a log, as 3-vectors with a scalar or two left over """
+    prefix = log.name[len('log_'):]
+    names = []
+    for k in range(count // 3):
+        names.extend('{}.v{}[{}]'.format(prefix, k, i) for i in range(3))
+    names.extend('{}.s{}'.format(prefix, k) for k in range(count % 3))
+    return names
+
+
+def write_header(fn, log, names):
+    with open(fn, 'w') as fh:
+        fh.write('{} byte_order is {}\n'.format(log.name, HEADER_FORMATS[log.fmt]))
+        fh.write('{} double s {}\n'.format(log.name, INDEX_VAR))
+        for name in names:
+            fh.write('{} double m {}\n'.format(log.name, name))
+
+
+def write_h5(fn, time, columns):
+    import h5py
+    with h5py.File(fn, 'w') as hdf_file:
+        hdf_file[INDEX_VAR] = time
+        for name in columns:
+            hdf_file[name] = columns[name]
+
+
+def write_csv(fn, time, columns):
+    import numpy as np
+    names = list(columns)
+    with open(fn, 'w') as fh:
+        fh.write(','.join(['{} {{s}}'.format(INDEX_VAR)] + ['{} {{m}}'.format(n) for n in names]))
+        fh.write('\n')
+        np.savetxt(fh, np.column_stack([time] + [columns[n] for n in names]), delimiter=',',
+                   fmt='%.17g')
+
+
+def write_trk(fn, time, columns):
+    import numpy as np
+    names = [INDEX_VAR] + list(columns)
+    with open(fn, 'wb') as fh:
+        fh.write(b'Trick-10-L')
+        fh.write(struct.pack('<i', len(names)))
+        for name in names:
+            for s in [name, 's' if name == INDEX_VAR else 'm']:
+                fh.write(struct.pack('<i', len(s)))
+                fh.write(s.encode('ascii'))
+            fh.write(struct.pack('<ii', TRICK_DOUBLE, 8))
+        fh.write(np.column_stack([time] + [columns[n] for n in columns]).astype('<f8').tobytes())
+
+
+WRITERS = {'h5': write_h5, 'csv': write_csv, 'trk': write_trk}
+
+
+def make_run(run_dir, samples=1000, variables=12, logs=LOGS, dt=0.01, seed=0):
+    """ Writes the logs and headers of a single run. Each log has the given number of variables,
+        sampled every `divisor` base time steps, with a phase that differs from run to run """
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+    for log in logs:
+        time = dt * np.arange(0, samples, log.divisor)
+        names = variable_names(log, variables)
+        columns = collections.OrderedDict()
+        for k, name in enumerate(names):
+            columns[name] = (1 + k % 5) * np.sin(time * (1 + k % 7) / 3 + rng.uniform(0, 2 * np.pi)) \
+                + 0.01 * rng.standard_normal(len(time))
+        write_header(os.path.join(run_dir, log.name + '.header'), log, names)
+        WRITERS[log.fmt](os.path.join(run_dir, log.name + '.' + log.fmt), time, columns)
+
+
+def make_sim(sim_dir, runs=1, samples=1000, variables=12, logs=LOGS, name='bench'):
+    """ Writes a MONTE_<name> directory of runs, or a RUN_<name> directory for a single run.
+        Returns the run or Monte Carlo directory, relative to sim_dir """
+    if runs > 1:
+        top = 'MONTE_' + name
+        for r in range(runs):
+            make_run(os.path.join(sim_dir, top, 'RUN_{:05d}'.format(r)), samples, variables,
+                     logs, seed=r)
+    else:
+        top = 'RUN_' + name
+        make_run(os.path.join(sim_dir, top), samples, variables, logs)
+    return top
+
+
+def main():
+    parser = ap.ArgumentParser(description="Writes synthetic Trick runs for benchmarking muse")
+    parser.add_argument('sim', help="Directory to write the runs in")
+    parser.add_argument('--runs', type=int, default=1, help="Number of Monte Carlo runs")
+    parser.add_argument('--samples', type=int, default=1000, help="Samples of the fastest log")
+    parser.add_argument('--vars', type=int, default=12, help="Variables per log")
+    parser.add_argument('--name', default='bench', help="Name of the RUN_/MONTE_ directory")
+    args = parser.parse_args()
+    print(make_sim(args.sim, args.runs, args.samples, args.vars, name=args.name))
+
+
+if __name__ == '__main__':
+    main()
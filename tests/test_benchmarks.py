@@ -0,0 +1,183 @@
+"""
+Benchmarks of each stage of the command-line pipeline, on synthetic runs. Run with pytest; with
+pytest-benchmark installed, results can be saved and compared release over release:
+
+    $ py.test tests --benchmark-autosave
+    $ py.test tests --benchmark-compare
+"""
+from __future__ import division
+
+import os
+import sys
+import shutil
+from timeit import default_timer as timer
+
+from muse import cli
+from muse import pputils as pp
+from muse import logindex
+from muse import simple_math as sm
+
+# Variables of each synthetic log: the 100 Hz HDF5 log, 10 Hz csv log and 50 Hz Trick binary log
+DYN = ['dyn.v0', 'dyn.v1[2]']
+CTL = ['ctl.v0[1]']
+GNC = ['gnc.v1']
+
+
+def parse(sim, runs, *argv):
+    """ Parses command-line arguments the way main() does """
+    saved = sys.argv
+    sys.argv = ['muse', '-s', sim.dir, '-r', runs] + list(argv)
+    try:
+        args = cli.parse_user_args()
+    finally:
+        sys.argv = saved
+    args.start = args.time = timer()
+    args.runs = pp.check_monte(args.sim, args.runs)
+    return args
+
+
+def prepare(args):
+    """ Runs the stages of main() up to extracting data """
+    logs, lvars = cli.get_logged_vars(args)
+    figs = cli.get_figures(args)
+    cli.get_time_window(args, figs)
+    pvars = cli.get_plot_vars(args, figs, lvars)
+    loglist, vlog = cli.get_logs(args, logs, pvars)
+    return figs, pvars, loglist, vlog
+
+
+def throughput(benchmark, args, samples):
+    benchmark.extra_info['runs'] = len(args.runs)
+    benchmark.extra_info['samples'] = samples
+
+
+def test_get_logged_vars(benchmark, sim):
+    args = parse(sim, sim.monte, '-v', *DYN)
+    logs, lvars = benchmark(cli.get_logged_vars, args)
+    assert 'dyn.v0[0]' in lvars and 'ctl.v0[1]' in lvars
+
+
+def test_log_index_build(benchmark, sim):
+    root = os.path.join(sim.dir, sim.single)
+
+    def setup():
+        # Start from no index, on disk or in memory
+        if os.path.exists(logindex.index_filename(root)):
+            os.remove(logindex.index_filename(root))
+        logindex._indexes.clear()
+
+    index = benchmark.pedantic(logindex.get_index, (root,), setup=setup, rounds=3)
+    assert index.lookup('gnc.v0[0]')[0].log == 'log_gnc.trk'
+
+
+def test_get_logs(benchmark, sim):
+    args = parse(sim, sim.monte, '-v', *(DYN + CTL + GNC))
+    logs, lvars = cli.get_logged_vars(args)
+    figs = cli.get_figures(args)
+    pvars = cli.get_plot_vars(args, figs, lvars)
+    loglist, vlog = benchmark(cli.get_logs, args, logs, pvars)
+    assert sorted(loglist) == ['log_ctl.csv', 'log_dyn.h5', 'log_gnc.trk']
+
+
+def extract(benchmark, sim, variables, *argv):
+    args = parse(sim, sim.monte, '-v', *(variables + list(argv)))
+    figs, pvars, loglist, vlog = prepare(args)
+    rdata, time, source = benchmark(cli.extract_data, args, pvars, loglist, vlog)
+    throughput(benchmark, args, sum(len(time[r][l]) for r in time for l in time[r]))
+    assert len(rdata) == sim.runs
+
+
+def test_extract_h5(benchmark, sim):
+    extract(benchmark, sim, DYN)
+
+
+def test_extract_csv(benchmark, sim):
+    extract(benchmark, sim, CTL)
+
+
+def test_extract_trk(benchmark, sim):
+    extract(benchmark, sim, GNC)
+
+
+def test_extract_parallel(benchmark, sim):
+    extract(benchmark, sim, DYN + GNC, '-j', '4')
+
+
+def test_variable_meld(benchmark, sim):
+    args = parse(sim, sim.single, '-v', *(DYN + CTL + GNC))
+    figs, pvars, loglist, vlog = prepare(args)
+    rdata, time, source = cli.extract_data(args, pvars, loglist, vlog)
+    r = args.runs[0]
+
+    def setup():
+        # Melding replaces the variables it resamples, so each round starts from a copy
+        return (args, dict(rdata[r]), time[r], source[r]), {}
+
+    data, length = benchmark.pedantic(cli.variable_meld, setup=setup, rounds=3)
+    assert length == sim.samples
+
+
+def test_process_data(benchmark, sim):
+    args = parse(sim, sim.monte, '-v', 'sys.exec.out.time', 'dyn.v0[0] * 2 + dyn.v1[1] * dyn.v1[1]',
+                 'dyn.v0 - mean(dyn.v0)')
+    figs, pvars, loglist, vlog = prepare(args)
+    rdata, time, source = cli.extract_data(args, pvars, loglist, vlog)
+
+    def setup():
+        return (args, figs, dict((r, dict(rdata[r])) for r in rdata), time, source), {}
+
+    fout = benchmark.pedantic(cli.process_data, setup=setup, rounds=3)
+    throughput(benchmark, args, sim.runs * sim.samples)
+    assert len(fout[0]['y']) == 2
+
+
+def test_stream_data(benchmark, sim):
+    args = parse(sim, sim.monte, '-v', 'sys.exec.out.time', 'dyn.v0', 'std(dyn.v1[0])',
+                 '--chunk-size', str(max(sim.samples // 8, 1)))
+    figs, pvars, loglist, vlog = prepare(args)
+    fout = benchmark(cli.stream_data, args, figs, pvars, loglist, vlog)
+    throughput(benchmark, args, sim.runs * sim.samples)
+    assert len(fout[0]['y'][0]['data']) == sim.runs
+
+
+def test_stream_runs(benchmark, sim):
+    args = parse(sim, sim.monte, '-v', 'sys.exec.out.time', 'dyn.v0[0]', '--stream-runs')
+    figs, pvars, loglist, vlog = prepare(args)
+    figs[0]['type'] = 'envelope'
+    fout = benchmark(cli.stream_runs, args, figs, pvars, loglist, vlog)
+    throughput(benchmark, args, sim.runs * sim.samples)
+    assert fout[0]['y'][0]['envelope']['runs'] == sim.runs
+
+
+def test_compile(benchmark):
+    def compile_uncached():
+        sm.cache_clear()
+        return sm.compile('(dyn.v0[0] * 2 + dyn.v1[1] * dyn.v1[1]) / 3 - mean(dyn.v0[2]) * -1.5')
+    assert benchmark(compile_uncached) is not None
+
+
+def test_evaluate_runs(benchmark, sim):
+    import numpy as np
+    size = sim.samples
+    batch = dict(('dyn.v0[{}]'.format(i), np.random.rand(sim.runs, size)) for i in range(3))
+    value, length = benchmark(sm.evaluate_runs, 'rss(dyn.v0) * 2 - mean(dyn.v0[0])', batch, size,
+                              sim.runs)
+    benchmark.extra_info['samples'] = sim.runs * size
+    assert value.shape == (sim.runs, size)
+
+
+def test_end_to_end(benchmark, sim, tmp_path):
+    output = str(tmp_path / 'figures')
+    argv = ['muse', '-s', sim.dir, '-r', sim.monte, '-v', 'sys.exec.out.time', 'dyn.v0[0]',
+            'ctl.v0[1]', '-o', output]
+
+    def run():
+        saved = sys.argv
+        sys.argv = argv
+        try:
+            return cli.main()
+        finally:
+            sys.argv = saved
+            shutil.rmtree(output, ignore_errors=True)
+
+    assert benchmark.pedantic(run, rounds=1) == 0
@@ -0,0 +1,67 @@
+"""
+Checks of the columnar store of csv logs against reading the csv itself
+"""
+from __future__ import division
+
+import os
+import collections
+
+import numpy as np
+
+from muse import colstore
+from muse import pputils as pp
+from tests import synthetic
+
+
+def write_log(run_dir, samples=40):
+    time = 0.25 * np.arange(samples)
+    columns = collections.OrderedDict()
+    columns['a[0]'] = np.sin(time)
+    columns['a[1]'] = np.cos(time) * 1e6
+    columns['b'] = -time
+    lfile = os.path.join(run_dir, 'log_a.csv')
+    synthetic.write_csv(lfile, time, columns)
+    return lfile
+
+
+def test_round_trip(tmp_path):
+    lfile = write_log(str(tmp_path))
+    positions = list(range(len(pp.get_csv_header(lfile))))
+    parsed = pp.read_csv_columns(lfile, positions)
+    assert colstore.read_columns(lfile, positions) is None
+    assert colstore.ingest(lfile)
+    assert not colstore.ingest(lfile)  # Already current
+    for tmin, tmax in [(None, None), (1.0, 3.3), (-1, 0.5), (9.75, None), (20, 30)]:
+        stored = colstore.read_columns(lfile, [2, 0], tmin, tmax)
+        window = pp.read_csv_columns(lfile, [2, 0], tmin=tmin, tmax=tmax)
+        assert sorted(stored) == [0, 2]
+        for c in stored:
+            assert np.array_equal(stored[c], window[c]), (c, tmin, tmax)
+    stored = colstore.read_columns(lfile, positions)
+    for c in positions:
+        assert np.array_equal(stored[c], parsed[c])
+
+
+def test_store_invalidated_when_log_changes(tmp_path):
+    lfile = write_log(str(tmp_path))
+    colstore.ingest(lfile)
+    assert colstore.is_current(lfile)
+    with open(lfile, 'a') as fh:
+        fh.write('10,1,2,3\n')
+    assert not colstore.is_current(lfile)
+    assert colstore.read_columns(lfile, [0]) is None
+    # Reads through pputils fall back to the csv, and remake the store if asked to
+    assert pp.read_columns(lfile, [0, 3])[3][-1] == 3
+    assert pp.read_columns(lfile, [0, 3], ingest=True)[3][-1] == 3
+    assert colstore.is_current(lfile)
+    assert colstore.read_columns(lfile, [0])[0][-1] == 10
+
+
+def test_find_logs(tmp_path):
+    sim = str(tmp_path)
+    for r in ['RUN_00001', 'RUN_00000']:
+        os.makedirs(os.path.join(sim, 'MONTE_a', r))
+        write_log(os.path.join(sim, 'MONTE_a', r))
+    colstore.ingest(os.path.join(sim, 'MONTE_a', 'RUN_00000', 'log_a.csv'))
+    assert colstore.find_logs([os.path.join(sim, 'MONTE_a')]) == \
+        [os.path.join(sim, 'MONTE_a', r, 'log_a.csv') for r in ['RUN_00000', 'RUN_00001']]
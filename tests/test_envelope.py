@@ -0,0 +1,68 @@
+"""
+Checks of the envelope statistics folded in a run at a time against those of all the runs at once
+"""
+from __future__ import division
+
+import numpy as np
+
+from muse import envelope as ev
+
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+
+def runs(count, points=20, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.standard_normal((count, points)) * (1 + np.arange(points))
+
+
+def sketch_of(values, size=ev.SKETCH_SIZE):
+    sketch = ev.QuantileSketch(size)
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def test_sketch_exact_up_to_its_size():
+    for count in [1, 2, 7, ev.SKETCH_SIZE]:
+        values = runs(count)
+        quantiles = sketch_of(values).quantiles(PERCENTILES)
+        assert np.allclose(quantiles, np.percentile(values, PERCENTILES, axis=0))
+
+
+def test_sketch_rank_error():
+    values = runs(5000)
+    quantiles = sketch_of(values).quantiles(PERCENTILES)
+    ordered = np.sort(values, axis=0)
+    for p, q in zip(PERCENTILES, quantiles):
+        # Fraction of the runs below each estimate, against the percentile asked for
+        ranks = np.array([np.searchsorted(ordered[:, k], q[k]) for k in range(len(q))])
+        assert np.max(np.abs(ranks / len(values) - p / 100)) < 0.01
+
+
+def test_sketch_merge():
+    values = runs(3000)
+    merged = sketch_of(values[:1000])
+    merged.merge(sketch_of(values[1000:]))
+    assert merged.count == len(values)
+    ordered = np.sort(values, axis=0)
+    for p, q in zip(PERCENTILES, merged.quantiles(PERCENTILES)):
+        ranks = np.array([np.searchsorted(ordered[:, k], q[k]) for k in range(len(q))])
+        assert np.max(np.abs(ranks / len(values) - p / 100)) < 0.01
+
+
+def test_accumulator_matches_envelope_stats():
+    values = runs(100)
+    accumulator = ev.EnvelopeAccumulator(percentiles=PERCENTILES)
+    for value in values[:60]:
+        accumulator.add(value)
+    other = ev.EnvelopeAccumulator(percentiles=PERCENTILES)
+    for value in values[60:]:
+        other.add(value)
+    accumulator.merge(other)
+    folded = accumulator.result()
+    expected = ev.envelope_stats(values, percentiles=PERCENTILES)
+    assert folded['runs'] == expected['runs']
+    for k in ['mean', 'std', 'lower', 'upper', 'min', 'max']:
+        assert np.allclose(folded[k], expected[k])
+    for p in PERCENTILES:
+        assert np.allclose(folded['percentiles'][p], expected['percentiles'][p])
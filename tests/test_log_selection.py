@@ -0,0 +1,71 @@
+"""
+Checks of the choice of logs to read against trying every set of logs
+"""
+from __future__ import division
+
+import itertools
+
+import numpy as np
+
+from muse import pputils as pp
+
+
+def random_logs(count, variables, seed):
+    """ Which of the logs each variable is in, at least one, and a cost for each log """
+    rng = np.random.RandomState(seed)
+    logs = ['log_{}'.format(k) for k in range(count)]
+    vldict = {}
+    for v in range(variables):
+        chosen = [l for l in logs if rng.rand() < 0.3]
+        vldict['v{}'.format(v)] = chosen or [logs[rng.randint(count)]]
+    costs = dict((l, float(rng.randint(1, 100))) for l in logs)
+    return vldict, costs
+
+
+def cheapest_cover(vldict, costs):
+    candidates = sorted(set(l for v in vldict for l in vldict[v]))
+    best = None
+    for n in range(1, len(candidates) + 1):
+        for chosen in itertools.combinations(candidates, n):
+            if all(set(vldict[v]) & set(chosen) for v in vldict):
+                cost = sum(costs[l] for l in chosen)
+                best = cost if best is None else min(best, cost)
+    return best
+
+
+def check_selection(vldict, costs, selected, vlog):
+    assert len(set(selected)) == len(selected)
+    for v in vldict:
+        assert vlog[v] in selected and vlog[v] in vldict[v]
+        assert costs[vlog[v]] == min(costs[l] for l in selected if l in vldict[v])
+
+
+def test_exact_selection_is_cheapest():
+    for seed in range(40):
+        vldict, costs = random_logs(6, 10, seed)
+        selected, vlog = pp.select_logs(vldict, costs)
+        check_selection(vldict, costs, selected, vlog)
+        assert sum(costs[l] for l in selected) == cheapest_cover(vldict, costs)
+
+
+def test_greedy_selection_covers_everything():
+    for seed in range(10):
+        vldict, costs = random_logs(pp.EXACT_MAX_LOGS + 8, 40, seed)
+        selected, vlog = pp.select_logs(vldict, costs)
+        check_selection(vldict, costs, selected, vlog)
+
+
+def test_fewer_logs_when_one_has_everything():
+    vldict = {'a': ['log_a.csv', 'log_all.h5'], 'b': ['log_b.trk', 'log_all.h5'],
+              'c': ['log_all.h5']}
+    costs = {'log_a.csv': 10.0, 'log_b.trk': 10.0, 'log_all.h5': 15.0}
+    selected, vlog = pp.select_logs(vldict, costs)
+    assert selected == ['log_all.h5']
+    assert set(vlog.values()) == set(['log_all.h5'])
+
+
+def test_csv_costs_more_than_binary(tmp_path):
+    for ext in ['.csv', '.h5']:
+        with open(str(tmp_path / ('log_a' + ext)), 'wb') as fh:
+            fh.write(b'0' * 100000)
+    assert pp.log_cost(str(tmp_path / 'log_a.csv')) > pp.log_cost(str(tmp_path / 'log_a.h5'))
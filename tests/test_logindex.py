@@ -0,0 +1,61 @@
+"""
+Checks that the log index of a run follows its headers and logs as they change
+"""
+from __future__ import division
+
+import os
+import json
+
+from muse import logindex
+from tests import synthetic
+
+
+def make_run(tmp_path, samples=100):
+    run_dir = str(tmp_path / 'RUN_a')
+    synthetic.make_run(run_dir, samples, variables=4)
+    return run_dir
+
+
+def samples(index, name):
+    return [v.samples for v in index.lookup(name)]
+
+
+def test_index_of_a_run(tmp_path):
+    run_dir = make_run(tmp_path)
+    index = logindex.LogIndex(run_dir)
+    assert index.lookup('dyn.v0[1]') == [logindex.IndexedVar('log_dyn.h5', 'double', 'm', 100)]
+    assert samples(index, 'ctl.s0') == [10]
+    assert samples(index, 'gnc.v0[2]') == [50]
+    assert set(index.logs()) == set(['log_dyn.h5', 'log_ctl.csv', 'log_gnc.trk'])
+    with open(logindex.index_filename(run_dir)) as fh:
+        assert json.load(fh)['version'] == logindex.INDEX_VERSION
+    # Names only, without reading the logs
+    assert samples(logindex.LogIndex(make_run(tmp_path / 'b'), samples=False), 'ctl.s0') == [None]
+
+
+def test_index_follows_changes(tmp_path):
+    run_dir = make_run(tmp_path)
+    logindex.LogIndex(run_dir)
+    # A log that grows is counted again
+    with open(os.path.join(run_dir, 'log_ctl.csv'), 'a') as fh:
+        fh.write('1,2,3,4,5\n1,2,3,4,5')
+    assert samples(logindex.LogIndex(run_dir), 'ctl.s0') == [12]
+    # A header that changes is parsed again, and one that's removed is dropped
+    with open(os.path.join(run_dir, 'log_gnc.header'), 'a') as fh:
+        fh.write('log_gnc double m gnc.extra\n')
+    os.remove(os.path.join(run_dir, 'log_dyn.header'))
+    index = logindex.LogIndex(run_dir)
+    assert samples(index, 'gnc.extra') == [50]
+    assert index.lookup('dyn.v0[1]') == []
+    # A log that can't be read has no count
+    with open(os.path.join(run_dir, 'log_gnc.trk'), 'wb') as fh:
+        fh.write(b'not a log')
+    assert samples(logindex.LogIndex(run_dir), 'gnc.extra') == [None]
+
+
+def test_counts_added_to_an_index_without_them(tmp_path):
+    run_dir = make_run(tmp_path)
+    index = logindex.get_index(run_dir, samples=False)
+    assert samples(index, 'ctl.s0') == [None]
+    assert logindex.get_index(run_dir) is index
+    assert samples(index, 'ctl.s0') == [10]
@@ -0,0 +1,64 @@
+"""
+Checks of the resampling methods and time bases against signals with known values
+"""
+from __future__ import division
+
+import argparse
+
+import numpy as np
+
+from muse import cli
+from muse import resample as rs
+
+# Uneven log times, and times to resample to across and beyond them
+T = np.array([0.0, 0.1, 0.3, 0.35, 0.7, 1.0])
+BASE = np.array([-0.5, 0.0, 0.05, 0.1, 0.2, 0.31, 0.34, 0.5, 0.9, 1.0, 2.0])
+
+
+def test_linear_is_exact_on_lines():
+    y = 3 * T - 1
+    inside = (BASE >= T[0]) & (BASE <= T[-1])
+    value = rs.resample(T, y, BASE, 'linear')
+    assert np.allclose(value[inside], 3 * BASE[inside] - 1)
+    assert value[0] == y[0] and value[-1] == y[-1]  # Ends are held
+
+
+def test_zoh_holds_the_last_sample():
+    y = np.arange(len(T), dtype=float)
+    value = rs.resample(T, y, BASE, 'zoh')
+    assert np.array_equal(value, [0, 0, 0, 1, 1, 2, 2, 3, 4, 5, 5])
+
+
+def test_nearest_takes_the_closest_sample():
+    y = np.arange(len(T), dtype=float)
+    value = rs.resample(T, y, BASE, 'nearest')
+    expected = [y[np.argmin(np.abs(T - b))] for b in BASE]
+    assert np.array_equal(value, expected)
+
+
+def test_same_times_and_single_samples():
+    y = np.sin(T)
+    for method in rs.METHODS:
+        assert rs.resample(T, y, T.copy(), method) is y
+        assert np.array_equal(rs.resample(T[:1], y[:1], BASE, method), np.full(len(BASE), y[0]))
+
+
+def test_time_bases():
+    fine = np.linspace(0, 1, 101)
+    coarse = np.linspace(0.5, 2, 4)
+    assert rs.time_base([coarse, fine]) is fine
+    assert rs.time_base([coarse, fine], 'coarsest') is coarse
+    assert np.allclose(rs.time_base([coarse, fine], dt=0.25), np.arange(9) * 0.25)
+
+
+def test_meld_onto_the_finest_log():
+    fine = np.linspace(0, 1, 11)
+    coarse = np.linspace(0, 1, 3)
+    data = {'a': 2 * fine, 'b': 4 * coarse, 'sys.exec.out.time': fine}
+    time = {'log_a.h5': fine, 'log_b.csv': coarse}
+    source = {'a': 'log_a.h5', 'b': 'log_b.csv'}
+    args = argparse.Namespace(grid='finest', dt=None, resample='linear')
+    data, length = cli.variable_meld(args, data, time, source)
+    assert length == len(fine)
+    assert np.array_equal(data['sys.exec.out.time'], fine)
+    assert np.allclose(data['a'], 2 * fine) and np.allclose(data['b'], 4 * fine)
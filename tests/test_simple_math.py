@@ -0,0 +1,238 @@
+"""
+Checks of simple_math expressions against numpy, naive loops and evaluation one run at a time
+"""
+from __future__ import division
+
+import warnings
+
+import numpy as np
+
+from muse import simple_math as sm
+
+
+def rotation_matrix(q):
+    """ Rotation matrix of a unit scalar-first quaternion """
+    w, x, y, z = q
+    return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+                     [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+                     [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)]])
+
+
+def random_vars(n=50, seed=0):
+    rng = np.random.RandomState(seed)
+    q = rng.standard_normal((4, n))
+    q /= np.sqrt(np.sum(q * q, axis=0))
+    a = rng.standard_normal((3, n))
+    b = rng.standard_normal((3, n))
+    variables = {}
+    for name, value in [('q', q), ('a', a), ('b', b), ('p', q[::-1].copy())]:
+        for i, c in enumerate(value):
+            variables['{}[{}]'.format(name, i)] = c
+    return variables, q, a, b
+
+
+def test_dot_cross_norm():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    assert np.allclose(sm.evaluate('dot(a, b)', variables, n)[0], np.sum(a * b, axis=0))
+    assert np.allclose(sm.evaluate('cross(a, b)', variables, n)[0], np.cross(a.T, b.T).T)
+    assert np.allclose(sm.evaluate('norm(a)', variables, n)[0], np.linalg.norm(a, axis=0))
+    assert np.allclose(sm.evaluate('norm(unit(a))', variables, n)[0], 1)
+
+
+def test_angle_between():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    cos = np.sum(a * b, axis=0) / (np.linalg.norm(a, axis=0) * np.linalg.norm(b, axis=0))
+    assert np.allclose(sm.evaluate('angle_between(a, b)', variables, n)[0], np.arccos(cos))
+
+
+def test_qrot_matches_rotation_matrix():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    rotated = sm.evaluate('qrot(q, a)', variables, n)[0]
+    expected = np.stack([rotation_matrix(q[:, k]).dot(a[:, k]) for k in range(n)], axis=1)
+    assert np.allclose(rotated, expected)
+
+
+def test_qtrans_inverts_qrot():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    assert np.allclose(sm.evaluate('qtrans(q, qrot(q, a))', variables, n)[0], a)
+    expected = np.stack([rotation_matrix(q[:, k]).T.dot(a[:, k]) for k in range(n)], axis=1)
+    assert np.allclose(sm.evaluate('qtrans(q, a)', variables, n)[0], expected)
+
+
+def test_qmul_composes_rotations():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    composed = sm.evaluate('qrot(qmul(p, q), a)', variables, n)[0]
+    assert np.allclose(composed, sm.evaluate('qrot(p, qrot(q, a))', variables, n)[0])
+    identity = sm.evaluate('qmul(q, qconj(q))', variables, n)[0]
+    assert np.allclose(identity, np.array([1, 0, 0, 0])[:, np.newaxis])
+
+
+def test_vector_functions_over_runs():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    batch = dict((v, np.stack([variables[v], 2 * variables[v]])) for v in variables)
+    value, length = sm.evaluate_runs('cross(a, qrot(q, b))', batch, n, 2)
+    single = sm.evaluate('cross(a, qrot(q, b))', variables, n)[0]
+    assert value.shape == (3, 2, n)
+    assert np.allclose(value[:, 0], single)
+
+
+def time_vars(n=2001, seed=0):
+    """ A noisy signal at uneven time steps """
+    rng = np.random.RandomState(seed)
+    t = np.cumsum(rng.uniform(0.005, 0.015, n))
+    x = np.sin(t) + 0.1 * rng.standard_normal(n)
+    return {sm.TIME: t, 'x': x}, t, x
+
+
+def window_loop(x, k, reduce):
+    """ Reduces a centered window of k samples at each sample, cut short at the ends """
+    h = k // 2
+    return np.array([reduce(x[max(i - h, 0):min(i - h + k, len(x))]) for i in range(len(x))])
+
+
+def test_ddt_matches_gradient():
+    variables, t, x = time_vars()
+    assert np.allclose(sm.evaluate('ddt(x)', variables, len(t))[0], np.gradient(x, t))
+
+
+def test_diff_and_cumtrapz():
+    variables, t, x = time_vars()
+    diff = sm.evaluate('diff(x)', variables, len(t))[0]
+    assert diff[0] == 0 and np.allclose(diff[1:], np.diff(x))
+    integral = sm.evaluate('cumtrapz(x)', variables, len(t))[0]
+    expected = np.concatenate([[0], np.cumsum((x[1:] + x[:-1]) / 2 * np.diff(t))])
+    assert np.allclose(integral, expected)
+
+
+def test_moving_windows_match_loops():
+    variables, t, x = time_vars()
+    dt = np.median(np.diff(t))
+    for width in [0, 0.05, 0.5, 7.3, 1000]:
+        k = int(min(max(round(width / dt), 1), len(x)))
+        movmean = sm.evaluate('movmean(x, {})'.format(width), variables, len(t))[0]
+        movmax = sm.evaluate('movmax(x, {})'.format(width), variables, len(t))[0]
+        assert np.allclose(movmean, window_loop(x, k, np.mean))
+        assert np.array_equal(movmax, window_loop(x, k, np.max))
+
+
+def test_lowpass_matches_recursion():
+    variables, t, x = time_vars()
+    dt = np.median(np.diff(t))
+    for tau in [0.001, 0.02, 1.0, 100.0]:
+        b = np.exp(-dt / tau)
+        expected = np.empty_like(x)
+        y = x[0]
+        for i in range(len(x)):
+            y = b * y + (1 - b) * x[i]
+            expected[i] = y
+        assert np.allclose(sm.evaluate('lowpass(x, {})'.format(tau), variables, len(t))[0],
+                           expected)
+
+
+def test_resample_holds_samples():
+    variables, t, x = time_vars()
+    held = sm.evaluate('resample(x, 0.1)', variables, len(t))[0]
+    for i in range(len(t)):
+        grid = t[0] + np.floor((t[i] - t[0]) / 0.1 + sm.EPSILON) * 0.1
+        assert held[i] == x[np.searchsorted(t, grid + sm.EPSILON, side='right') - 1]
+
+
+def test_time_functions_over_runs():
+    variables, t, x = time_vars()
+    batch = dict((v, np.stack([variables[v], variables[v]])) for v in variables)
+    expression = 'lowpass(movmax(ddt(x), 0.1), 0.2)'
+    value, length = sm.evaluate_runs(expression, batch, len(t), 2)
+    assert np.allclose(value[0], sm.evaluate(expression, variables, len(t))[0])
+    assert np.allclose(value[1], value[0])
+
+
+def test_precision_snaps_finite_values_only():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        value = sm.getPrecision(np.array([np.inf, -np.inf, np.nan, 1 + 1e-15, 2.5]))
+    assert np.array_equal(value, [np.inf, -np.inf, 0, 1, 2.5])
+
+
+def test_precedence():
+    for expression, expected in [('1 + 2 * 3', 7), ('(1 + 2) * 3', 9), ('8 / 4 / 2', 1),
+                                 ('2 * 3 / 4 * 2', 3), ('2 ^ 3 ^ 2', 512), ('-2 ^ 2', 4),
+                                 ('1 - 2 - 3', -4), ('2 * -3 + 1', -5), ('3 - -1', 4),
+                                 ('2 ^ 0.5 * 2 ^ 0.5', 2), ('pi * 2 / pi', 2)]:
+        assert sm.evaluate(expression)[0] == expected, expression
+
+
+def test_element_wise_arithmetic():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    x = variables['a[0]']
+    y = variables['b[1]']
+    value, length = sm.evaluate('a[0] * 2 + b[1] ^ 2 / (1 + a[0] * a[0]) - 3', variables, n)
+    assert length == n
+    assert np.allclose(value, x * 2 + y ** 2 / (1 + x * x) - 3)
+    assert np.allclose(sm.evaluate('2 * a - b', variables, n)[0], 2 * a - b)
+    assert np.allclose(sm.evaluate('rss(a)', variables, n)[0], np.sqrt(np.sum(a * a, axis=0)))
+    assert np.allclose(sm.evaluate('log(rss(a))', variables, n)[0],
+                       np.log10(np.linalg.norm(a, axis=0)))
+
+
+def test_reductions_and_constants():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    x = variables['a[0]']
+    assert sm.evaluate('mean(a[0])', variables, n) == (np.mean(x), 1)
+    assert np.isclose(sm.evaluate('std(a[0])', variables, n)[0], np.std(x))
+    assert sm.evaluate('max(a[0])', variables, n)[0] == np.max(x)
+    assert sm.evaluate('last(a[0])', variables, n)[0] == x[-1]
+    assert np.allclose(sm.evaluate('a[0] - mean(a[0])', variables, n)[0], x - np.mean(x))
+    value, length = sm.evaluate('3', variables, n)
+    assert length == n and np.array_equal(value, np.full(n, 3.0))
+
+
+def test_cache_hits_and_eviction():
+    cache = sm.ExpressionCache(maxsize=2)
+    first = cache.get('a + 1')
+    assert cache.get('a + 1') is first
+    cache.get('b + 1')
+    cache.get('a + 1')  # Now the most recently used
+    cache.get('c + 1')  # Evicts 'b + 1'
+    assert cache.info() == sm.CacheInfo(hits=2, misses=3, maxsize=2, currsize=2)
+    assert list(cache.nodes) == ['a + 1', 'c + 1']
+    cache.get('b + 1')
+    assert cache.info().misses == 4
+    cache.clear()
+    assert cache.info() == sm.CacheInfo(0, 0, 2, 0)
+
+
+def test_runs_match_each_run():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    runs = [dict((v, variables[v] * (k + 1) + k) for v in variables) for k in range(3)]
+    batch = dict((v, np.stack([r[v] for r in runs])) for v in variables)
+    for expression in ['a[0] * 2 + b[1]', 'rss(a)', 'a[0] - mean(a[0])', 'std(b[2])', 'last(a[1])',
+                       'max(a[0] * b[0])', '4']:
+        value, length = sm.evaluate_runs(expression, batch, n, len(runs))
+        assert length == sm.evaluate(expression, runs[0], n)[1]
+        for k, r in enumerate(runs):
+            assert np.allclose(value[k], sm.evaluate(expression, r, n)[0]), expression
+
+
+def test_program_matches_uncompiled():
+    variables, q, a, b = random_vars()
+    n = a.shape[1]
+    expressions = ['rss(a) * 2', 'rss(a) + mean(rss(a))', 'cross(a, b)', 'norm(cross(a, b))',
+                   sm.TIME, 'a[0]']
+    variables[sm.TIME] = np.arange(n, dtype=float)
+    program = sm.Program(expressions)
+    assert program.shared == set(['rss(a)', 'cross(a, b)'])
+    scope = program.scope(variables)
+    for expression in expressions:
+        value, length = program.evaluate(expression, scope, n)
+        expected = sm.evaluate(expression, variables, n)
+        assert length == expected[1] and np.allclose(value, expected[0]), expression
+    assert set(scope.memo) == program.shared
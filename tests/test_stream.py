@@ -0,0 +1,58 @@
+"""
+Checks of the streaming reducers against the whole of the samples at once
+"""
+from __future__ import division
+
+import numpy as np
+
+from muse import stream
+
+
+def lines(n, count=3, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.cumsum(rng.uniform(0.5, 1.5, n))
+    y = rng.standard_normal((count, n))
+    return x, y
+
+
+def test_min_max_kept_over_chunks():
+    for trial in range(300):
+        rng = np.random.RandomState(trial)
+        n = rng.randint(1, 200)
+        points = rng.randint(2, 40)
+        chunk = rng.randint(1, 50)
+        x, y = lines(n, seed=trial)
+        reducer = stream.MinMaxReducer(points)
+        for start in range(0, n, chunk):
+            reducer.add(x[start:start + chunk], y[:, start:start + chunk])
+        rx, ry = reducer.result()
+        assert np.array_equal(ry.min(axis=1), y.min(axis=1)), (n, points, chunk)
+        assert np.array_equal(ry.max(axis=1), y.max(axis=1)), (n, points, chunk)
+        assert rx[0] == x[0] and rx[-1] == x[-1]
+        assert np.all(np.diff(rx) > 0)
+
+
+def test_min_max_keeps_samples_of_a_merging_chunk():
+    x, y = lines(26, count=1)
+    y[0, 23] = 100
+    reducer = stream.MinMaxReducer(5)
+    reducer.add(x[:13], y[:, :13])
+    reducer.add(x[13:], y[:, 13:])
+    rx, ry = reducer.result()
+    assert x[23] in rx and ry.max() == 100
+
+
+def test_running_stats_over_chunks():
+    x, y = lines(101)
+    stats = stream.RunningStats()
+    other = stream.RunningStats()
+    for start in range(0, 60, 7):
+        stats.add(y[:, start:min(start + 7, 60)])
+    other.add(y[:, 60:])
+    stats.merge(other)
+    assert stats.count == y.shape[1]
+    assert np.allclose(stats.mean, y.mean(axis=1))
+    assert np.allclose(stats.std(), y.std(axis=1))
+    assert np.array_equal(stats.min, y.min(axis=1))
+    assert np.array_equal(stats.max, y.max(axis=1))
+    assert np.array_equal(stats.last, y[:, -1])
@@ -0,0 +1,70 @@
+"""
+Checks of time windows read from logs against the whole of the logs, cut to the window
+"""
+from __future__ import division
+
+import os
+import argparse
+import collections
+
+import numpy as np
+
+from muse import pputils as pp
+from tests import synthetic
+
+TIME = np.round(0.1 * np.arange(50), 10)
+# Windows on, between, before and after the samples, and empty ones
+WINDOWS = [(None, None), (0.0, 4.9), (1.0, 2.0), (1.05, 1.95), (-1, 0.0), (4.9, 10), (None, 0.3),
+           (2.5, None), (-5, -1), (5.5, 9), (1.01, 1.09), (2.0, 2.0)]
+
+
+def columns():
+    data = collections.OrderedDict()
+    data['a'] = np.sin(TIME)
+    data['b'] = TIME ** 2
+    return data
+
+
+def inside(tmin, tmax):
+    keep = np.ones(len(TIME), dtype=bool)
+    if tmin is not None:
+        keep &= TIME >= tmin
+    if tmax is not None:
+        keep &= TIME <= tmax
+    return keep
+
+
+def test_time_slice():
+    for tmin, tmax in WINDOWS:
+        window = pp.time_slice(TIME, tmin, tmax)
+        assert np.array_equal(TIME[window], TIME[inside(tmin, tmax)]), (tmin, tmax)
+
+
+def test_csv_window_bounds(tmp_path):
+    lfile = str(tmp_path / 'log_a.csv')
+    synthetic.write_csv(lfile, TIME, columns())
+    with open(lfile, 'rb') as fh:
+        text = fh.read()
+    for tmin, tmax in WINDOWS:
+        start, stop = pp.csv_window(lfile, tmin, tmax)
+        rows = text[start:stop].splitlines()
+        times = np.array([float(row.split(b',')[0]) for row in rows])
+        assert start == 0 or text[start - 1:start] == b'\n'
+        assert stop == len(text) or text[stop - 1:stop] == b'\n'
+        assert np.array_equal(times, TIME[inside(tmin, tmax)]), (tmin, tmax)
+
+
+def test_extract_windows(tmp_path):
+    extract = {'h5': pp.extract_h5, 'csv': pp.extract_csv, 'trk': pp.extract_trk}
+    for fmt in extract:
+        lfile = os.path.join(str(tmp_path), 'log_a.' + fmt)
+        synthetic.WRITERS[fmt](lfile, TIME, columns())
+        for tmin, tmax in WINDOWS:
+            args = argparse.Namespace(tmin=tmin, tmax=tmax, csv_engine='c', ingest=False)
+            data, time = extract[fmt](args, ['a', 'b'], {}, lfile)
+            keep = inside(tmin, tmax)
+            assert len(time) == np.sum(keep), (fmt, tmin, tmax)
+            # The c csv parser can round the last digit of the values written
+            assert np.allclose(time, TIME[keep], rtol=1e-14, atol=1e-15)
+            assert np.allclose(data['a'], columns()['a'][keep], rtol=1e-14, atol=1e-15)
+            assert np.allclose(data['b'], columns()['b'][keep], rtol=1e-14, atol=1e-15)